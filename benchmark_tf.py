@@ -0,0 +1,114 @@
+# Benchmarks tensorflow settings for concurrent single board evaluations.
+#
+# Runs the same search-like load (game threads each evaluating one board at a
+# time) for every combination of model call mode, intra op threads and game
+# threads, each in a fresh process (thread pools can only be sized once per
+# process), and prints evaluations per second, best first:
+#   python benchmark_tf.py path/to/model.h5 [seconds per run]
+# Use the best row's values for MODEL_CALL_MODE, TF_INTRA_OP_THREADS and
+# BATCH_GAME_WORKERS.
+
+import json
+import os
+import subprocess
+import sys
+
+
+CALL_MODES = ("predict", "call", "function")
+
+
+def run_benchmark(model_path, call_mode, intra_op_threads, game_threads, seconds):
+    """
+    Evaluates boards from game_threads threads for given -> seconds in this process
+    Returns -> {evaluations_per_second, mean_latency}
+    """
+    os.environ["MODEL_CALL_MODE"] = call_mode
+
+    import threading
+    import time
+    import chess
+    import numpy
+    from tf_config import configure_tensorflow, evaluate_boards
+    configure_tensorflow(intra_op_threads, 1)
+    from tensorflow import keras
+    from search import split_dims
+
+    model = keras.models.load_model(model_path)
+
+    # positions of a random game, like the boards search evaluates
+    board = chess.Board()
+    boards = []
+    while not board.is_game_over() and len(boards) < 64:
+        board.push(list(board.legal_moves)[len(boards) * 7 % board.legal_moves.count()])
+        boards.append(numpy.expand_dims(split_dims(board), 0))
+
+    evaluate_boards(model, boards[0]) # warm up
+
+    counts = [0] * game_threads
+    deadline = time.perf_counter() + seconds
+
+    def evaluate(thread_number):
+        i = thread_number
+        while time.perf_counter() < deadline:
+            evaluate_boards(model, boards[i % len(boards)])
+            counts[thread_number] += 1
+            i += 1
+
+    threads = [threading.Thread(target=evaluate, args=(i,)) for i in range(game_threads)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    evaluations = sum(counts)
+    return {
+        "evaluations_per_second": evaluations / elapsed,
+        "mean_latency": elapsed * game_threads / max(1, evaluations),
+    }
+
+
+def main(argv):
+    usage = "usage: python benchmark_tf.py <model.h5> [seconds per run]"
+    if len(argv) < 1:
+        print(usage)
+        return 1
+
+    if argv[0] == "--run": # one configuration, run in a child process
+        model_path, call_mode, intra_op_threads, game_threads, seconds = argv[1], argv[2], int(argv[3]), int(argv[4]), float(argv[5])
+        print(json.dumps(run_benchmark(model_path, call_mode, intra_op_threads, game_threads, seconds)))
+        return 0
+
+    model_path = argv[0]
+    seconds = float(argv[1]) if len(argv) > 1 else 5.0
+
+    from tf_config import available_cpus
+    cpus = available_cpus()
+    thread_counts = sorted({1, 2, cpus // 2, cpus} - {0})
+
+    results = []
+    for call_mode in CALL_MODES:
+        for intra_op_threads in thread_counts:
+            for game_threads in thread_counts:
+                output = subprocess.run(
+                    [sys.executable, __file__, "--run", model_path, call_mode, str(intra_op_threads), str(game_threads), str(seconds)],
+                    capture_output=True, text=True, env=dict(os.environ, TF_CPP_MIN_LOG_LEVEL="3")
+                )
+                try:
+                    result = json.loads(output.stdout.strip().splitlines()[-1])
+                except (IndexError, ValueError):
+                    print(f"{call_mode} intra={intra_op_threads} games={game_threads} failed:", output.stderr.strip()[-500:])
+                    continue
+                results.append((result["evaluations_per_second"], result["mean_latency"], call_mode, intra_op_threads, game_threads))
+                print(f"{call_mode:>8} intra={intra_op_threads:<3} games={game_threads:<3} {result['evaluations_per_second']:10.1f} evals/s {result['mean_latency'] * 1000:8.2f} ms/eval")
+
+    print(f"\n{cpus} cores available, best first:")
+    print(f"{'evals/s':>10} {'ms/eval':>8}  MODEL_CALL_MODE  TF_INTRA_OP_THREADS  BATCH_GAME_WORKERS")
+    for evaluations_per_second, mean_latency, call_mode, intra_op_threads, game_threads in sorted(results, reverse=True):
+        print(f"{evaluations_per_second:10.1f} {mean_latency * 1000:8.2f}  {call_mode:<15}  {intra_op_threads:<19}  {game_threads}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
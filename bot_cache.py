@@ -0,0 +1,143 @@
+# Functions and classes to support caching bot replies to positions.
+#
+# Human players of the same bot often reach the same positions (especially
+# openings), so the bot's reply is cached keyed by
+# (bot_player_id, model_hash, normalized fen, search depth).
+# The fen is normalized by dropping the move clocks, which don't change the
+# bot's search. Entries expire after a ttl and the least recently used entry is
+# evicted when the cache is full.
+
+from metrics import Counter, Gauge
+import chess
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+BOT_CACHE_SIZE = int(os.environ.get("BOT_CACHE_SIZE", 50000)) # max cached replies
+BOT_CACHE_TTL = float(os.environ.get("BOT_CACHE_TTL", 24 * 60 * 60)) # seconds
+
+# common human (white) moves explored when pre-warming a bot's opening replies
+PREWARM_WHITE_MOVES = (
+    "e2e4", "d2d4", "c2c4", "g1f3", "b1c3", "g2g3", "f2f4", "b2b3",
+    "e4e5", "d4d5", "f1c4", "f1b5", "c1f4", "c1g5", "f1e2", "e1g1",
+)
+PREWARM_MAX_PLIES = int(os.environ.get("BOT_CACHE_PREWARM_PLIES", 6)) # human moves deep
+PREWARM_MAX_POSITIONS = int(os.environ.get("BOT_CACHE_PREWARM_POSITIONS", 500))
+
+
+def normalize_fen(board):
+    """
+    Returns fen of given -> chess.Board without halfmove and fullmove clocks
+    En passant square only kept if a capture is legal, so equal positions share one key
+    """
+    return board.fen(en_passant="legal").rsplit(" ", 2)[0]
+
+
+class MoveCache:
+    """
+    Thread safe LRU cache of bot replies with ttl expiry
+    """
+    def __init__(self, max_entries=BOT_CACHE_SIZE, ttl=BOT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = OrderedDict() # key -> (expires_at, move uci)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+
+    def make_key(self, bot_player_id, model_hash, board, depth):
+        return (str(bot_player_id), model_hash, normalize_fen(board), depth)
+
+
+    def get(self, bot_player_id, model_hash, board, depth):
+        """
+        Returns cached reply for given position as chess.Move or None if not cached
+        """
+        key = self.make_key(bot_player_id, model_hash, board, depth)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry == None or entry[0] < time.monotonic():
+                if entry != None: # expired
+                    del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            move_uci = entry[1]
+
+        return chess.Move.from_uci(move_uci)
+
+
+    def contains(self, bot_player_id, model_hash, board, depth):
+        """
+        Returns True if a live reply is cached for given position (no hit/miss counted)
+        """
+        key = self.make_key(bot_player_id, model_hash, board, depth)
+
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry != None and entry[0] >= time.monotonic()
+
+
+    def put(self, bot_player_id, model_hash, board, depth, move):
+        """
+        Caches given -> move as the bot's reply to given position
+        """
+        key = self.make_key(bot_player_id, model_hash, board, depth)
+
+        with self.lock:
+            self.entries[key] = (time.monotonic() + self.ttl, move.uci())
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+
+def iter_prewarm_positions(max_plies=PREWARM_MAX_PLIES, max_positions=PREWARM_MAX_POSITIONS):
+    """
+    Yields opening positions (bot to move, bot is black) reached by common human
+    moves, breadth first. The caller sends back the bot's reply to each position
+    so the tree can be played out further.
+    Returns generator -> chess.Board, ... (send -> chess.Move | None)
+    """
+    frontier = [chess.Board()]
+    positions = 0
+
+    for ply in range(max_plies):
+        next_frontier = []
+        for board in frontier:
+            legal_moves = {move.uci() for move in board.legal_moves}
+            for move_uci in PREWARM_WHITE_MOVES:
+                if move_uci not in legal_moves:
+                    continue
+                human_board = board.copy(stack=False)
+                human_board.push_uci(move_uci)
+                if human_board.is_game_over():
+                    continue
+
+                bot_move = yield human_board
+                positions += 1
+                if positions >= max_positions:
+                    return
+
+                if bot_move != None:
+                    human_board.push(bot_move)
+                    if not human_board.is_game_over():
+                        next_frontier.append(human_board)
+        frontier = next_frontier
+
+
+# one cache shared by every bot move request in this process
+bot_move_cache = MoveCache()
+
+BOT_CACHE_REQUESTS = Counter("chess_bot_cache_requests_total", "Bot reply cache lookups by result.", ("result",),
+    function=lambda: {("hit",): bot_move_cache.hits, ("miss",): bot_move_cache.misses})
+BOT_CACHE_ENTRIES = Gauge("chess_bot_cache_entries", "Bot replies currently cached.", function=lambda: len(bot_move_cache))
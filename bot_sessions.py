@@ -0,0 +1,149 @@
+# Functions and classes to support stateful human vs. bot game sessions.
+#
+# A session keeps the game's board (with move history), the bot's loaded model
+# and its transposition table in memory between /botmove calls, so each call
+# only applies the human's move instead of replaying the game from a fen, and
+# search results are reused across moves. Sessions idle for longer than
+# BOT_SESSION_IDLE_SECONDS are evicted.
+
+from search import TranspositionTable
+from bot_cache import normalize_fen
+from metrics import Gauge
+import chess
+import os
+import threading
+import time
+import uuid
+import weakref
+from collections import OrderedDict
+
+
+BOT_SESSION_IDLE_SECONDS = float(os.environ.get("BOT_SESSION_IDLE_SECONDS", 30 * 60))
+BOT_SESSION_MAX = int(os.environ.get("BOT_SESSION_MAX", 1000))
+
+
+class BotSession:
+    """
+    One human vs. bot game held in memory. Lock must be held while using it.
+    """
+    def __init__(self, session_id, bot_player_id, model_hash, bot_player, board):
+        self.session_id = session_id
+        self.bot_player_id = str(bot_player_id)
+        self.model_hash = model_hash
+        self.bot_player = bot_player # Player with loaded model (None until first needed)
+        self.board = board # chess.Board including move history
+        self.table = TranspositionTable()
+        self.last_used = time.monotonic()
+        self.lock = threading.Lock()
+        # pondering state (see ponder.py), generation changes on every human move
+        self.ponder_generation = 0
+        self.ponder_table = None
+        self.ponder_lock = threading.Lock()
+
+
+    def sync_board(self, fen):
+        """
+        Brings session board up to date with the client's fen.
+        Pushes the human's move if fen is one move on from the session board,
+        otherwise restarts the board from fen (transposition table is kept).
+        Returns -> chess.Board (session board)
+        """
+        client_board = chess.Board(fen)
+        client_key = normalize_fen(client_board)
+
+        if normalize_fen(self.board) != client_key:
+            for move in self.board.legal_moves:
+                self.board.push(move)
+                if normalize_fen(self.board) == client_key:
+                    break
+                self.board.pop()
+            else: # not one move on (e.g. takeback or a different game)
+                self.board = client_board
+
+        # keep the client's move clocks
+        self.board.halfmove_clock = client_board.halfmove_clock
+        self.board.fullmove_number = client_board.fullmove_number
+
+        return self.board
+
+
+class SessionStore:
+    """
+    Thread safe store of bot sessions with idle eviction.
+    Sessions of the same bot model share one loaded model.
+    """
+    def __init__(self, idle_seconds=BOT_SESSION_IDLE_SECONDS, max_sessions=BOT_SESSION_MAX):
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.sessions = OrderedDict() # session_id -> BotSession (least recently used first)
+        self.bot_players = weakref.WeakValueDictionary() # model_hash -> Player while any session uses it
+        self.lock = threading.Lock()
+
+
+    def get(self, session_id, bot_player_id):
+        """
+        Returns live session for given -> session_id & bot_player_id or None
+        """
+        with self.lock:
+            self.evict_idle()
+            session = self.sessions.get(session_id)
+            if session == None or session.bot_player_id != str(bot_player_id):
+                return None
+            session.last_used = time.monotonic()
+            self.sessions.move_to_end(session_id)
+            return session
+
+
+    def get_bot_player(self, model_hash):
+        """
+        Returns already loaded bot Player for given -> model_hash or None
+        """
+        with self.lock:
+            return self.bot_players.get(model_hash)
+
+
+    def create(self, bot_player_id, model_hash, bot_player, fen):
+        """
+        Creates and stores a new session starting from given -> fen
+        Returns -> BotSession
+        """
+        session = BotSession(uuid.uuid4().hex, bot_player_id, model_hash, bot_player, chess.Board(fen))
+
+        with self.lock:
+            self.evict_idle()
+            while len(self.sessions) >= self.max_sessions:
+                self.sessions.popitem(last=False)
+            self.sessions[session.session_id] = session
+
+        return session
+
+
+    def share_bot_player(self, model_hash, bot_player):
+        """
+        Makes a loaded bot Player available to other sessions of given -> model_hash
+        """
+        with self.lock:
+            self.bot_players[model_hash] = bot_player
+
+
+    def evict_idle(self):
+        """
+        Removes sessions idle for longer than idle_seconds (lock must be held)
+        """
+        now = time.monotonic()
+        while len(self.sessions) > 0:
+            session_id, session = next(iter(self.sessions.items()))
+            if now - session.last_used < self.idle_seconds:
+                break
+            del self.sessions[session_id]
+
+
+    def __len__(self):
+        with self.lock:
+            return len(self.sessions)
+
+
+# one store shared by every bot move request in this process
+bot_sessions = SessionStore()
+
+BOT_SESSIONS_LIVE = Gauge("chess_bot_sessions", "Live human vs. bot sessions.", function=lambda: len(bot_sessions))
@@ -3,8 +3,28 @@
 import sqlalchemy
 import pymysql.cursors
 import re
+import json
+from datetime import datetime, timedelta
+from metrics import timed, DB_QUERY_SECONDS
 
 
+# Columns of each table in table order (selected explicitly, never SELECT *)
+TABLE_COLUMNS = {
+    "players": ("player_id", "name", "elo_score", "model_url", "status_flag", "email", "password"),
+    "matches": ("match_id", "player_1_id", "player_1_score", "player_2_id", "player_2_score", "pgn", "batch_id", "date", "time", "winner_id", "status_flag"),
+}
+
+# Primary key of each table (used as the keyset for paginated reads)
+TABLE_ID_COLUMNS = {
+    "players": "player_id",
+    "matches": "match_id",
+}
+
+# Number of rows fetched per page when streaming a table
+DB_PAGE_SIZE = 500
+
+
+@timed(DB_QUERY_SECONDS, function="db_update_player_model")
 def db_update_player_model(conn, player_id, model):
     """
     Updates player data in db according to given -> db connection & player id
@@ -31,6 +51,7 @@ def db_update_player_model(conn, player_id, model):
         return db_upload_message
 
 
+@timed(DB_QUERY_SECONDS, function="db_update_player_data")
 def db_update_player_data(conn, player):
     """
     Updates player data in db according to given -> db connection & player object
@@ -55,6 +76,57 @@ def db_update_player_data(conn, player):
 
 
 
+@timed(DB_QUERY_SECONDS, function="db_update_player_elo")
+def db_update_player_elo(conn, player_id, elo_score):
+    """
+    Updates player's elo_score in players and leaderboard tables given -> player_id & elo_score
+    Called by Chess Game Master after recalculating ratings from match history
+
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    try:
+        conn.execute(
+            sqlalchemy.text("UPDATE players SET elo_score = :elo_score WHERE player_id = :player_id;"),
+            {"elo_score": elo_score, "player_id": player_id}
+        )
+        conn.execute(
+            sqlalchemy.text("UPDATE leaderboard SET elo_score = :elo_score WHERE player_id = :player_id;"),
+            {"elo_score": elo_score, "player_id": player_id}
+        )
+
+        return db_upload_message
+    except Exception as e:
+        #print(e)
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_update_player_status")
+def db_update_player_status(conn, player_id, status_flag):
+    """
+    Updates player's status_flag given -> player_id & status_flag
+    Called by sharded batch workers after loading the player's model
+
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    try:
+        conn.execute(
+            sqlalchemy.text("UPDATE players SET status_flag = :status_flag WHERE player_id = :player_id;"),
+            {"status_flag": status_flag, "player_id": player_id}
+        )
+
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
 # def db_insert_new_ongoing_match(conn, fen, bot_player_id):
 #     """
 #     Inserts new ongoing match in db according to given -> db connection, fen &  bot_player_id
@@ -99,6 +171,7 @@ def db_update_player_data(conn, player):
 
 
 
+@timed(DB_QUERY_SECONDS, function="db_get_player_model")
 def db_get_player_model(conn, player_id):
     """
     Retrieves binary model (.h5 file) from db or None if not found given -> player_id
@@ -119,6 +192,82 @@ def db_get_player_model(conn, player_id):
 
 
 
+@timed(DB_QUERY_SECONDS, function="db_get_player_model_hash")
+def db_get_player_model_hash(conn, player_id):
+    """
+    Retrieves model hash (sha256 hex of model blob) given -> player_id
+    Reads only the stored hash column, never the model blob
+    Returns -> db_check_message, model_hash | db_check_message, None
+    """
+    db_check_message = "OK"
+
+    db_query = conn.execute(
+        sqlalchemy.text("SELECT model_hash FROM players WHERE player_id = :player_id;"),
+        {"player_id": player_id}
+    ).fetchone()
+
+    if db_query == None or db_query[0] == None: # no player or no model
+        db_check_message = "No model found"
+        return db_check_message, None
+
+    return db_check_message, db_query[0]
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_iter_player_model_chunks")
+def db_iter_player_model_chunks(conn, player_id, chunk_size):
+    """
+    Lazily yields binary model (.h5 file) from db in chunks of chunk_size bytes given -> player_id
+    Only one chunk of the blob is held in memory at a time
+    Returns generator -> bytes, ...
+    """
+    query = sqlalchemy.text(
+        "SELECT SUBSTRING(model, :start, :chunk_size) FROM players WHERE player_id = :player_id;"
+    )
+
+    start = 1 # SUBSTRING is 1-indexed
+    while True:
+        db_query = conn.execute(query, {"start": start, "chunk_size": chunk_size, "player_id": player_id}).fetchone()
+
+        if db_query == None or not db_query[0]: # no model or past end of blob
+            break
+
+        chunk = bytes(db_query[0])
+        yield chunk
+
+        if len(chunk) < chunk_size: # last chunk
+            break
+        start += chunk_size
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_update_series_games")
+def db_update_series_games(conn, batch_id, player_1_id, player_2_id, series_games):
+    """
+    Records how many games the series between given -> players (either colour) took in batch_id
+    on each of its matches
+
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    try:
+        conn.execute(
+            sqlalchemy.text(
+                "UPDATE matches SET series_games = :series_games WHERE batch_id = :batch_id AND "
+                "((player_1_id = :player_1_id AND player_2_id = :player_2_id) OR (player_1_id = :player_2_id AND player_2_id = :player_1_id));"
+            ),
+            {"series_games": series_games, "batch_id": batch_id, "player_1_id": player_1_id, "player_2_id": player_2_id}
+        )
+
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_insert_new_match")
 def db_insert_new_match(conn, match):
     """
     Inserts new match data in db according to given -> db connection &  match object
@@ -137,6 +286,8 @@ def db_insert_new_match(conn, match):
     # match.player_1_score (IF match.status_flag > 0)
     # match.player_2_score (IF match.status_flag > 0)
     # match.player_2_score (IF match.status_flag > 0)
+    # match.num_moves (IF match.status_flag > 0)
+    # match.series_game (IF match.status_flag > 0)
 
     Returns -> db_upload_message
     """
@@ -146,9 +297,9 @@ def db_insert_new_match(conn, match):
         if match.status_flag < 0: # no game played
             conn.execute(f"INSERT INTO matches (player_1_id, player_2_id, batch_id, date, time, status_flag) VALUES ({match.player_1_id}, {match.player_2_id}, {match.batch_id}, '{match.date}', '{match.time}', {match.status_flag});")
         elif match.status_flag == 2: # tied and no winner found
-            conn.execute(f"INSERT INTO matches (player_1_id, player_1_score, player_2_id, player_2_score, pgn, batch_id, date, time, status_flag) VALUES ({match.player_1_id}, {match.player_1_score}, {match.player_2_id}, {match.player_2_score}, '{match.pgn}', {match.batch_id}, '{match.date}', '{match.time}', {match.status_flag});")
+            conn.execute(f"INSERT INTO matches (player_1_id, player_1_score, player_2_id, player_2_score, pgn, batch_id, date, time, status_flag, num_moves, series_game) VALUES ({match.player_1_id}, {match.player_1_score}, {match.player_2_id}, {match.player_2_score}, '{match.pgn}', {match.batch_id}, '{match.date}', '{match.time}', {match.status_flag}, {match.num_moves if match.num_moves != None else 'NULL'}, {match.series_game if match.series_game != None else 'NULL'});")
         else:
-            conn.execute(f"INSERT INTO matches (player_1_id, player_1_score, player_2_id, player_2_score, pgn, batch_id, date, time, winner_id, status_flag) VALUES ({match.player_1_id}, {match.player_1_score}, {match.player_2_id}, {match.player_2_score}, '{match.pgn}', {match.batch_id}, '{match.date}', '{match.time}', {match.winner_id}, {match.status_flag});")
+            conn.execute(f"INSERT INTO matches (player_1_id, player_1_score, player_2_id, player_2_score, pgn, batch_id, date, time, winner_id, status_flag, num_moves, series_game) VALUES ({match.player_1_id}, {match.player_1_score}, {match.player_2_id}, {match.player_2_score}, '{match.pgn}', {match.batch_id}, '{match.date}', '{match.time}', {match.winner_id}, {match.status_flag}, {match.num_moves if match.num_moves != None else 'NULL'}, {match.series_game if match.series_game != None else 'NULL'});")
         #conn.execute(f"UPDATE matches SET player_1_id = {match.player_1_id}, player_1_score = {match.player_1_score}, player_2_id = {match.player_2_id}, player_2_score = {match.player_2_score}, pgn = '{match.pgn}', batch_id = '{match.batch_id}', date = '{match.date}', time = '{match.time}', winner_id = {match.winner_id}, status_flag = {match.status_flag} ;")
 
         return db_upload_message
@@ -159,21 +310,476 @@ def db_insert_new_match(conn, match):
 
 
 
-def db_latest_batch_id(conn):
+@timed(DB_QUERY_SECONDS, function="db_peek_next_batch_id")
+def db_peek_next_batch_id(conn):
     """
-    Retrieves latest batch_id from db or None if no batches found
-    Returns -> batch_id | None
+    Retrieves batch_id the next new batch would get from the batches table (without reserving it)
+    Returns -> batch_id
     """
     db_query = conn.execute(
-        f"SELECT MAX(batch_id) FROM matches;"
-    ).fetchall()
+        "SELECT MAX(batch_id) FROM batches;"
+    ).fetchone()
+
+    return (db_query[0] or 0) + 1 # 1 if no batches found
 
-    batch_id = db_query[0][0] # None if no batches found
+
+
+@timed(DB_QUERY_SECONDS, function="db_new_batch_id")
+def db_new_batch_id(conn, schedule=None):
+    """
+    Atomically reserves a new running batch_id in the batches table
+    Stores given -> schedule [(player_1_id, player_2_id),...] as the batch's checkpoint
+    Returns -> batch_id
+    """
+    batch_id = conn.execute(
+        sqlalchemy.text(
+            "INSERT INTO batches (status, schedule, heartbeat_at) VALUES ('running', :schedule, :now);"
+        ),
+        {"schedule": json.dumps(schedule) if schedule != None else None, "now": datetime.utcnow()}
+    ).lastrowid
 
     return batch_id
 
 
 
+@timed(DB_QUERY_SECONDS, function="db_get_running_batch")
+def db_get_running_batch(conn):
+    """
+    Retrieves latest batch that was started but never finalised or None if none found
+    Returns -> (batch_id, schedule [(player_1_id, player_2_id),...], heartbeat_at) | None
+    """
+    db_query = conn.execute(
+        "SELECT batch_id, schedule, heartbeat_at FROM batches "
+        "WHERE status = 'running' ORDER BY batch_id DESC LIMIT 1;"
+    ).fetchone()
+
+    if db_query == None:
+        return None
+
+    batch_id, schedule, heartbeat_at = db_query
+    if schedule != None:
+        schedule = [tuple(pairing) for pairing in json.loads(schedule)]
+
+    return batch_id, schedule, heartbeat_at
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_touch_batch")
+def db_touch_batch(conn, batch_id):
+    """
+    Updates running batch's heartbeat (shows the batch is still being played)
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    try:
+        conn.execute(
+            sqlalchemy.text("UPDATE batches SET heartbeat_at = :now WHERE batch_id = :batch_id;"),
+            {"now": datetime.utcnow(), "batch_id": batch_id}
+        )
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_complete_batch")
+def db_complete_batch(conn, batch_id):
+    """
+    Marks batch as finalised so it is never resumed
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    try:
+        conn.execute(
+            sqlalchemy.text("UPDATE batches SET status = 'complete', heartbeat_at = :now WHERE batch_id = :batch_id;"),
+            {"now": datetime.utcnow(), "batch_id": batch_id}
+        )
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_retrieve_batch_matches")
+def db_retrieve_batch_matches(conn, batch_id):
+    """
+    Retrieves results of matches already recorded for given -> batch_id
+    Returns -> [{player_1_id:x, player_2_id:x, winner_id:x, status_flag:x, series_game:x, series_games:x},...]
+    """
+    columns = ("player_1_id", "player_2_id", "winner_id", "status_flag", "series_game", "series_games")
+
+    db_matches = conn.execute(
+        sqlalchemy.text(
+            "SELECT player_1_id, player_2_id, winner_id, status_flag, series_game, series_games FROM matches "
+            "WHERE batch_id = :batch_id ORDER BY match_id;"
+        ),
+        {"batch_id": batch_id}
+    ).fetchall()
+
+    batch_matches = [dict(zip(columns, entry)) for entry in db_matches]
+
+    return batch_matches
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_create_batch_shards")
+def db_create_batch_shards(conn, batch_id, shards):
+    """
+    Queues given -> shards [[(player_1_id, player_2_id),...],...] of batch_id to be claimed by workers
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    query = sqlalchemy.text(
+        "INSERT INTO batch_shards (batch_id, shard_id, pairings, status, attempts) "
+        "VALUES (:batch_id, :shard_id, :pairings, 'pending', 0);"
+    )
+
+    try:
+        for shard_id, pairings in enumerate(shards):
+            conn.execute(query, {"batch_id": batch_id, "shard_id": shard_id, "pairings": json.dumps(pairings)})
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_count_batch_shards")
+def db_count_batch_shards(conn, batch_id):
+    """
+    Counts shards of given -> batch_id by status
+    Returns -> {status: count} ({} if batch is not sharded)
+    """
+    db_query = conn.execute(
+        sqlalchemy.text("SELECT status, COUNT(*) FROM batch_shards WHERE batch_id = :batch_id GROUP BY status;"),
+        {"batch_id": batch_id}
+    ).fetchall()
+
+    return {status: count for status, count in db_query}
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_claim_batch_shard")
+def db_claim_batch_shard(conn, batch_id, worker_id, stale_seconds):
+    """
+    Claims next shard of batch_id which is pending, or whose worker stopped heartbeating
+    for stale_seconds. Claims are conditional updates on the shard's attempts count so
+    only one worker can win a shard (no row locks held, works on any sql db).
+    Returns -> (shard_id, [(player_1_id, player_2_id),...], attempts) | None if none left
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=stale_seconds)
+
+    claim_query = sqlalchemy.text(
+        "UPDATE batch_shards SET status = 'claimed', worker_id = :worker_id, attempts = attempts + 1, "
+        "claimed_at = :now, heartbeat_at = :now "
+        "WHERE batch_id = :batch_id AND shard_id = :shard_id AND attempts = :attempts "
+        "AND (status = 'pending' OR (status = 'claimed' AND heartbeat_at < :stale_before));"
+    )
+
+    while True:
+        candidates = conn.execute(
+            sqlalchemy.text(
+                "SELECT shard_id, pairings, attempts FROM batch_shards "
+                "WHERE batch_id = :batch_id "
+                "AND (status = 'pending' OR (status = 'claimed' AND heartbeat_at < :stale_before)) "
+                "ORDER BY shard_id LIMIT 8;"
+            ),
+            {"batch_id": batch_id, "stale_before": stale_before}
+        ).fetchall()
+
+        if len(candidates) == 0:
+            return None
+
+        for shard_id, pairings, attempts in candidates:
+            claimed = conn.execute(claim_query, {
+                "worker_id": worker_id,
+                "now": datetime.utcnow(),
+                "batch_id": batch_id,
+                "shard_id": shard_id,
+                "attempts": attempts,
+                "stale_before": stale_before,
+            }).rowcount == 1
+
+            if claimed:
+                return shard_id, [tuple(pairing) for pairing in json.loads(pairings)], attempts + 1
+        # every candidate was claimed by another worker first, look again
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_touch_batch_shard")
+def db_touch_batch_shard(conn, batch_id, shard_id, worker_id):
+    """
+    Updates heartbeat of a shard claimed by given -> worker_id
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    try:
+        conn.execute(
+            sqlalchemy.text(
+                "UPDATE batch_shards SET heartbeat_at = :now "
+                "WHERE batch_id = :batch_id AND shard_id = :shard_id AND worker_id = :worker_id AND status = 'claimed';"
+            ),
+            {"now": datetime.utcnow(), "batch_id": batch_id, "shard_id": shard_id, "worker_id": worker_id}
+        )
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_complete_batch_shard")
+def db_complete_batch_shard(conn, batch_id, shard_id, worker_id):
+    """
+    Marks a shard claimed by given -> worker_id as done
+    Returns -> db_upload_message ("Shard claim lost." if another worker took the shard over)
+    """
+    db_upload_message = "OK"
+
+    try:
+        completed = conn.execute(
+            sqlalchemy.text(
+                "UPDATE batch_shards SET status = 'done', heartbeat_at = :now "
+                "WHERE batch_id = :batch_id AND shard_id = :shard_id AND worker_id = :worker_id AND status = 'claimed';"
+            ),
+            {"now": datetime.utcnow(), "batch_id": batch_id, "shard_id": shard_id, "worker_id": worker_id}
+        ).rowcount == 1
+
+        if not completed:
+            db_upload_message = "Shard claim lost."
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_claim_batch_finalise")
+def db_claim_batch_finalise(conn, batch_id, stale_seconds):
+    """
+    Claims the right to finalise a running batch (or one whose finaliser stopped
+    for stale_seconds), so exactly one worker acts as coordinator
+    Returns -> True if claimed
+    """
+    claimed = conn.execute(
+        sqlalchemy.text(
+            "UPDATE batches SET status = 'finalising', heartbeat_at = :now "
+            "WHERE batch_id = :batch_id "
+            "AND (status = 'running' OR (status = 'finalising' AND heartbeat_at < :stale_before));"
+        ),
+        {"now": datetime.utcnow(), "batch_id": batch_id, "stale_before": datetime.utcnow() - timedelta(seconds=stale_seconds)}
+    ).rowcount == 1
+
+    return claimed
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_release_batch_finalise")
+def db_release_batch_finalise(conn, batch_id):
+    """
+    Hands a batch whose finalising failed back to running so it can be finalised again
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    try:
+        conn.execute(
+            sqlalchemy.text("UPDATE batches SET status = 'running' WHERE batch_id = :batch_id AND status = 'finalising';"),
+            {"batch_id": batch_id}
+        )
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_update_leaderboard")
+def db_update_leaderboard(conn, batch_id, players, matches):
+    """
+    Incrementally updates the leaderboard summary with one batch given -> players & matches of that batch
+    (matches as dicts of player_1_id, player_2_id, winner_id, status_flag)
+    Called by Chess Game Master after the batch's matches are uploaded
+    Costs one upsert per player (never rescans matches)
+
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    # tally this batch's results per player
+    tallies = {player.player_id: [0, 0, 0, 0] for player in players} # games, wins, draws, losses
+    for match in matches:
+        if match["status_flag"] <= 0: # no game played
+            continue
+        for player_id in (match["player_1_id"], match["player_2_id"]):
+            tally = tallies.setdefault(player_id, [0, 0, 0, 0])
+            tally[0] += 1
+            if match["status_flag"] == 2:
+                tally[2] += 1
+            elif match["winner_id"] == player_id:
+                tally[1] += 1
+            else:
+                tally[3] += 1
+
+    elo_scores = {player.player_id: player.elo_score for player in players}
+
+    query = sqlalchemy.text(
+        "INSERT INTO leaderboard (player_id, elo_score, games_played, wins, draws, losses, last_batch_id) "
+        "VALUES (:player_id, :elo_score, :games, :wins, :draws, :losses, :batch_id) "
+        "ON DUPLICATE KEY UPDATE elo_score = VALUES(elo_score), "
+        "games_played = games_played + VALUES(games_played), wins = wins + VALUES(wins), "
+        "draws = draws + VALUES(draws), losses = losses + VALUES(losses), "
+        "last_batch_id = VALUES(last_batch_id);"
+    )
+
+    try:
+        for player_id, (games, wins, draws, losses) in tallies.items():
+            conn.execute(query, {
+                "player_id": player_id,
+                "elo_score": elo_scores.get(player_id) or 0,
+                "games": games,
+                "wins": wins,
+                "draws": draws,
+                "losses": losses,
+                "batch_id": batch_id,
+            })
+
+        return db_upload_message
+    except Exception as e:
+        #print(e)
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_update_model_stats")
+def db_update_model_stats(conn, batch_id, players):
+    """
+    Stores latest model validation (status_flag & latency) of given -> validated players
+    Returns -> db_upload_message
+    """
+    db_upload_message = "OK"
+
+    query = sqlalchemy.text(
+        "INSERT INTO model_stats (player_id, status_flag, latency_seconds, batch_id, measured_at) "
+        "VALUES (:player_id, :status_flag, :latency_seconds, :batch_id, :now) "
+        "ON DUPLICATE KEY UPDATE status_flag = VALUES(status_flag), latency_seconds = VALUES(latency_seconds), "
+        "batch_id = VALUES(batch_id), measured_at = VALUES(measured_at);"
+    )
+
+    try:
+        for player in players:
+            conn.execute(query, {
+                "player_id": player.player_id,
+                "status_flag": player.status_flag,
+                "latency_seconds": player.latency,
+                "batch_id": batch_id,
+                "now": datetime.utcnow(),
+            })
+        return db_upload_message
+    except Exception as e:
+        db_upload_message = str(e)
+        return db_upload_message
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_retrieve_model_latencies")
+def db_retrieve_model_latencies(conn):
+    """
+    Retrieves latest measured model latency of every validated player
+    Returns -> {player_id: latency_seconds}
+    """
+    db_query = conn.execute(
+        "SELECT player_id, latency_seconds FROM model_stats WHERE latency_seconds IS NOT NULL;"
+    ).fetchall()
+
+    return {player_id: latency_seconds for player_id, latency_seconds in db_query}
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_retrieve_player_game_lengths")
+def db_retrieve_player_game_lengths(conn, min_batch_id):
+    """
+    Retrieves average plies of each player's games played since given -> min_batch_id
+    Returns -> {player_id: average plies}
+    """
+    db_query = conn.execute(
+        sqlalchemy.text(
+            "SELECT player_id, AVG(num_moves) FROM ("
+            "SELECT player_1_id AS player_id, num_moves FROM matches WHERE batch_id >= :min_batch_id AND num_moves IS NOT NULL "
+            "UNION ALL "
+            "SELECT player_2_id AS player_id, num_moves FROM matches WHERE batch_id >= :min_batch_id AND num_moves IS NOT NULL"
+            ") AS games GROUP BY player_id;"
+        ),
+        {"min_batch_id": min_batch_id}
+    ).fetchall()
+
+    return {player_id: float(plies) for player_id, plies in db_query}
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_retrieve_pgn_bytes_per_ply")
+def db_retrieve_pgn_bytes_per_ply(conn, min_batch_id):
+    """
+    Retrieves average pgn bytes per ply of games played since given -> min_batch_id
+    Returns -> bytes per ply | None if no games found
+    """
+    db_query = conn.execute(
+        sqlalchemy.text(
+            "SELECT SUM(LENGTH(pgn)), SUM(num_moves) FROM matches "
+            "WHERE batch_id >= :min_batch_id AND num_moves > 0 AND pgn IS NOT NULL;"
+        ),
+        {"min_batch_id": min_batch_id}
+    ).fetchone()
+
+    if db_query == None or db_query[0] == None or not db_query[1]:
+        return None
+    return float(db_query[0]) / float(db_query[1])
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_retrieve_model_sizes")
+def db_retrieve_model_sizes(conn):
+    """
+    Retrieves size in bytes of every stored player model (blobs are measured in the db, not pulled)
+    Returns -> {player_id: model_bytes}
+    """
+    db_query = conn.execute(
+        "SELECT player_id, LENGTH(model) FROM players WHERE model IS NOT NULL;"
+    ).fetchall()
+
+    return {player_id: int(model_bytes) for player_id, model_bytes in db_query}
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_retrieve_leaderboard")
+def db_retrieve_leaderboard(conn):
+    """
+    Calls db and returns leaderboard ordered by elo_score (highest first)
+    Reads the per player summary table so cost is O(players) not O(matches)
+    Returns -> [{player_id:x, name:x, elo_score:x, games_played:x, wins:x, draws:x, losses:x, last_batch_id:x},...]
+    """
+    columns = ("player_id", "name", "elo_score", "games_played", "wins", "draws", "losses", "last_batch_id")
+
+    db_leaderboard = conn.execute(
+        "SELECT l.player_id, p.name, l.elo_score, l.games_played, l.wins, l.draws, l.losses, l.last_batch_id "
+        "FROM leaderboard l JOIN players p ON p.player_id = l.player_id "
+        "ORDER BY l.elo_score DESC, l.player_id;"
+    ).fetchall()
+
+    leaderboard = [dict(zip(columns, entry)) for entry in db_leaderboard]
+
+    return leaderboard
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_insert_new_player")
 def db_insert_new_player(conn, table_name, name, password, email):
     """
     Inserts given player details into database and returns new player_id
@@ -202,6 +808,7 @@ def db_insert_new_player(conn, table_name, name, password, email):
 
 
 
+@timed(DB_QUERY_SECONDS, function="db_confirm_player_credentials")
 def db_confirm_player_credentials(conn, table_name, name, password):
     """
     Checks given player credentials are in database and returns player_id
@@ -223,6 +830,7 @@ def db_confirm_player_credentials(conn, table_name, name, password):
 
 
 
+@timed(DB_QUERY_SECONDS, function="db_retrieve_entry_data")
 def db_retrieve_entry_data(conn, table_name, id_name, id_value):
     """
     Calls db and returns table entry from given -> table where given -> var_name = var_value
@@ -244,40 +852,71 @@ def db_retrieve_table_list(conn, table_name):
     Calls db and returns table data stored as list of dictionaries from given -> table_name
     Returns -> [{...entry data key value pairs...},...]
     """
-    table_list = []
+    table_list = list(db_iter_table_list(conn, table_name))
 
-    db_table = db_retrieve_table_data(conn, table_name)
+    return table_list
 
-    for entry in db_table:
-        if table_name == "players":
-            player_dict = {}
-            player_dict["player_id"] = entry[0]
-            player_dict["name"] = entry[1]
-            player_dict["elo_score"] = entry[2]
-            player_dict["model_url"] = entry[3]
-            player_dict["status_flag"] = entry[4]
-            player_dict["email"] = entry[5]
-            player_dict["password"] = entry[6]
-
-            table_list.append(player_dict)
-
-        elif table_name == "matches":
-            match_dict = {}
-            match_dict["match_id"] = entry[0]
-            match_dict["player_1_id"] = entry[1]
-            match_dict["player_1_score"] = entry[2]
-            match_dict["player_2_id"] = entry[3]
-            match_dict["player_2_score"] = entry[4]
-            match_dict["pgn"] = entry[5]
-            match_dict["batch_id"] = entry[6]
-            match_dict["date"] = entry[7]
-            match_dict["time"] = entry[8]
-            match_dict["winner_id"] = entry[9]
-            match_dict["status_flag"] = entry[10]
-
-            table_list.append(match_dict)
 
-    return table_list
+
+def db_iter_table_list(conn, table_name, columns=None, page_size=DB_PAGE_SIZE):
+    """
+    Lazily yields table entries as dictionaries from given -> table_name
+    Only the given -> columns are selected (all known table columns if None)
+    Returns generator -> {...column value pairs...}, ...
+    """
+    if columns == None:
+        columns = TABLE_COLUMNS[table_name]
+
+    for entry in db_iter_table_rows(conn, table_name, columns, page_size):
+        yield dict(zip(columns, entry))
+
+
+
+@timed(DB_QUERY_SECONDS, function="db_iter_table_rows")
+def db_iter_table_rows(conn, table_name, columns=None, page_size=DB_PAGE_SIZE):
+    """
+    Lazily yields table entries as tuples from given -> table_name & columns
+    Reads one page of page_size rows at a time using keyset pagination on the
+    table's id column, so memory use is constant regardless of table size and
+    the connection stays free for other queries between pages.
+    Returns generator -> (...column values...), ...
+    """
+    if columns == None:
+        columns = TABLE_COLUMNS[table_name]
+    columns = tuple(columns)
+
+    # only known table and column names are ever interpolated into the query
+    id_name = TABLE_ID_COLUMNS[table_name]
+    for column in columns:
+        if column not in TABLE_COLUMNS[table_name]:
+            raise ValueError(f"Unknown column {column} for table {table_name}.")
+
+    # id column is always selected (first) so the next page can be found
+    id_added = id_name not in columns
+    if id_added:
+        select_columns = (id_name,) + columns
+    else:
+        select_columns = columns
+    id_index = select_columns.index(id_name)
+
+    query = sqlalchemy.text(
+        f"SELECT {', '.join(select_columns)} FROM {table_name} "
+        f"WHERE {id_name} > :last_id ORDER BY {id_name} LIMIT :page_size;"
+    )
+
+    last_id = -1
+    while True:
+        db_page = conn.execute(query, {"last_id": last_id, "page_size": page_size}).fetchall()
+
+        for entry in db_page:
+            if id_added:
+                yield tuple(entry[1:])
+            else:
+                yield tuple(entry)
+
+        if len(db_page) < page_size: # last page
+            break
+        last_id = db_page[-1][id_index]
 
 
 
@@ -305,9 +944,7 @@ def db_retrieve_table_data(conn, table_name):
     Calls db and returns table data stored as tuples from given -> table_name
     Returns tuples -> ((id, ...entry data...),...)
     """
-    db_table = conn.execute(
-        f"SELECT * FROM {table_name};"
-    ).fetchall()
+    db_table = tuple(db_iter_table_rows(conn, table_name))
 
     return db_table
 
@@ -0,0 +1,250 @@
+# Functions to support migrating (creating and upgrading) the database schema.
+#
+# Each migration is applied once, in order, and recorded by version number in
+# the schema_migrations table. New migrations are only ever appended to
+# MIGRATIONS, never edited once deployed.
+# Mysql commits each DDL statement on its own, so a migration interrupted
+# partway leaves some of its statements applied. Every statement therefore
+# checks whether its index, table, column or seed rows already exist, and
+# instances migrate one at a time (MIGRATION_LOCK, a mysql named lock), so a
+# failed or concurrent migration is simply completed by the next run.
+
+import sqlalchemy
+import threading
+
+
+MIGRATION_LOCK = "chess_schema_migrations" # mysql GET_LOCK name
+MIGRATION_LOCK_SECONDS = 120 # wait for another instance's migrations this long
+
+
+def table_exists(conn, table_name):
+    return conn.execute(
+        sqlalchemy.text("SELECT COUNT(*) FROM information_schema.TABLES WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name;"),
+        {"table_name": table_name}
+    ).fetchone()[0] > 0
+
+
+def column_exists(conn, table_name, column_name):
+    return conn.execute(
+        sqlalchemy.text("SELECT COUNT(*) FROM information_schema.COLUMNS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND COLUMN_NAME = :column_name;"),
+        {"table_name": table_name, "column_name": column_name}
+    ).fetchone()[0] > 0
+
+
+def index_exists(conn, table_name, index_name):
+    return conn.execute(
+        sqlalchemy.text("SELECT COUNT(*) FROM information_schema.STATISTICS WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table_name AND INDEX_NAME = :index_name;"),
+        {"table_name": table_name, "index_name": index_name}
+    ).fetchone()[0] > 0
+
+
+def create_index(conn, table_name, index_name, columns):
+    if not index_exists(conn, table_name, index_name):
+        conn.execute(f"CREATE INDEX {index_name} ON {table_name} ({columns});")
+
+
+def add_column(conn, table_name, column_name, definition):
+    if not column_exists(conn, table_name, column_name):
+        conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column_name} {definition};")
+
+
+def migration_matches_indexes(conn):
+    """
+    Indexes matches on batch and players so per batch / per player reads
+    no longer scan the whole table
+    """
+    create_index(conn, "matches", "idx_matches_batch_id", "batch_id")
+    create_index(conn, "matches", "idx_matches_player_1_id", "player_1_id")
+    create_index(conn, "matches", "idx_matches_player_2_id", "player_2_id")
+
+
+def migration_batches_table(conn):
+    """
+    Creates batches table which hands out batch ids atomically (auto increment)
+    Seeded with the latest batch_id already used in matches
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS batches ("
+        "batch_id INT NOT NULL AUTO_INCREMENT PRIMARY KEY, "
+        "created_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP"
+        ");"
+    )
+    if conn.execute("SELECT COUNT(*) FROM batches;").fetchone()[0] == 0: # not seeded yet
+        conn.execute(
+            "INSERT INTO batches (batch_id) "
+            "SELECT MAX(batch_id) FROM matches HAVING MAX(batch_id) IS NOT NULL;"
+        )
+
+
+def migration_leaderboard_table(conn):
+    """
+    Creates leaderboard table holding a per player summary of all matches
+    Seeded once from matches, then updated incrementally after each batch
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS leaderboard ("
+        "player_id INT NOT NULL PRIMARY KEY, "
+        "elo_score INT NOT NULL DEFAULT 0, "
+        "games_played INT NOT NULL DEFAULT 0, "
+        "wins INT NOT NULL DEFAULT 0, "
+        "draws INT NOT NULL DEFAULT 0, "
+        "losses INT NOT NULL DEFAULT 0, "
+        "last_batch_id INT NULL"
+        ");"
+    )
+    if conn.execute("SELECT COUNT(*) FROM leaderboard;").fetchone()[0] > 0:
+        return # already seeded
+    conn.execute(
+        "INSERT INTO leaderboard (player_id, elo_score, games_played, wins, draws, losses, last_batch_id) "
+        "SELECT p.player_id, COALESCE(p.elo_score, 0), COUNT(m.match_id), "
+        "COALESCE(SUM(CASE WHEN m.status_flag = 1 AND m.winner_id = p.player_id THEN 1 ELSE 0 END), 0), "
+        "COALESCE(SUM(CASE WHEN m.status_flag = 2 THEN 1 ELSE 0 END), 0), "
+        "COALESCE(SUM(CASE WHEN m.status_flag = 1 AND m.winner_id <> p.player_id THEN 1 ELSE 0 END), 0), "
+        "MAX(m.batch_id) "
+        "FROM players p LEFT JOIN matches m "
+        "ON (m.player_1_id = p.player_id OR m.player_2_id = p.player_id) AND m.status_flag > 0 "
+        "GROUP BY p.player_id, p.elo_score;"
+    )
+
+
+def migration_players_model_hash(conn):
+    """
+    Adds model_hash column to players, generated by the db from the model blob
+    so it is always current however the model is uploaded
+    """
+    add_column(conn, "players", "model_hash", "CHAR(64) GENERATED ALWAYS AS (SHA2(model, 256)) STORED")
+
+
+def migration_batches_checkpoint(conn):
+    """
+    Adds checkpoint columns to batches so an interrupted batch can be resumed:
+    status ('running' until finalised), the batch's schedule and a heartbeat
+    """
+    add_column(conn, "batches", "status", "VARCHAR(16) NOT NULL DEFAULT 'complete'")
+    add_column(conn, "batches", "schedule", "MEDIUMTEXT NULL")
+    add_column(conn, "batches", "heartbeat_at", "DATETIME NULL")
+
+
+def migration_batch_shards_table(conn):
+    """
+    Creates batch_shards table, the work queue of a sharded batch: each shard is a
+    slice of the batch's schedule claimed and played by one game master instance
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS batch_shards ("
+        "batch_id INT NOT NULL, "
+        "shard_id INT NOT NULL, "
+        "pairings MEDIUMTEXT NOT NULL, "
+        "status VARCHAR(16) NOT NULL DEFAULT 'pending', "
+        "worker_id VARCHAR(128) NULL, "
+        "attempts INT NOT NULL DEFAULT 0, "
+        "claimed_at DATETIME NULL, "
+        "heartbeat_at DATETIME NULL, "
+        "PRIMARY KEY (batch_id, shard_id)"
+        ");"
+    )
+
+
+def migration_model_stats_table(conn):
+    """
+    Creates model_stats table holding each player's latest model validation:
+    status and median single position evaluation latency (used for scheduling)
+    """
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS model_stats ("
+        "player_id INT NOT NULL PRIMARY KEY, "
+        "status_flag INT NOT NULL, "
+        "latency_seconds DOUBLE NULL, "
+        "batch_id INT NULL, "
+        "measured_at DATETIME NOT NULL"
+        ");"
+    )
+
+
+def migration_matches_num_moves(conn):
+    """
+    Adds num_moves (plies played) to matches so game length can be used for scheduling
+    """
+    add_column(conn, "matches", "num_moves", "INT NULL")
+
+
+def migration_matches_series(conn):
+    """
+    Adds series_game (game's number in its pairing's series) and series_games (games the series took)
+    to matches for batches playing match series
+    """
+    add_column(conn, "matches", "series_game", "INT NULL")
+    add_column(conn, "matches", "series_games", "INT NULL")
+
+
+# (version, migration) in the order they must be applied
+MIGRATIONS = (
+    (1, migration_matches_indexes),
+    (2, migration_batches_table),
+    (3, migration_leaderboard_table),
+    (4, migration_players_model_hash),
+    (5, migration_batches_checkpoint),
+    (6, migration_batch_shards_table),
+    (7, migration_model_stats_table),
+    (8, migration_matches_num_moves),
+    (9, migration_matches_series),
+)
+
+
+# set once this process has brought the schema up to date
+migrations_lock = threading.Lock()
+migrations_applied = False
+
+
+def run_migrations(conn):
+    """
+    Applies any migrations not yet recorded in schema_migrations given -> db connection
+    Holds MIGRATION_LOCK in the db while migrating, only checks the db once per process
+    Returns -> migrate_message
+    """
+    global migrations_applied
+
+    migrate_message = "OK"
+
+    with migrations_lock:
+        if migrations_applied:
+            return migrate_message
+
+        locked = False
+        try:
+            locked = conn.execute(
+                sqlalchemy.text("SELECT GET_LOCK(:name, :timeout);"),
+                {"name": MIGRATION_LOCK, "timeout": MIGRATION_LOCK_SECONDS}
+            ).fetchone()[0] == 1
+            if not locked:
+                raise Exception("Timed out waiting for another instance's schema migrations.")
+
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS schema_migrations ("
+                "version INT NOT NULL PRIMARY KEY"
+                ");"
+            )
+            db_versions = conn.execute("SELECT version FROM schema_migrations;").fetchall()
+            applied_versions = {entry[0] for entry in db_versions}
+
+            for version, migration in MIGRATIONS:
+                if version in applied_versions:
+                    continue
+                print(f"Applying schema migration {version}: {migration.__name__}")
+                migration(conn)
+                conn.execute(
+                    sqlalchemy.text("INSERT IGNORE INTO schema_migrations (version) VALUES (:version);"),
+                    {"version": version}
+                )
+
+            migrations_applied = True
+
+        except Exception as e:
+            print("Error migrating db:", str(e))
+            migrate_message = str(e)
+
+        finally:
+            if locked:
+                conn.execute(sqlalchemy.text("SELECT RELEASE_LOCK(:name);"), {"name": MIGRATION_LOCK})
+
+    return migrate_message
@@ -0,0 +1,265 @@
+# Functions and classes to support evaluating dense-input models without tensorflow.
+#
+# Many models flatten the 14x8x8 board tensor straight into a Dense layer. The
+# board tensor is sparse and a move only changes a few of its piece squares, so
+# (like NNUE) the first layer's output for the 12 piece planes is kept in an
+# accumulator updated per move: subtract the kernel rows of squares a piece
+# left, add the rows of squares it arrived on. Only the 2 attack planes (which
+# change all over the board) are multiplied in at each leaf, and the remaining
+# layers run in NumPy.
+# An evaluator is only used for a model if it matches model.predict on the
+# validation positions (and moves from them) within DENSE_EVAL_TOLERANCE,
+# otherwise the model is evaluated by tensorflow as before.
+
+import numpy
+import os
+from search import split_dims, piece_plane, EncodedBoard
+
+
+# "0" evaluates every model with tensorflow
+DENSE_EVALUATOR = os.environ.get("DENSE_EVALUATOR", "1") == "1"
+DENSE_EVAL_TOLERANCE = float(os.environ.get("DENSE_EVAL_TOLERANCE", 1e-4)) # relative and absolute
+
+BOARD_SHAPE = (14, 8, 8)
+PIECE_FEATURES = 12 * 64 # features of the piece planes, the attack planes follow
+
+
+def sigmoid(x):
+    return 1 / (1 + numpy.exp(-x))
+
+
+def elu(x):
+    return numpy.where(x > 0, x, numpy.expm1(numpy.minimum(x, 0)))
+
+
+def softmax(x):
+    e = numpy.exp(x - numpy.max(x, axis=-1, keepdims=True))
+    return e / numpy.sum(e, axis=-1, keepdims=True)
+
+
+# keras activation name -> numpy function
+ACTIVATIONS = {
+    "linear": lambda x: x,
+    "relu": lambda x: numpy.maximum(x, 0),
+    "sigmoid": sigmoid,
+    "tanh": numpy.tanh,
+    "elu": elu,
+    "selu": lambda x: 1.0507009873554805 * numpy.where(x > 0, x, 1.6732632423543772 * numpy.expm1(numpy.minimum(x, 0))),
+    "softplus": lambda x: numpy.logaddexp(0, x),
+    "softsign": lambda x: x / (1 + numpy.abs(x)),
+    "swish": lambda x: x * sigmoid(x),
+    "silu": lambda x: x * sigmoid(x),
+    "exponential": numpy.exp,
+    "softmax": softmax,
+}
+
+
+def activation_name(layer):
+    """
+    Returns name of given -> layer's activation | None if numpy can't run it
+    """
+    name = getattr(getattr(layer, "activation", None), "__name__", None)
+    return name if name in ACTIVATIONS else None
+
+
+def convert_layers(model):
+    """
+    Converts given -> keras model (Flatten, Dense, then Dense/Activation/BatchNormalization/Dropout layers)
+    into numpy weights. The first Dense's kernel rows are in split_dims tensor order (plane, row, column)
+    Returns -> "OK", (kernel, bias, activation, steps) | error message, None
+    steps: [("dense", kernel, bias), ("scale", scale, shift), ("activation", name),...]
+    """
+    input_shape = getattr(model, "input_shape", None)
+    if not isinstance(input_shape, tuple) or tuple(input_shape[1:]) != BOARD_SHAPE:
+        return "Model input is not the 14x8x8 board tensor.", None
+
+    layers = [layer for layer in model.layers if layer.__class__.__name__ != "InputLayer"]
+    if len(layers) < 2 or layers[0].__class__.__name__ != "Flatten" or layers[1].__class__.__name__ != "Dense":
+        return "First layer is not Dense over the flattened input.", None
+
+    first = layers[1]
+    weights = first.get_weights()
+    kernel = numpy.asarray(weights[0], dtype=numpy.float32)
+    bias = numpy.asarray(weights[1], dtype=numpy.float32) if first.use_bias else numpy.zeros(kernel.shape[1], dtype=numpy.float32)
+    if getattr(layers[0], "data_format", "channels_last") == "channels_first": # flattens as (8, 8, 14)
+        kernel = kernel.reshape(8, 8, 14, -1).transpose(2, 0, 1, 3).reshape(PIECE_FEATURES + 128, -1)
+    activation = activation_name(first)
+    if activation == None:
+        return "First layer activation is not supported.", None
+
+    steps = []
+    for layer in layers[2:]:
+        kind = layer.__class__.__name__
+        if kind == "Dropout": # identity at inference
+            continue
+        elif kind == "Dense":
+            weights = layer.get_weights()
+            layer_kernel = numpy.asarray(weights[0], dtype=numpy.float32)
+            layer_bias = numpy.asarray(weights[1], dtype=numpy.float32) if layer.use_bias else numpy.zeros(layer_kernel.shape[1], dtype=numpy.float32)
+            steps.append(("dense", layer_kernel, layer_bias))
+            name = activation_name(layer)
+            if name == None:
+                return f"Activation of layer {layer.name} is not supported.", None
+            if name != "linear":
+                steps.append(("activation", name))
+        elif kind == "Activation":
+            name = activation_name(layer)
+            if name == None:
+                return f"Activation of layer {layer.name} is not supported.", None
+            steps.append(("activation", name))
+        elif kind == "BatchNormalization":
+            weights = list(layer.get_weights())
+            gamma = weights.pop(0) if layer.scale else 1
+            beta = weights.pop(0) if layer.center else 0
+            mean, variance = weights[0], weights[1]
+            scale = numpy.asarray(gamma / numpy.sqrt(variance + layer.epsilon), dtype=numpy.float32)
+            shift = numpy.asarray(beta - mean * scale, dtype=numpy.float32)
+            steps.append(("scale", scale, shift))
+        else:
+            return f"Layer {layer.name} ({kind}) is not supported.", None
+
+    return "OK", (kernel, bias, activation, steps)
+
+
+class Accumulator:
+    """
+    First layer output (before activation) of a board's piece planes, updated on push/pop.
+    Each push saves the previous values so pop restores them exactly (no rounding drift).
+    """
+    def __init__(self, evaluator, planes):
+        self.evaluator = evaluator
+        self.values = evaluator.bias + planes[:12].reshape(PIECE_FEATURES) @ evaluator.piece_kernel
+        self.stack = []
+
+
+    def push(self, delta):
+        """
+        Updates values with given -> delta [(square, old piece, new piece),...] of a push
+        """
+        self.stack.append(self.values)
+        kernel = self.evaluator.piece_kernel
+        values = self.values.copy()
+        for square, old_piece, new_piece in delta:
+            offset = (7 - square // 8) * 8 + square % 8
+            if old_piece != None:
+                values -= kernel[piece_plane(old_piece) * 64 + offset]
+            if new_piece != None:
+                values += kernel[piece_plane(new_piece) * 64 + offset]
+        self.values = values
+
+
+    def pop(self):
+        """
+        Restores values before the last push
+        Returns -> False if there was no push to undo (accumulator must be rebuilt)
+        """
+        if len(self.stack) == 0:
+            return False
+        self.values = self.stack.pop()
+        return True
+
+
+class DenseEvaluator:
+    """
+    Evaluates an EncodedBoard with a dense-input model's weights in numpy,
+    the first layer through the board's accumulator
+    """
+    def __init__(self, kernel, bias, activation, steps):
+        self.piece_kernel = kernel[:PIECE_FEATURES]
+        self.attack_kernel = kernel[PIECE_FEATURES:]
+        self.bias = bias
+        self.activation_name = activation
+        self.activation = ACTIVATIONS[activation]
+        self.steps = steps
+        self.fingerprint = None # of the model's architecture, set for grouping (model_groups.py)
+
+
+    def forward(self, hidden):
+        """
+        Returns model output of given -> first layer output (before activation)
+        """
+        x = self.activation(hidden)
+        for step in self.steps:
+            if step[0] == "dense":
+                x = x @ step[1] + step[2]
+            elif step[0] == "scale":
+                x = x * step[1] + step[2]
+            else:
+                x = ACTIVATIONS[step[1]](x)
+        return x
+
+
+    def evaluate(self, board):
+        """
+        Evaluates given -> EncodedBoard whose tensor is encoded (planes up to date)
+        Returns -> model's evaluation (first output)
+        """
+        accumulator = board.accumulator
+        if accumulator == None or accumulator.evaluator is not self:
+            accumulator = board.accumulator = Accumulator(self, board.planes)
+        hidden = accumulator.values + board.planes[12:].reshape(128) @ self.attack_kernel
+        return self.forward(hidden)[0]
+
+
+    def evaluate_batch(self, boards):
+        """
+        Evaluates given -> batch of encoded boards (numpy array (n, 14, 8, 8)) without accumulators
+        Returns -> numpy array (n, outputs)
+        """
+        x = numpy.asarray(boards, dtype=numpy.float32).reshape(len(boards), PIECE_FEATURES + 128)
+        return self.forward(x[:, :PIECE_FEATURES] @ self.piece_kernel + x[:, PIECE_FEATURES:] @ self.attack_kernel + self.bias)
+
+
+def check_positions():
+    """
+    Returns -> EncodedBoards of the validation positions, with a move pushed and popped around each
+    encode so the accumulator's incremental path is exercised
+    """
+    from model_validation import VALIDATION_FENS
+
+    positions = []
+    for fen in VALIDATION_FENS:
+        board = EncodedBoard(fen)
+        positions.append((board, None))
+        for move in list(board.legal_moves)[:3]:
+            positions.append((board, move))
+    return positions
+
+
+def build_dense_evaluator(model):
+    """
+    Builds a DenseEvaluator of given -> model if its first layer is Dense over the flattened input
+    and it matches model.predict within DENSE_EVAL_TOLERANCE
+    Returns -> "OK", evaluator | reason, None
+    """
+    if not DENSE_EVALUATOR:
+        return "Dense evaluator disabled.", None
+
+    try:
+        convert_message, converted = convert_layers(model)
+        if convert_message != "OK":
+            return convert_message, None
+        evaluator = DenseEvaluator(*converted)
+
+        # evaluate through the accumulator, as search does
+        evaluations = []
+        boards = []
+        for board, move in check_positions():
+            if move != None:
+                board.push(move)
+            board.encode()
+            evaluations.append(evaluator.evaluate(board))
+            boards.append(split_dims(board))
+            if move != None:
+                board.pop()
+
+        expected = numpy.asarray(model.predict(numpy.stack(boards), verbose=0))
+        evaluations = numpy.asarray(evaluations).reshape(expected.shape)
+    except Exception as e:
+        return f"Dense evaluator failed: {str(e)}", None
+
+    if not numpy.allclose(evaluations, expected, rtol=DENSE_EVAL_TOLERANCE, atol=DENSE_EVAL_TOLERANCE):
+        error = float(numpy.max(numpy.abs(evaluations - expected)))
+        return f"Dense evaluator differs from model by {error:.2e}.", None
+
+    return "OK", evaluator
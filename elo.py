@@ -0,0 +1,142 @@
+# Functions and classes to support calculating player elo ratings.
+#
+# Standard Elo updates are applied per game as results arrive. Each batch is a
+# rating period: expected scores use the ratings at the start of the batch, so
+# the result does not depend on which game thread finishes first and a
+# historical replay can update a whole batch at once with numpy.
+
+import numpy
+import threading
+
+
+ELO_K_FACTOR = 32
+ELO_INITIAL_SCORE = 0 # new players start at 0 in db
+ELO_MIN_SCORE = 0 # ratings are floored at 0 after each batch
+
+
+def expected_score(rating_a, rating_b):
+    """
+    Returns expected score (0-1) of player a against player b
+    Works elementwise on numpy arrays
+    """
+    return 1 / (1 + 10 ** ((rating_b - rating_a) / 400))
+
+
+def match_result(winner_id, player_1_id, status_flag):
+    """
+    Returns player 1's score (1 win, 0.5 draw, 0 loss) from match data or None if no game played
+    """
+    if status_flag == 2: # tied
+        return 0.5
+    elif status_flag == 1: # has winner
+        return 1.0 if winner_id == player_1_id else 0.0
+    else: # no game played
+        return None
+
+
+class EloEngine:
+    """
+    Thread safe incremental elo ratings for one rating period (batch)
+    """
+    def __init__(self, ratings=None, k_factor=ELO_K_FACTOR):
+        self.k_factor = k_factor
+        self.lock = threading.Lock()
+        self.ratings = {} # current ratings (updated per game)
+        self.period_ratings = {} # ratings at start of period (used for expected scores)
+        for player_id, rating in (ratings or {}).items():
+            self.ratings[player_id] = float(rating if rating != None else ELO_INITIAL_SCORE)
+        self.start_period()
+
+
+    def start_period(self):
+        """
+        Snapshots current ratings as the start of a new rating period
+        """
+        with self.lock:
+            self.period_ratings = dict(self.ratings)
+
+
+    def end_period(self):
+        """
+        Rounds and floors ratings at the end of a rating period
+        Returns -> {player_id: elo_score}
+        """
+        with self.lock:
+            for player_id, rating in self.ratings.items():
+                self.ratings[player_id] = float(max(ELO_MIN_SCORE, round(rating)))
+            self.period_ratings = dict(self.ratings)
+            return {player_id: int(rating) for player_id, rating in self.ratings.items()}
+
+
+    def rating(self, player_id):
+        with self.lock:
+            return self.ratings.get(player_id, float(ELO_INITIAL_SCORE))
+
+
+    def record_game(self, player_1_id, player_2_id, player_1_result):
+        """
+        Applies one game result immediately given -> player 1's score (1 win, 0.5 draw, 0 loss)
+        Returns -> (player_1 rating, player_2 rating)
+        """
+        with self.lock:
+            rating_1 = self.period_ratings.get(player_1_id, float(ELO_INITIAL_SCORE))
+            rating_2 = self.period_ratings.get(player_2_id, float(ELO_INITIAL_SCORE))
+
+            change = self.k_factor * (player_1_result - expected_score(rating_1, rating_2))
+
+            self.ratings[player_1_id] = self.ratings.get(player_1_id, float(ELO_INITIAL_SCORE)) + change
+            self.ratings[player_2_id] = self.ratings.get(player_2_id, float(ELO_INITIAL_SCORE)) - change
+
+            return self.ratings[player_1_id], self.ratings[player_2_id]
+
+
+    def replay_matches(self, matches):
+        """
+        Recomputes ratings from match history given -> iterable of match dicts
+        (player_1_id, player_2_id, winner_id, batch_id, status_flag)
+        Each batch is one rating period, updated in a single vectorized step,
+        giving the same ratings as recording the batch's games one by one.
+        Returns -> {player_id: elo_score}
+        """
+        player_1_ids, player_2_ids, results, batch_ids = [], [], [], []
+        for match in matches:
+            result = match_result(match["winner_id"], match["player_1_id"], match["status_flag"])
+            if result == None or match["batch_id"] == None:
+                continue
+            player_1_ids.append(match["player_1_id"])
+            player_2_ids.append(match["player_2_id"])
+            results.append(result)
+            batch_ids.append(match["batch_id"])
+
+        with self.lock:
+            # index players into a ratings array
+            player_ids = sorted(set(self.ratings) | set(player_1_ids) | set(player_2_ids))
+            player_index = {player_id: i for i, player_id in enumerate(player_ids)}
+            ratings = numpy.array(
+                [self.ratings.get(player_id, float(ELO_INITIAL_SCORE)) for player_id in player_ids],
+                dtype=numpy.float64
+            )
+
+            if len(results) > 0:
+                index_1 = numpy.array([player_index[p] for p in player_1_ids], dtype=numpy.int64)
+                index_2 = numpy.array([player_index[p] for p in player_2_ids], dtype=numpy.int64)
+                scores = numpy.array(results, dtype=numpy.float64)
+                batches = numpy.array(batch_ids, dtype=numpy.int64)
+
+                # group games by batch (stable so match order within a batch is kept)
+                order = numpy.argsort(batches, kind="stable")
+                index_1, index_2, scores, batches = index_1[order], index_2[order], scores[order], batches[order]
+                boundaries = numpy.flatnonzero(numpy.diff(batches)) + 1
+                starts = numpy.concatenate(([0], boundaries))
+                ends = numpy.concatenate((boundaries, [len(batches)]))
+
+                for start, end in zip(starts, ends):
+                    i_1, i_2 = index_1[start:end], index_2[start:end]
+                    change = self.k_factor * (scores[start:end] - expected_score(ratings[i_1], ratings[i_2]))
+                    numpy.add.at(ratings, i_1, change)
+                    numpy.add.at(ratings, i_2, -change)
+                    ratings = numpy.maximum(ELO_MIN_SCORE, numpy.round(ratings))
+
+            self.ratings = {player_id: float(rating) for player_id, rating in zip(player_ids, ratings)}
+            self.period_ratings = dict(self.ratings)
+            return {player_id: int(rating) for player_id, rating in self.ratings.items()}
@@ -9,19 +9,60 @@
 # 5. Updates game data and player data for this batch into DB
 
 from db_access import *
+from db_migrate import run_migrations
+from model_store import get_model_path
+from elo import EloEngine, match_result
+from series import Series, resume_series, series_pairing, SERIES_GAMES
+from model_validation import validate_model, MODEL_LATENCY_BUDGET, MODEL_LATENCY_LIMIT
+from dense_eval import build_dense_evaluator
+from model_groups import group_players, architecture_fingerprint
+from model_artifacts import ingest_model, load_artifact, write_artifact, file_hash, MODEL_ARTIFACTS
+from model_lifecycle import ModelLifecycle, order_lifecycle_games, MODEL_LIFECYCLE
+from scheduling import GameScheduler, estimate_game_cost, GAME_LENGTH_BATCHES, BATCH_GAME_WORKERS, EVALUATIONS_PER_MOVE
+from simulation import simulate_batch, estimate_db_writes, evaluations_per_move, SIMULATION_MODEL_MEMORY_FACTOR, PGN_BYTES_PER_PLY
+from tf_config import configure_tensorflow
+from bot_cache import bot_move_cache, iter_prewarm_positions
+from search import get_ai_move
+from root_search import root_search
+from tablebase import tablebase_result
+from bot_sessions import bot_sessions
+from ponder import ponderer, BOT_PONDER
+from metrics import GAMES_PLAYED, MOVE_SECONDS, MODEL_LOAD_SECONDS
+from profiling import BatchProfiler, stage, PROFILE_GAMES
+from heartbeat import Heartbeat, BATCH_HEARTBEAT_SECONDS
 import os
 import re
+import socket
 import requests
 from datetime import datetime, timedelta, timezone
 import chess
 import chess.pgn
 import random
+import time
+from array import array
 from tensorflow import keras
-import numpy
 import threading
 #import pickle
 
 
+# size tensorflow's thread pools before any model runs
+configure_tensorflow()
+
+
+# player columns needed to run a batch of games
+PLAYER_BATCH_COLUMNS = ("player_id", "name", "elo_score", "model_url", "status_flag")
+
+# minimax search depth used by bots (part of the bot reply cache key)
+MINIMAX_DEPTH = 1
+
+# a running batch without a heartbeat (written every BATCH_HEARTBEAT_SECONDS while it is played) for this long is resumed
+BATCH_STALE_SECONDS = int(os.environ.get("BATCH_STALE_SECONDS", 5 * BATCH_HEARTBEAT_SECONDS))
+
+# sharded batches: the schedule is split into shards claimed by any number of game master instances
+SHARDED_BATCHES = os.environ.get("SHARDED_BATCHES", "0") == "1"
+BATCH_SHARD_SIZE = int(os.environ.get("BATCH_SHARD_SIZE", 16)) # pairings per shard
+
+
 
 #### put in own functions file
 
@@ -67,26 +108,43 @@ def download_gdrive_file(id, destination):
 #### put in own file functions ^^^
 
 
+def pack_moves(moves):
+    """
+    Returns given -> chess.Moves packed 2 bytes each (from square, to square, promotion piece type)
+    """
+    return array("H", (move.from_square | move.to_square << 6 | (move.promotion or 0) << 12 for move in moves))
+
+
+def unpack_moves(packed):
+    """
+    Returns chess.Moves of given -> packed moves (pack_moves)
+    """
+    return [chess.Move(value & 63, value >> 6 & 63, value >> 12 or None) for value in packed]
+
+
 class Match:
     """
     Instance of a chess match. Just used as storage for now.
+    Kept compact for large batches: the game is stored as its PGN headers and packed
+    moves, the PGN text and date/time strings are only produced when uploaded.
     """
-    def __init__(self, player_1_id, player_1_score, player_2_id, player_2_score, pgn, batch_id, winner_id, status_flag):
+    __slots__ = ("player_1_id", "player_1_score", "player_2_id", "player_2_score", "batch_id",
+                 "winner_id", "status_flag", "num_moves", "series_game", "timestamp", "headers", "moves")
+
+    def __init__(self, player_1_id, player_1_score, player_2_id, player_2_score, pgn, batch_id, winner_id, status_flag, num_moves=None, series_game=None):
         self.player_1_id = player_1_id
         self.player_1_score = player_1_score
         self.player_2_id = player_2_id
         self.player_2_score = player_2_score
-        self.pgn = pgn
-        if batch_id != None:
-            self.batch_id = batch_id
-        else:
-            self.batch_id = None
-        self.date, self.time = self.get_date_time()
-        if winner_id != None:
-            self.winner_id = winner_id
-        else:
-            self.winner_id = None
+        # game (chess.pgn.Game) packed as headers and mainline moves
+        self.headers = tuple(pgn.headers.items()) if pgn != None else None
+        self.moves = pack_moves(pgn.mainline_moves()) if pgn != None else None
+        self.batch_id = batch_id
+        self.timestamp = int(time.time())
+        self.winner_id = winner_id
         self.status_flag = status_flag
+        self.num_moves = num_moves # plies played (None if no game played)
+        self.series_game = series_game # game's number in its pairing's series (None if not a series)
         # status flags:
         # 0 not used
         # 1 match OK (Has winner)
@@ -94,16 +152,39 @@ class Match:
         # -1 match error -> player has status flag -1 (bad model_url)
         # -2 match error -> player has status flag -2 (bad model)
         # -3 other error
+        # -4 match error -> player has status flag -4 (model too slow)
 
 
-    def get_date_time(self):
+    @property
+    def pgn(self):
         """
-        Returns date in format DATE and time in format TIME that db can accept
+        Returns PGN text of the game | None if no game was played
         """
-        now = datetime.now(timezone.utc) + timedelta(hours=10)
-        date = now.strftime("%Y-%m-%d")
-        time = now.strftime("%H:%M:%S")
-        return (date, time)
+        if self.headers == None:
+            return None
+        game = chess.pgn.Game(dict(self.headers))
+        game.add_line(unpack_moves(self.moves))
+        return str(game)
+
+
+    def local_time(self):
+        return datetime.fromtimestamp(self.timestamp, timezone.utc) + timedelta(hours=10)
+
+
+    @property
+    def date(self):
+        """
+        Returns date in format DATE that db can accept
+        """
+        return self.local_time().strftime("%Y-%m-%d")
+
+
+    @property
+    def time(self):
+        """
+        Returns time in format TIME that db can accept
+        """
+        return self.local_time().strftime("%H:%M:%S")
 
 
 
@@ -111,6 +192,9 @@ class Player:
     """
     Instance of a player. Just used as storage for now.
     """
+    __slots__ = ("player_id", "name", "elo_score", "model_url", "status_flag", "model_path", "games_scored", "score_total",
+                 "model", "colour", "latency", "throttled", "evaluator", "model_hash", "ingested", "__weakref__") # weakref: per player caches (search.draw_evals)
+
     def __init__(self, player_id, name, elo_score, model_url, status_flag):
         self.player_id = player_id
         self.name = name
@@ -118,9 +202,15 @@ class Player:
         self.model_url = model_url
         self.status_flag = status_flag # reset to zero every new VM instance?
         self.model_path = None
-        self.scores = [] # list of their match scores (used to calculate elo)
+        self.games_scored = 0 # match scores are kept as running totals
+        self.score_total = 0
         self.model = None # entire model downloaded and stored
         self.colour = None # set to "white" or "black" each game
+        self.latency = None # seconds per evaluation measured by validation
+        self.throttled = False # set if model is slow, then it plays one game at a time
+        self.evaluator = None # numpy evaluator of the model if it has one (dense_eval.py)
+        self.model_hash = None # sha256 of the model file, names its artifact (model_artifacts.py)
+        self.ingested = False # set if validation was read from the model's artifact
         # status flags:
         # 0 just created (no model link provided)
         # 1 model link added
@@ -128,6 +218,17 @@ class Player:
         # -1 model could not be downloaded
         # -2 problem with loading model for chess match
         # -3 other error
+        # -4 model slower than MODEL_LATENCY_LIMIT (excluded from batches)
+
+
+    def add_score(self, score):
+        self.games_scored += 1
+        self.score_total += score
+
+
+    @property
+    def mean_score(self):
+        return self.score_total / self.games_scored if self.games_scored > 0 else None
 
 
 
@@ -142,44 +243,72 @@ class ChessGameMaster:
         self.batch_id = None
         self.match_schedule = None
         self.round = 0
-        self.game_threads = []
-
-
-    def initialise_players(self):
+        self.game_plies = None # {player_id: average plies of recent games} used to schedule games
+        self.elo_engine = None
+        self.profiler = None # BatchProfiler while a profiled batch runs
+        self.lifecycle = None # ModelLifecycle of the schedule being played
+        self.db_lock = threading.Lock()
+        self.db_upload_errors = []
+        self.shard_id = None # shard being played by this instance (sharded batches)
+        self.resumed_series = {} # (player_1_id, player_2_id) -> Series left unfinished by an interrupted batch
+        self.simulation_report = None # {name: value} of the last dry run
+        self.worker_id = os.environ.get("GAME_MASTER_ID", f"{socket.gethostname()}-{os.getpid()}")
+
+
+    def initialise_players(self, load_models=True):
         """
         Store players as objects in list and returns list.
-        Tries to download models for players also.
+        Tries to download models for players also (unless load_models is False,
+        then call prepare_player before the player plays).
         """
 
-        players_data_list = self.get_players_data()
+        players_data = self.get_players_data()
 
         # instantiate player objects with downloaded player data
         players = []
-        for p in players_data_list:
+        for p in players_data:
             players.append(Player(p["player_id"], p["name"], p["elo_score"], p["model_url"], p["status_flag"]))
 
-        for player in players:
-            #player.status_flag = 0
-
-            if player.status_flag >= 1: # just inserted new model link
-                # try download model for each player (even if link hasnt changed)
-                self.download_model(player)
-            if player.model_path != None: # download succeeded but not loaded
-                # try load model for each player from downloaded file
-                #print("loading")
-                self.load_model(player)
+        if load_models:
+            for player in players:
+                self.prepare_player(player)
+            self.group_models(players)
 
         return players
 
 
+    def prepare_player(self, player):
+        """
+        Downloads and loads player's model (once per game master)
+        """
+        if player.model_path != None:
+            return # already downloaded
+
+        #player.status_flag = 0
+
+        if player.status_flag >= 1: # just inserted new model link
+            # try download model for each player (even if link hasnt changed)
+            self.download_model(player)
+        if player.model_path != None: # download succeeded but not loaded
+            # try load model for each player from downloaded file
+            #print("loading")
+            self.load_model(player)
+        if player.status_flag == 2: # loaded, check it can play before scheduling it
+            self.validate_player(player)
+        if MODEL_LIFECYCLE:
+            player.model = None # loaded again before the player's first game (model_lifecycle.py)
+
+
     def get_players_data(self):
         """
-        Calls database retrieval function and returns list of player data dictionaries
+        Calls database retrieval function and returns player data dictionaries.
+        Only the columns needed for a batch are selected and rows are streamed
+        page by page (no passwords, emails or model blobs are pulled).
 
-        Returns -> [list of dicts{key:value}] -> [{player_id:x, name:x, elo_score:x, model_url:x, status_flag:x, email:x, password:x},...]
+        Returns -> generator of dicts{key:value} -> {player_id:x, name:x, elo_score:x, model_url:x, status_flag:x}, ...
         """
 
-        players_data = db_retrieve_table_list(self.conn, "players")
+        players_data = db_iter_table_list(self.conn, "players", PLAYER_BATCH_COLUMNS)
 
         return players_data
 
@@ -201,6 +330,8 @@ class ChessGameMaster:
             destination = "models/" + str(player.player_id) + ".h5"
 
             player.model_path = download_gdrive_file(url_id, destination)
+            if player.model_path != None and MODEL_ARTIFACTS:
+                player.model_hash = file_hash(player.model_path) # link may point to a new model
         # set status flag for model download
         if player.model_path == None:
             player.status_flag = -1 # error downloading model file
@@ -210,13 +341,25 @@ class ChessGameMaster:
 
     def load_model(self, player):
         """
-        Loads keras model from downloaded model file.
+        Loads player's model from its artifact if it was ingested (model_artifacts.py), the keras
+        model from downloaded model file only if the artifact has no dense evaluator.
         Sets player status_flag -> 2 (success) | -2 (fail).
         """
         try:
             #print(player.model_path)
             #print(keras.backend.image_data_format())
-            player.model = keras.models.load_model(player.model_path)
+            with MODEL_LOAD_SECONDS.time(source="game"):
+                artifact = load_artifact(player.model_hash) if player.model_hash != None else None
+                if artifact != None:
+                    player.ingested = True
+                    if artifact.validation_message != "OK":
+                        print(f"Model of {player.name} failed validation: {artifact.validation_message}")
+                        player.status_flag = -2 # bad model, don't load it again
+                        return
+                    player.latency = artifact.latency
+                    player.evaluator = artifact.evaluator
+                if player.evaluator == None:
+                    player.model = keras.models.load_model(player.model_path)
             #print(player.model)
             player.status_flag = 2 # set model load error flag
         except Exception as e:
@@ -224,6 +367,68 @@ class ChessGameMaster:
             player.status_flag = -2 # set model load error flag
 
 
+    def validate_player(self, player):
+        """
+        Runs player's model on fixed positions (also warming it up) and measures its latency,
+        once per model: the result is stored in the model's artifact and read from it later.
+        Sets player status_flag -> -2 (invalid model) | -4 (too slow), throttles slow models.
+        """
+        if player.ingested: # validated when ingested
+            validation_message = "OK"
+        else:
+            validation_message, player.latency = validate_model(player.model)
+
+        if validation_message != "OK":
+            print(f"Model of {player.name} failed validation: {validation_message}")
+            player.status_flag = -2 # bad model
+        elif player.latency > MODEL_LATENCY_LIMIT:
+            print(f"Model of {player.name} is too slow ({player.latency:.3f}s per evaluation)")
+            player.status_flag = -4 # too slow to play
+        elif player.latency > MODEL_LATENCY_BUDGET:
+            player.throttled = True # over budget, one game at a time
+
+        if player.status_flag not in (-2, -4) and player.evaluator == None:
+            self.prepare_evaluator(player)
+
+        if MODEL_ARTIFACTS and not player.ingested and player.model_hash != None:
+            write_message = write_artifact(player.model_hash, validation_message, player.latency, player.evaluator)
+            if write_message != "OK":
+                print(f"Error storing artifact of {player.name}'s model:", write_message)
+            player.ingested = write_message == "OK"
+
+
+    def prepare_evaluator(self, player):
+        """
+        Sets player's dense evaluator if their model's first layer is Dense over the flattened input
+        """
+        evaluator_message, player.evaluator = build_dense_evaluator(player.model)
+        if evaluator_message == "OK":
+            player.evaluator.fingerprint = architecture_fingerprint(player.model)
+            print(f"Evaluating {player.name or player.player_id} with dense evaluator")
+
+
+    def group_models(self, players):
+        """
+        Releases keras models of given -> players with a dense evaluator, players with identical
+        models share one evaluator (model_groups.py)
+        """
+        groups = group_players(players)
+        if len(groups) > 0:
+            print(f"{sum(len(group) for group in groups)} players share {len(groups)} identical models")
+
+
+    def update_model_stats(self, players):
+        """
+        Calls db function to store validation results of given -> players (for scheduling)
+        """
+        validated_players = [player for player in players if player.latency != None]
+        db_upload_message = db_update_model_stats(self.conn, self.batch_id, validated_players)
+        if db_upload_message != "OK":
+            print("Error uploading model stats:", db_upload_message)
+
+        return db_upload_message
+
+
     def extract_url_id(self, url):
         # returns extracted url_id from given url
         # e.g "1vTnYdYU6TJOOYlWVG1ct9Lb9aTTYON1A"
@@ -248,6 +453,7 @@ class ChessGameMaster:
 
         Calls db function to upload new player data to database
         """
+        db_upload_message = "OK"
         for player in self.players:
             db_upload_message = db_update_player_data(self.conn, player)
             if db_upload_message != "OK":
@@ -258,33 +464,128 @@ class ChessGameMaster:
         return db_upload_message
 
 
-    def update_matches_data(self):
+    def update_players_elo(self):
         """
-        Called at end of all chess games.
+        Called by the coordinator at end of a sharded batch.
 
-        Calls db function to upload new matches data to database
+        Uploads only elo scores (status flags were uploaded by the workers which loaded the models)
         """
-        for match in self.matches:
-            db_upload_message = db_insert_new_match(self.conn, match)
+        db_upload_message = "OK"
+        for player in self.players:
+            db_upload_message = db_update_player_elo(self.conn, player.player_id, player.elo_score)
             if db_upload_message != "OK":
-                #print("Error uploading match.")
-                #print(db_upload_message)
                 break
 
         return db_upload_message
 
 
-    def get_batch_id(self):
+    def start_batch(self):
         """
-        Calls database retrieval function and returns batch_id.
-        Returns -> int | None.
+        Resumes the latest interrupted batch (running but no heartbeat for
+        BATCH_STALE_SECONDS) or otherwise starts a new batch with a new schedule.
+        Sets self.batch_id and self.match_schedule.
+
+        Returns -> status, [dicts of matches already recorded for the batch]
         """
-        latest_batch_id = db_latest_batch_id(self.conn)
+        running_batch = db_get_running_batch(self.conn)
 
-        if latest_batch_id == None:
-            return 1
-        else:
-            return latest_batch_id + 1
+        if running_batch != None:
+            batch_id, schedule, heartbeat_at = running_batch
+
+            if heartbeat_at != None and datetime.utcnow() - heartbeat_at < timedelta(seconds=BATCH_STALE_SECONDS):
+                # another instance is still playing this batch
+                return f"Batch {batch_id} is still running.", []
+
+            # resume with the batch's own schedule (players since removed are skipped)
+            players_by_id = {player.player_id: player for player in self.players}
+            self.batch_id = batch_id
+            self.match_schedule = tuple(
+                [players_by_id[player_1_id], players_by_id[player_2_id]]
+                for player_1_id, player_2_id in (schedule or [])
+                if player_1_id in players_by_id and player_2_id in players_by_id
+            )
+            played_matches = db_retrieve_batch_matches(self.conn, batch_id)
+            print(f"Resuming batch {batch_id}: {len(played_matches)} of {len(self.match_schedule)} matches already recorded")
+            return "OK", played_matches
+
+        # new batch, schedule is checkpointed with its batch_id
+        self.match_schedule = self.create_match_schedule()
+        schedule = [(player_1.player_id, player_2.player_id) for player_1, player_2 in self.match_schedule]
+        self.batch_id = db_new_batch_id(self.conn, schedule)
+        return "OK", []
+
+
+    def resume_played_matches(self, played_matches):
+        """
+        Works out which pairings of an interrupted batch need no more games from given -> played_matches.
+        Unfinished series are kept in self.resumed_series to be played on, finished series missing
+        their length get it recorded
+        Returns -> played_pairings {(player_1_id, player_2_id),...}
+        """
+        played_pairings = {(match["player_1_id"], match["player_2_id"]) for match in played_matches if match["series_game"] == None}
+
+        unrecorded = {series_pairing(match) for match in played_matches if match["series_game"] != None and match["series_games"] == None}
+        self.resumed_series = {}
+        for pairing, series in resume_series(played_matches).items():
+            if not series.finished():
+                self.resumed_series[pairing] = series
+                continue
+            played_pairings.add(pairing)
+            if pairing in unrecorded and series.games > 0:
+                with self.db_lock:
+                    db_upload_message = db_update_series_games(self.conn, self.batch_id, pairing[0], pairing[1], series.games)
+                if db_upload_message != "OK":
+                    print("Error uploading series length:", db_upload_message)
+                    self.db_upload_errors.append(db_upload_message)
+
+        if len(self.resumed_series) > 0:
+            print(f"Resuming {len(self.resumed_series)} unfinished series")
+        return played_pairings
+
+
+    def update_leaderboard_data(self):
+        """
+        Called at end of all chess games, after matches are uploaded.
+
+        Calls db function to fold this batch's results (including any played
+        before the batch was resumed) into the leaderboard summary
+        """
+        batch_matches = db_retrieve_batch_matches(self.conn, self.batch_id)
+        db_upload_message = db_update_leaderboard(self.conn, self.batch_id, self.players, batch_matches)
+
+        return db_upload_message
+
+
+    def finalise_batch(self, sharded=False):
+        """
+        Called at end of all chess games (matches were uploaded as each finished).
+
+        Uploads player data (only elo scores if sharded), adds the batch to the
+        leaderboard and marks the batch complete, all in one transaction so a
+        resumed batch is never counted twice.
+        Returns -> db_upload_message
+        """
+        if len(self.db_upload_errors) > 0: # a match failed to upload
+            return self.db_upload_errors[0]
+
+        transaction = self.conn.begin()
+        db_upload_message = "NOT OK"
+        try:
+            if sharded:
+                db_upload_message = self.update_players_elo()
+            else:
+                db_upload_message = self.update_players_data() #uploads all player object data to db
+            if db_upload_message == "OK":
+                db_upload_message = self.update_leaderboard_data() #adds this batch to leaderboard summary
+            if db_upload_message == "OK":
+                db_upload_message = db_complete_batch(self.conn, self.batch_id)
+        finally:
+            if db_upload_message == "OK":
+                transaction.commit()
+            else:
+                transaction.rollback()
+
+        return db_upload_message
 
 
     def create_match_schedule(self):
@@ -313,157 +614,17 @@ class ChessGameMaster:
         return "OK"
 
 
-    def play_chess(self, player_1, player_2, fen=None):
+    def play_chess(self, player_1, player_2, fen=None, series_game=None):
         """
         Plays a game of chess between two provided players.
 
         Should create a new Match object for this chess match
-        Should also calculate a score for the players (adds to Match object and player.scores list)
+        Should also calculate a score for the players (adds to Match object and player's score totals)
+        and apply the game's elo update (self.elo_engine)
 
         anything else important
         """
 
-        """Utility Functions"""
-        ## split dimensions of board to translate move to the model
-        squares_index = {
-            'a': 0,
-            'b': 1,
-            'c': 2,
-            'd': 3,
-            'e': 4,
-            'f': 5,
-            'g': 6,
-            'h': 7
-        }
-
-        def square_to_index(square):
-            letter = chess.square_name(square)
-            return 8 - int(letter[1]), squares_index[letter[0]]
-
-        def split_dims(board):
-            # this is the 3d matrix
-            # 14: 6 for white chess pieces, 6 for black chess pieces, 2 for valid attacks and moves for white and black
-            # 8:8 is the chess board size
-            # order is (pawns, knights, bishops, rooks, queen,king)
-
-            board3d = numpy.zeros((14, 8, 8), dtype=numpy.int8)
-
-            # here we add the pieces's view on the matrix
-            for piece in chess.PIECE_TYPES:
-                for square in board.pieces(piece, chess.WHITE):
-                    idx = numpy.unravel_index(square, (8, 8))
-                    board3d[piece - 1][7 - idx[0]][idx[1]] = 1
-                for square in board.pieces(piece, chess.BLACK):
-                    idx = numpy.unravel_index(square, (8, 8))
-                    board3d[piece + 5][7 - idx[0]][idx[1]] = 1
-
-            # add attacks and valid moves too
-            # so the network knows what is being attacked
-            aux = board.turn
-            board.turn = chess.WHITE
-            for move in board.legal_moves:
-                i, j = square_to_index(move.to_square)
-                board3d[12][i][j] = 1
-            board.turn = chess.BLACK
-            for move in board.legal_moves:
-                i, j = square_to_index(move.to_square)
-                board3d[13][i][j] = 1
-            board.turn = aux
-
-            return board3d
-
-
-        # this is the function that gets the move from the neural network
-        def get_ai_move(board, depth, model):
-            max_move = None
-            # set max to -infinity
-            max_eval = -numpy.inf
-
-            for move in board.legal_moves:
-                board.push(move)
-                eval = minimax(board, depth - 1, -numpy.inf, numpy.inf, False, model)
-                board.pop()
-                if eval > max_eval:
-                    max_eval = eval
-                    max_move = move
-
-            return max_move
-
-
-        # used for the minimax algorithm
-        def minimax_eval(board, player):
-            board3d = split_dims(board)
-            board3d = numpy.expand_dims(board3d, 0)
-            #print(model.predict(board3d)[0][0])
-            #if player.colour == "white":
-            return player.model.predict(board3d)[0][0]
-            #elif player.colour == "black":
-              #return 1 - player.model.predict(board3d)[0][0]
-
-
-        def minimax(board, depth, alpha, beta, player, maximising):
-            if depth == 0 or board.is_game_over():
-                return minimax_eval(board, player)
-
-            if maximising == True: # maximizing_player
-                max_eval = -numpy.inf
-                for move in board.legal_moves:
-                    board.push(move)
-                    eval = minimax(board, depth - 1, alpha, beta, player, False)
-                    board.pop()
-                    max_eval = max(max_eval, eval)
-                    alpha = max(alpha, eval)
-                    if beta <= alpha:
-                        break
-                return max_eval
-
-            elif maximising == False: # minimising_player
-                min_eval = numpy.inf
-                for move in board.legal_moves:
-                    board.push(move)
-                    eval = minimax(board, depth - 1, alpha, beta, player, True)
-                    board.pop()
-                    min_eval = min(min_eval, eval)
-                    beta = min(beta, eval)
-                    if beta <= alpha:
-                        break
-                return min_eval
-
-
-        # This is the actual function that gets the move from the neural network
-        def get_ai_move(board, depth, player):
-            # White player tries to maximize score
-            if player.colour == "white":
-              max_move = None
-              # set max to -infinity
-              max_eval = -numpy.inf
-
-              for move in board.legal_moves:
-                  board.push(move)
-                  eval = minimax(board, depth - 1, -numpy.inf, numpy.inf, player, maximising=False)
-                  board.pop()
-                  if eval > max_eval:
-                      max_eval = eval
-                      max_move = move
-
-              return max_move
-
-            # Black player tries to minimize score
-            elif player.colour == "black":
-              min_move = None
-              # set min to infinity
-              min_eval = numpy.inf
-
-              for move in board.legal_moves:
-                  board.push(move)
-                  eval = minimax(board, depth - 1, -numpy.inf, numpy.inf, player, maximising=True)
-                  board.pop()
-                  if eval < min_eval:
-                      min_eval = eval
-                      min_move = move
-              return min_move
-
-
         """
         Chess Match
         """
@@ -485,20 +646,21 @@ class ChessGameMaster:
             if board.is_game_over():
                 status = "Error"
                 # error: stop playing
-                return status, fen
+                return status, fen, None
 
             #print("game\n", game)
 
             print(f"Starting Match Between Human and Bot: {player_2.player_id}")
             # try get ai move
-            minmax_depth = 1
+            minmax_depth = MINIMAX_DEPTH
             try:
-                move = get_ai_move(board, minmax_depth, player_2)
+                with MOVE_SECONDS.time(source="fen"):
+                    move = get_ai_move(board, minmax_depth, player_2)
             except Exception as e:
                 print("Error getting move from player 2:", str(e))
                 # error: stop playing
                 status = str(e)
-                return status, fen
+                return status, fen, None
 
             board.push(move)
             # save in PGN
@@ -507,8 +669,8 @@ class ChessGameMaster:
             status = "OK"
             # convert new board to fen
             fen = board.fen()
-            # return status and fen
-            return status, fen
+            # return status, fen and the bot's move
+            return status, fen, move
 
 
         else:
@@ -535,7 +697,8 @@ class ChessGameMaster:
             ### START MATCH ###
             print(f"Starting Match Between {player_1.name} and {player_2.name}")
             iteration = 0
-            minmax_depth = 1
+            minmax_depth = MINIMAX_DEPTH
+            adjudicated_result = None # set once the tablebases solve the position
             while True:
                 # Player 1 move
                 # set random starting point everytime
@@ -543,13 +706,14 @@ class ChessGameMaster:
                     move = random.choice([move for move in board.legal_moves])
                 else:
                     try:
-                        move = get_ai_move(board, minmax_depth, player_1)
+                        with MOVE_SECONDS.time(source="game"):
+                            move = get_ai_move(board, minmax_depth, player_1)
                     except:
                         # error getting move from player 1
                         player_1.status_flag = -3
                         # add match information with error flag
                         status_flag = -3
-                        self.matches.append(Match(player_1.player_id, None, player_2.player_id, None, None, self.batch_id, None, status_flag))
+                        self.add_match(Match(player_1.player_id, None, player_2.player_id, None, None, self.batch_id, None, status_flag))
                         # stop playing
                         return
 
@@ -560,16 +724,20 @@ class ChessGameMaster:
                 #print(f'\n{board}')
                 if board.is_game_over():
                     break
+                adjudicated_result = tablebase_result(board)
+                if adjudicated_result != None:
+                    break
 
                 # Player 2 move
                 try:
-                    move = get_ai_move(board, minmax_depth, player_2)
+                    with MOVE_SECONDS.time(source="game"):
+                        move = get_ai_move(board, minmax_depth, player_2)
                 except:
                     # error getting move from player 2
                     player_2.status_flag = -3
                     # add match information with error flag
                     status_flag = -3
-                    self.matches.append(Match(player_1.player_id, None, player_2.player_id, None, None, self.batch_id, None, status_flag))
+                    self.add_match(Match(player_1.player_id, None, player_2.player_id, None, None, self.batch_id, None, status_flag))
                     # stop playing
                     return
 
@@ -579,8 +747,15 @@ class ChessGameMaster:
                 #print(f'\n{board}')
                 if board.is_game_over():
                     break
+                adjudicated_result = tablebase_result(board)
+                if adjudicated_result != None:
+                    break
 
-            game.headers["Result"] = board.result()
+            if adjudicated_result != None:
+                game.headers["Result"] = adjudicated_result
+                game.headers["Termination"] = "adjudication" # tablebase position
+            else:
+                game.headers["Result"] = board.result()
 
             ##PGN should be stored here (game)
             #print(game) # pgn
@@ -615,15 +790,50 @@ class ChessGameMaster:
                 winner_id = None
                 status_flag = 2 # OK BUT Tied Match
 
-            player_1.scores.append(player1_score)
-            player_2.scores.append(player2_score)
+            player_1.add_score(player1_score)
+            player_2.add_score(player2_score)
 
             #print(f"Player 1 score: {player1_score}")
             #print(f"Player 2 score: {player2_score}")
 
             # create a match object and add it to the matches list!
-            self.matches.append(Match(player_1.player_id, player1_score, player_2.player_id, player2_score, game, self.batch_id, winner_id, status_flag))
+            match = Match(player_1.player_id, player1_score, player_2.player_id, player2_score, game, self.batch_id, winner_id, status_flag, board.ply(), series_game)
+            self.add_match(match)
+            # apply this game's elo update as soon as it finishes
+            self.elo_engine.record_game(player_1.player_id, player_2.player_id, match_result(winner_id, player_1.player_id, status_flag))
             print(f"Completed Match Between {player_1.name} and {player_2.name}")
+            return match
+
+
+    def add_match(self, match):
+        """
+        Records a finished (or errored) match of this batch
+        Uploaded straight away so an interrupted batch can resume without replaying it
+        """
+        with self.db_lock: # game threads share one db connection
+            self.matches.append(match)
+            with stage("db"):
+                db_upload_message = db_insert_new_match(self.conn, match)
+            if db_upload_message != "OK":
+                print("Error uploading match:", db_upload_message)
+                self.db_upload_errors.append(db_upload_message)
+
+        GAMES_PLAYED.inc(status_flag=match.status_flag)
+
+
+    def beat(self):
+        """
+        Refreshes the heartbeat of the batch being played and of the shard this instance
+        claimed if sharded (called by its Heartbeat thread)
+        Returns -> db_upload_message
+        """
+        with self.db_lock:
+            with stage("db"):
+                db_upload_message = db_touch_batch(self.conn, self.batch_id)
+                if db_upload_message == "OK" and self.shard_id != None:
+                    db_upload_message = db_touch_batch_shard(self.conn, self.batch_id, self.shard_id, self.worker_id)
+
+        return db_upload_message
 
 
     def get_round(self):
@@ -631,42 +841,131 @@ class ChessGameMaster:
         return self.round
 
 
-    def calculate_elo_score(self, player):
+    def calculate_elo_score(self, player, elo_scores):
         """
-        Given player with list of scores calculate elo_score
+        Given player and end of batch ratings from elo engine set elo_score
         """
-        if len(player.scores) > 0:
-            player.elo_score = (player.elo_score + (sum(player.scores)/len(player.scores))) // 2
-            if player.elo_score < 0:
-                player.elo_score = 0
+        if player.player_id in elo_scores:
+            player.elo_score = elo_scores[player.player_id]
 
 
-    def run_games(self):
+    def recalculate_elo_scores(self):
         """
-        After init calls game functions and database functions
+        Replays the whole matches history through a fresh elo engine and
+        uploads the recomputed elo_score of every player.
+        Returns -> db_upload_message
         """
-        print("Running")
-        # initialise
-        self.players = self.initialise_players()
-        self.batch_id = self.get_batch_id()
-        self.match_schedule = self.create_match_schedule()
+        migrate_message = run_migrations(self.conn)
+        if migrate_message != "OK":
+            return migrate_message
+
+        player_ids = [entry[0] for entry in db_iter_table_rows(self.conn, "players", ("player_id",))]
+        matches_data = db_iter_table_list(self.conn, "matches", ("player_1_id", "player_2_id", "winner_id", "batch_id", "status_flag"))
+
+        elo_engine = EloEngine({player_id: 0 for player_id in player_ids})
+        elo_scores = elo_engine.replay_matches(matches_data)
+
+        db_upload_message = "OK"
+        for player_id, elo_score in elo_scores.items():
+            db_upload_message = db_update_player_elo(self.conn, player_id, elo_score)
+            if db_upload_message != "OK":
+                break
+
+        return db_upload_message
+
+
+    def play_game(self, player_1, player_2):
+        """
+        Plays a batch game (profiled if the batch is), with the players' models loaded for it
+        """
+        lifecycle = self.lifecycle
+        if lifecycle != None:
+            lifecycle.acquire(player_1, player_2)
+        try:
+            if SERIES_GAMES > 1:
+                play, args = self.play_series, (player_1, player_2)
+            else:
+                play, args = self.play_chess, (player_1, player_2, None)
+            if self.profiler != None:
+                self.profiler.profile_thread(play, *args)
+            else:
+                play(*args)
+        finally:
+            if lifecycle != None:
+                lifecycle.release(player_1, player_2)
+
+
+    def play_series(self, player_1, player_2):
+        """
+        Plays a series between given -> players (colours alternating, player_1 white first) until
+        its stop rule settles it or SERIES_GAMES are played, then records how many games it took
+        """
+        # an interrupted batch's series carries on from its recorded games
+        series = self.resumed_series.pop((player_1.player_id, player_2.player_id), None)
+        if series == None:
+            series = Series()
+        while not series.finished():
+            white, black = (player_1, player_2) if series.games % 2 == 0 else (player_2, player_1)
+            match = self.play_chess(white, black, None, series.games + 1)
+            result = match_result(match.winner_id, white.player_id, match.status_flag) if match != None else None
+            if result == None: # game errored (recorded), stop the series
+                series.stopped = True
+                break
+            series.record(result if white is player_1 else 1 - result)
+
+        if series.games > 0:
+            with self.db_lock:
+                db_upload_message = db_update_series_games(self.conn, self.batch_id, player_1.player_id, player_2.player_id, series.games)
+            if db_upload_message != "OK":
+                print("Error uploading series length:", db_upload_message)
+                self.db_upload_errors.append(db_upload_message)
+        print(f"Series {player_1.name} vs {player_2.name}: {series.summary()}")
+
+
+    def estimate_game_costs(self, games):
+        """
+        Estimates seconds each of given -> games [[player_1, player_2],...] takes from
+        the players' model latency and recent game length
+        Returns -> [(cost, player_1, player_2),...]
+        """
+        if self.game_plies == None:
+            self.game_plies = db_retrieve_player_game_lengths(self.conn, (self.batch_id or 0) - GAME_LENGTH_BATCHES)
+
+        # models not validated in this game master (yet) use their last measured latency
+        stored_latencies = None
+        if any(player.latency == None for game in games for player in game):
+            stored_latencies = db_retrieve_model_latencies(self.conn)
+
+        latencies = sorted(player.latency for game in games for player in game if player.latency != None)
+        default_latency = latencies[len(latencies) // 2] if len(latencies) > 0 else MODEL_LATENCY_BUDGET
+
+        game_costs = []
+        for player_1, player_2 in games:
+            for player in (player_1, player_2):
+                if player.latency == None and player.player_id in stored_latencies:
+                    player.latency = stored_latencies[player.player_id]
+            game_costs.append((estimate_game_cost(player_1, player_2, self.game_plies, default_latency), player_1, player_2))
+
+        return game_costs
+
+
+    def play_schedule(self, match_schedule, played_pairings=()):
+        """
+        Plays every game of given -> match_schedule [[player_1, player_2],...] (skipping
+        pairings of player ids in played_pairings) on a bounded pool of game workers,
+        longest estimated game first, and waits for them to finish
+        """
+        games = []
 
         # pick two players from match schedule
-        for player_1, player_2 in self.match_schedule:
+        for player_1, player_2 in match_schedule:
+            if (player_1.player_id, player_2.player_id) in played_pairings:
+                continue # already played before the batch was interrupted
 
             # check if players are ready
             if self.check_status_flags([player_1, player_2]) == "OK":
                 # ready to play game
-                try:
-                    # launch game between two players in its own thread
-                    t = threading.Thread(target=self.play_chess, args=(player_1, player_2, None,))
-                    t.start()
-                    self.game_threads.append(t)
-
-                except:
-                    # other error flag
-                    status_flag = -3
-                    self.matches.append(Match(player_1.player_id, None, player_2.player_id, None, None, self.batch_id, None, status_flag))
+                games.append([player_1, player_2])
 
             else: # known error with one of the players
                 # return a match object with status_flag set appropriately
@@ -675,26 +974,102 @@ class ChessGameMaster:
                 if len(player_error_flags) > 0:
                     # set match status flag the first occuring of the player errors
                     status_flag = max(player_error_flags)
-                    self.matches.append(Match(player_1.player_id, None, player_2.player_id, None, None, self.batch_id, None, status_flag))
+                    self.add_match(Match(player_1.player_id, None, player_2.player_id, None, None, self.batch_id, None, status_flag))
+
+        if len(games) == 0:
+            return
+
+        game_costs = self.estimate_game_costs(games)
+        scheduler = GameScheduler()
+        print(f"Playing {len(games)} games on {min(scheduler.workers, len(games))} workers, longest estimated {max(game_costs, key=lambda game: game[0])[0]:.0f}s")
+        if MODEL_LIFECYCLE:
+            # longest first, or players in waves if loaded models are capped (model_lifecycle.py)
+            game_costs = order_lifecycle_games(game_costs)
+            self.lifecycle = ModelLifecycle(game_costs, self.load_model)
+            try:
+                scheduler.run(game_costs, self.play_game, ordered=True)
+            finally:
+                print(self.lifecycle.report())
+                self.lifecycle = None
+        else:
+            scheduler.run(game_costs, self.play_game)
 
-        elo_status = "OK"
 
-        # wait for games to finish
-        for t in self.game_threads:
-            t.join()
+    def run_games(self, profile=False, sharded=SHARDED_BATCHES, dry_run=False, workers=BATCH_GAME_WORKERS, depth=MINIMAX_DEPTH, instances=1):
+        """
+        After init calls game functions and database functions
+        Plays shards of a sharded batch alongside other instances if sharded (or SHARDED_BATCHES env) is set
+        Profiles the batch if profile (or PROFILE_GAMES env) is set
+        If dry_run is set only simulates the batch (simulate_batch) with workers, depth & instances
+        """
+        if dry_run:
+            return self.simulate_batch(sharded, workers, depth, instances)
+
+        run_batch = self.run_sharded_batch if sharded else self.run_batch
+
+        if not (profile or PROFILE_GAMES):
+            return run_batch()
+
+        self.profiler = BatchProfiler()
+        self.profiler.start()
+        try:
+            return run_batch()
+        finally:
+            self.profiler.stop()
+            now = datetime.now(timezone.utc) + timedelta(hours=10)
+            self.profiler.write(f"batch-{self.batch_id}-{now.strftime('%Y%m%d-%H%M%S')}")
+            self.profiler = None
+
+
+    def run_batch(self):
+        """
+        Plays one batch: loads players, plays every scheduled game and uploads results
+        """
+        print("Running")
+        # bring db schema up to date (indexes, batches & leaderboard tables)
+        migrate_message = run_migrations(self.conn)
+        if migrate_message != "OK":
+            return migrate_message
+
+        # initialise
+        with stage("models"):
+            self.players = self.initialise_players()
+
+        # start a new batch or resume an interrupted one
+        batch_status, played_matches = self.start_batch()
+        if batch_status != "OK":
+            return batch_status
+
+        # models were validated when loaded, keep their latency for scheduling
+        self.update_model_stats(self.players)
+
+        self.elo_engine = EloEngine({player.player_id: player.elo_score for player in self.players})
+
+        # replay results of games recorded before the batch was interrupted
+        played_pairings = self.resume_played_matches(played_matches)
+        for match in played_matches:
+            result = match_result(match["winner_id"], match["player_1_id"], match["status_flag"])
+            if result != None:
+                self.elo_engine.record_game(match["player_1_id"], match["player_2_id"], result)
+
+        # the batch stays claimed while its games are played, however long they take
+        with Heartbeat(self.beat):
+            self.play_schedule(self.match_schedule, played_pairings)
+
+        elo_status = "OK"
 
         try:
-            # finished games
+            # finished games, close this batch's rating period
+            elo_scores = self.elo_engine.end_period()
             for player in self.players:
-                self.calculate_elo_score(player)
+                self.calculate_elo_score(player, elo_scores)
         except Exception as e:
             elo_status = f"Error calculating elo: {str(e)}"
 
         if elo_status == "OK":
             # update database
-            db_upload_message = self.update_players_data() #uploads all player object data to db
-            if db_upload_message == "OK":
-                db_upload_message = self.update_matches_data() #uploads all matches object data to db
+            with stage("db"):
+                db_upload_message = self.finalise_batch()
 
             # end VM instance
             launch_status = str(db_upload_message)
@@ -704,70 +1079,460 @@ class ChessGameMaster:
         return launch_status
 
 
+
+    def simulate_batch(self, sharded=SHARDED_BATCHES, workers=BATCH_GAME_WORKERS, depth=MINIMAX_DEPTH, instances=1):
+        """
+        Dry run of a batch: schedules the players in the players table and simulates playing the
+        schedule on workers per game master (instances game masters claiming shards if sharded)
+        at search depth, from stored model latencies, model sizes and game lengths (simulation.py).
+        Loads no model, plays no move and writes nothing to the db.
+        Sets self.simulation_report
+        Returns -> status
+        """
+        print("Simulating batch")
+        self.players = self.initialise_players(load_models=False)
+
+        # the next batch's recent games, as estimate_game_costs would use them
+        next_batch_id = db_peek_next_batch_id(self.conn)
+        self.game_plies = db_retrieve_player_game_lengths(self.conn, next_batch_id - GAME_LENGTH_BATCHES)
+        pgn_bytes_per_ply = db_retrieve_pgn_bytes_per_ply(self.conn, next_batch_id - GAME_LENGTH_BATCHES) or PGN_BYTES_PER_PLY
+
+        # players' last validation stands in for validating them now
+        stored_latencies = db_retrieve_model_latencies(self.conn)
+        for player in self.players:
+            player.latency = stored_latencies.get(player.player_id)
+            if player.latency == None:
+                continue
+            if player.latency > MODEL_LATENCY_LIMIT:
+                player.status_flag = -4 # too slow to play
+            elif player.latency > MODEL_LATENCY_BUDGET:
+                player.throttled = True
+
+        self.match_schedule = self.create_match_schedule()
+        games = [[player_1, player_2] for player_1, player_2 in self.match_schedule if self.check_status_flags([player_1, player_2]) == "OK"]
+        error_matches = len(self.match_schedule) - len(games)
+
+        # estimates are for single games at depth 1
+        scale = evaluations_per_move(depth) / EVALUATIONS_PER_MOVE * max(1, SERIES_GAMES)
+        game_costs = {}
+        if len(games) > 0:
+            for cost, player_1, player_2 in self.estimate_game_costs(games):
+                game_costs[(player_1.player_id, player_2.player_id)] = (cost * scale, player_1, player_2)
+
+        if sharded:
+            pairings = [(player_1.player_id, player_2.player_id) for player_1, player_2 in self.match_schedule]
+            shards = [[game_costs[pairing] for pairing in pairings[i:i + BATCH_SHARD_SIZE] if pairing in game_costs]
+                      for i in range(0, len(pairings), BATCH_SHARD_SIZE)]
+        else:
+            shards = [list(game_costs.values())]
+            instances = 1
+
+        # models without a stored blob (linked only) are taken to be of median size
+        model_sizes = db_retrieve_model_sizes(self.conn)
+        sizes = sorted(model_sizes.values())
+        default_size = sizes[len(sizes) // 2] if len(sizes) > 0 else 0
+        model_memory = {player.player_id: model_sizes.get(player.player_id, default_size) * SIMULATION_MODEL_MEMORY_FACTOR for player in self.players}
+
+        makespan, peak_memory, peak_models = simulate_batch(shards, model_memory, instances, workers)
+        db_statements, db_bytes = estimate_db_writes(shards, error_matches, len(self.players), instances, self.game_plies, pgn_bytes_per_ply, sharded, makespan)
+
+        busy_seconds = sum(cost for cost, player_1, player_2 in game_costs.values())
+        self.simulation_report = {
+            "executor": "sharded" if sharded else "threads",
+            "instances": instances,
+            "workers": workers,
+            "depth": depth,
+            "players": len(self.players),
+            "pairings": len(game_costs),
+            "error_matches": error_matches,
+            "shards": len(shards),
+            "makespan_seconds": round(makespan, 1),
+            "utilisation": round(busy_seconds / (makespan * workers * instances), 3) if makespan > 0 else 0,
+            "peak_memory_mb": round(peak_memory / 2 ** 20),
+            "peak_models": peak_models,
+            "db_statements": db_statements,
+            "db_write_mb": round(db_bytes / 2 ** 20, 2),
+        }
+        for name, value in self.simulation_report.items():
+            print(f"{name}: {value}")
+
+        return "OK"
+
+
+
+    def join_sharded_batch(self, create=True):
+        """
+        Joins the running sharded batch. If none is running and create is set, starts
+        a new batch (or shards what is left of an interrupted batch) and queues its shards.
+        Sets self.batch_id.
+        Returns -> status
+        """
+        running_batch = db_get_running_batch(self.conn)
+
+        if running_batch != None:
+            batch_id, schedule, heartbeat_at = running_batch
+
+            if len(db_count_batch_shards(self.conn, batch_id)) > 0:
+                self.batch_id = batch_id
+                return "OK"
+
+            if not create:
+                return "No sharded batch running."
+
+            if heartbeat_at != None and datetime.utcnow() - heartbeat_at < timedelta(seconds=BATCH_STALE_SECONDS):
+                # an unsharded batch is still being played
+                return f"Batch {batch_id} is still running."
+
+            # interrupted batch, shard the pairings it has left (unfinished series are played on by their shard)
+            self.batch_id = batch_id
+            played_pairings = self.resume_played_matches(db_retrieve_batch_matches(self.conn, batch_id))
+            pairings = [pairing for pairing in (schedule or []) if pairing not in played_pairings]
+
+        elif not create:
+            return "No sharded batch running."
+
+        else:
+            self.match_schedule = self.create_match_schedule()
+            pairings = [(player_1.player_id, player_2.player_id) for player_1, player_2 in self.match_schedule]
+            self.batch_id = db_new_batch_id(self.conn, pairings)
+
+        # consecutive pairings share a player, so each shard needs few models
+        shards = [pairings[i:i + BATCH_SHARD_SIZE] for i in range(0, len(pairings), BATCH_SHARD_SIZE)]
+        print(f"Sharded batch {self.batch_id}: {len(pairings)} pairings in {len(shards)} shards")
+
+        return db_create_batch_shards(self.conn, self.batch_id, shards)
+
+
+    def play_shard(self, shard_id, pairings, attempts):
+        """
+        Plays given -> claimed shard's pairings [(player_1_id, player_2_id),...]
+        then uploads status flags of players loaded and marks the shard done
+        Returns -> db_upload_message
+        """
+        self.shard_id = shard_id
+        players_by_id = {player.player_id: player for player in self.players}
+
+        # a shard taken over from a stopped worker (or of a resumed batch's series) may have some games recorded already
+        played_pairings = set()
+        self.resumed_series = {}
+        if attempts > 1 or SERIES_GAMES > 1:
+            shard_pairings = {tuple(pairing) for pairing in pairings}
+            played_matches = [match for match in db_retrieve_batch_matches(self.conn, self.batch_id)
+                              if (match["player_1_id"], match["player_2_id"]) in shard_pairings or (match["player_2_id"], match["player_1_id"]) in shard_pairings]
+            played_pairings = self.resume_played_matches(played_matches)
+
+        match_schedule = [
+            [players_by_id[player_1_id], players_by_id[player_2_id]]
+            for player_1_id, player_2_id in pairings
+            if player_1_id in players_by_id and player_2_id in players_by_id
+        ]
+
+        # the shard stays claimed while its models load and its games are played
+        with Heartbeat(self.beat):
+            # only load models this shard needs
+            shard_players = {player.player_id: player for pairing in match_schedule for player in pairing}
+            with stage("models"):
+                for player in shard_players.values():
+                    self.prepare_player(player)
+                self.group_models(shard_players.values())
+            with self.db_lock: # shared with the heartbeat
+                self.update_model_stats(shard_players.values())
+
+            self.play_schedule(match_schedule, played_pairings)
+
+        self.shard_id = None
+
+        if len(self.db_upload_errors) > 0: # leave shard claimed, it is retried once stale
+            return self.db_upload_errors[0]
+
+        with stage("db"):
+            db_upload_message = "OK"
+            for player in shard_players.values():
+                db_upload_message = db_update_player_status(self.conn, player.player_id, player.status_flag)
+                if db_upload_message != "OK":
+                    return db_upload_message
+
+            db_upload_message = db_complete_batch_shard(self.conn, self.batch_id, shard_id, self.worker_id)
+
+        return db_upload_message
+
+
+    def finalise_sharded_batch(self):
+        """
+        Called by each worker once no shards are left to claim. When every shard is
+        done one worker wins the finalise claim and acts as coordinator: rates the
+        whole batch as one rating period and finalises it.
+        Returns -> db_upload_message
+        """
+        shard_counts = db_count_batch_shards(self.conn, self.batch_id)
+        if any(status != "done" for status in shard_counts):
+            return "OK" # other workers still playing, the last to finish finalises
+
+        if not db_claim_batch_finalise(self.conn, self.batch_id, BATCH_STALE_SECONDS):
+            return "OK" # another worker is finalising
+
+        print(f"Finalising sharded batch {self.batch_id}")
+
+        # ratings don't depend on game order (expected scores use period start ratings)
+        self.elo_engine = EloEngine({player.player_id: player.elo_score for player in self.players})
+        for match in db_retrieve_batch_matches(self.conn, self.batch_id):
+            result = match_result(match["winner_id"], match["player_1_id"], match["status_flag"])
+            if result != None:
+                self.elo_engine.record_game(match["player_1_id"], match["player_2_id"], result)
+
+        elo_scores = self.elo_engine.end_period()
+        for player in self.players:
+            self.calculate_elo_score(player, elo_scores)
+
+        with stage("db"):
+            db_upload_message = self.finalise_batch(sharded=True)
+
+        if db_upload_message != "OK":
+            db_release_batch_finalise(self.conn, self.batch_id)
+
+        return db_upload_message
+
+
+    def run_sharded_batch(self, create=True):
+        """
+        Plays shards of the running sharded batch (starting one if create is set and
+        none is running) until none are left to claim. Any number of game master
+        instances can run this at once against the same db.
+        Returns -> status
+        """
+        print("Running sharded", self.worker_id)
+        migrate_message = run_migrations(self.conn)
+        if migrate_message != "OK":
+            return migrate_message
+
+        # models are loaded per shard, as needed
+        self.players = self.initialise_players(load_models=False)
+
+        batch_status = self.join_sharded_batch(create)
+        if batch_status != "OK":
+            return batch_status
+
+        # games update a local engine only, the coordinator rates the whole batch
+        self.elo_engine = EloEngine({player.player_id: player.elo_score for player in self.players})
+
+        while True:
+            shard = db_claim_batch_shard(self.conn, self.batch_id, self.worker_id, BATCH_STALE_SECONDS)
+            if shard == None:
+                break
+
+            shard_id, pairings, attempts = shard
+            print(f"Playing shard {shard_id} of batch {self.batch_id} ({len(pairings)} pairings)")
+            db_upload_message = self.play_shard(shard_id, pairings, attempts)
+            if db_upload_message != "OK":
+                return db_upload_message
+
+        return self.finalise_sharded_batch()
+
     def get_ai_move_from_fen(self, fen, bot_player):
         status = "OK"
+        move = None
 
         try:
             # get ai move, ai is always black
-            status, fen = self.play_chess("Human", bot_player, fen)
+            status, fen, move = self.play_chess("Human", bot_player, fen)
 
         except Exception as e:
             print("Error:", str(e))
             status = str(e)
 
-        return status, fen
-
+        return status, fen, move
 
-    def bot_move(self, bot_player_id, fen):
 
-        db_check_message = "OK"
-        # get locally saved model path
-        filename = f"{bot_player_id}.h5"
-        model_path = os.path.join(os.path.join(os.getcwd(), "final_models"), filename)
+    def load_bot_player(self, bot_player_id, model_hash):
+        """
+        Loads bot's model from the local model store (downloading if missing) as a Player,
+        ingesting it on first use (model_artifacts.py)
+        Returns -> db_check_message, bot_player | db_check_message, None
+        """
+        bot_player = None
 
         try:
-            # try locate model locally
-            #with open(model_path, 'rb') as f:
-            #if os.path.isfile(model_path):
-            if not os.path.exists('final_models'):
-                os.makedirs('final_models')
-            bot_model = keras.models.load_model(model_path)
-            print("Loaded model")
+            # get locally stored model for the bot's current model_hash (downloads if missing)
+            db_check_message, model_hash, model_path = get_model_path(self.conn, bot_player_id, model_hash)
+            if db_check_message == "OK":
+                bot_player = Player(bot_player_id, None, None, None, None)
+                if MODEL_ARTIFACTS:
+                    # dense models are evaluated from their ingested weights, never parsed again
+                    with MODEL_LOAD_SECONDS.time(source="botmove"):
+                        ingest_message, artifact, bot_player.model = ingest_model(model_path, model_hash)
+                    if artifact != None:
+                        bot_player.evaluator = artifact.evaluator
+                if bot_player.model == None and bot_player.evaluator == None:
+                    with MODEL_LOAD_SECONDS.time(source="botmove"):
+                        bot_player.model = keras.models.load_model(model_path)
+                bot_player.model_path = model_path # root search workers load it from here
+                bot_player.model_hash = model_hash
+                bot_player.colour = "black"
+                if bot_player.evaluator == None:
+                    self.prepare_evaluator(bot_player)
+                print("Loaded model")
+            else:
+                print("Error loading bot model from db:", db_check_message)
         except Exception as e:
             print(str(e))
-            # download model and save locally
-            with open(model_path, 'wb') as f:
-                # get bot_player_id model
-                db_check_message, binary_bot_model = db_get_player_model(self.conn, bot_player_id)
-                #print(binary_bot_model)
-                if db_check_message == "OK":
-                    f.write(binary_bot_model)
-                    #pickle.dump(pickled_bot_model, f, pickle.HIGHEST_PROTOCOL)
-                    bot_model = keras.models.load_model(model_path)
-                else:
-                    print("Error loading bot model from db:", db_check_message)
+            db_check_message = str(e)
 
+        return db_check_message, bot_player
 
-        # do something to the fen
-        if db_check_message == "OK":
-            player_id = bot_player_id
-            status_flag = 2
-            bot_player = Player(bot_player_id, None, None, None, None)
-            bot_player.model = bot_model
-            bot_player.colour = "black"
 
-            status, fen = self.get_ai_move_from_fen(fen, bot_player)
+    def register_player_model(self, player_id, model_bytes=None):
+        """
+        Stores given -> model_bytes (.h5 file) as player's model if given, then ingests the
+        player's stored model: validated once and precompiled into its artifact (model_artifacts.py)
+        Models registered by link are ingested by the first batch downloading them
+        Returns -> status ("OK" | why the model was rejected)
+        """
+        if model_bytes != None:
+            db_upload_message = db_update_player_model(self.conn, player_id, model_bytes)
+            if db_upload_message != "OK":
+                return db_upload_message
 
+        # the db hashes the new blob, fetch it into the model store by that hash
+        db_check_message, model_hash, model_path = get_model_path(self.conn, player_id)
+        if db_check_message != "OK":
+            return db_check_message
+
+        ingest_message, artifact, model = ingest_model(model_path, model_hash)
+        if ingest_message != "OK":
+            return ingest_message
+        return artifact.validation_message
 
-            if status == "OK":
-                print("Move OK")
-            else:
-                # Error or game already completed
-                print("Error:", status)
 
-            return status, fen
+    def bot_move(self, bot_player_id, fen, session_id=None):
+        """
+        Returns the bot's reply to the human's latest move.
+        Continues the in-memory game session_id if still live (only the human's
+        move is applied and the bot's search state is reused), otherwise starts
+        a new session from fen.
+        Returns -> status, fen, session_id
+        """
+        session = None
+        if session_id != None:
+            session = bot_sessions.get(session_id, bot_player_id)
 
-        return db_check_message, fen
+        if session == None:
+            db_check_message, session = self.start_bot_session(bot_player_id, fen)
+            if db_check_message != "OK":
+                return db_check_message, fen, None
+
+        with session.lock:
+            # human has moved, stop pondering the previous position
+            session.ponder_generation += 1
+
+            try:
+                board = session.sync_board(fen)
+            except ValueError as e: # invalid fen
+                return str(e), fen, session.session_id
+
+            if board.is_game_over():
+                status = "Error"
+                # error: stop playing
+                return status, fen, session.session_id
+
+            # answer straight from the reply cache if this position was seen before
+            move = bot_move_cache.get(bot_player_id, session.model_hash, board, MINIMAX_DEPTH)
+            if move != None and move in board.legal_moves:
+                board.push(move)
+                print("Move OK (cached)")
+                if BOT_PONDER:
+                    ponderer.start(session, MINIMAX_DEPTH)
+                return "OK", board.fen(), session.session_id
+
+            if session.bot_player == None:
+                db_check_message, session.bot_player = self.load_bot_player(bot_player_id, session.model_hash)
+                if db_check_message != "OK":
+                    return db_check_message, fen, session.session_id
+                bot_sessions.share_bot_player(session.model_hash, session.bot_player)
+
+            try:
+                with MOVE_SECONDS.time(source="botmove"):
+                    move = root_search.get_move(board, MINIMAX_DEPTH, session.bot_player, session.table)
+            except Exception as e:
+                print("Error getting move from bot:", str(e))
+                # error: stop playing
+                return str(e), fen, session.session_id
+
+            bot_move_cache.put(bot_player_id, session.model_hash, board, MINIMAX_DEPTH, move)
+            board.push(move)
+            print("Move OK")
+
+            # search the human's likely replies while they think
+            if BOT_PONDER:
+                ponderer.start(session, MINIMAX_DEPTH)
+
+            return "OK", board.fen(), session.session_id
+
+
+    def start_bot_session(self, bot_player_id, fen):
+        """
+        Starts a new human vs. bot session for the bot's current model version.
+        The model is shared with live sessions of the same version, otherwise
+        loaded on the first move not answered from the reply cache.
+        Returns -> db_check_message, session | db_check_message, None
+        """
+        # bring db schema up to date (model_hash column)
+        db_check_message = run_migrations(self.conn)
+        if db_check_message != "OK":
+            return db_check_message, None
+
+        # bot's current model version
+        db_check_message, model_hash = db_get_player_model_hash(self.conn, bot_player_id)
+        if db_check_message != "OK":
+            print("Error loading bot model from db:", db_check_message)
+            return db_check_message, None
+
+        try:
+            bot_player = bot_sessions.get_bot_player(model_hash) # None if not loaded
+            session = bot_sessions.create(bot_player_id, model_hash, bot_player, fen)
+        except ValueError as e: # invalid fen
+            return str(e), None
+
+        print(f"Started session {session.session_id} with bot: {bot_player_id}")
+        return db_check_message, session
+
+
+    def prewarm_bot_cache(self, bot_player_id):
+        """
+        Plays out the common opening tree for a bot, caching its reply to every
+        position so human games through these openings are answered from cache.
+        Returns -> status
+        """
+        migrate_message = run_migrations(self.conn)
+        if migrate_message != "OK":
+            return migrate_message
+
+        db_check_message, model_hash = db_get_player_model_hash(self.conn, bot_player_id)
+        if db_check_message != "OK":
+            return db_check_message
+
+        db_check_message, bot_player = self.load_bot_player(bot_player_id, model_hash)
+        if db_check_message != "OK":
+            return db_check_message
+
+        num_positions = 0
+        positions = iter_prewarm_positions()
+        try:
+            board = next(positions)
+            while True:
+                move = bot_move_cache.get(bot_player_id, model_hash, board, MINIMAX_DEPTH)
+                if move == None:
+                    status, new_fen, move = self.get_ai_move_from_fen(board.fen(), bot_player)
+                    if status == "OK":
+                        bot_move_cache.put(bot_player_id, model_hash, board, MINIMAX_DEPTH, move)
+                    else:
+                        move = None
+                num_positions += 1
+                board = positions.send(move)
+        except StopIteration:
+            pass
+
+        print(f"Pre-warmed {num_positions} positions for bot {bot_player_id}")
+        return "OK"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,63 @@
+# Classes to support heartbeats of running batches.
+#
+# A batch whose heartbeat is older than BATCH_STALE_SECONDS is taken to be
+# interrupted and is resumed by the next game master (likewise a claimed shard
+# of a sharded batch is claimed by another game master). Heartbeats used to be
+# written only when a match was uploaded, so a batch whose games outlasted the
+# stale time looked stopped while it was still being played. A Heartbeat thread
+# writes one every BATCH_HEARTBEAT_SECONDS for as long as its game master is
+# playing, however long its games take.
+
+import os
+import threading
+
+
+BATCH_HEARTBEAT_SECONDS = float(os.environ.get("BATCH_HEARTBEAT_SECONDS", 60))
+
+
+class Heartbeat:
+    """
+    Calls given -> beat (returning "OK" or an error str) every interval seconds on its
+    own thread, from start() until stop(). Usable as a context manager
+    """
+    def __init__(self, beat, interval=BATCH_HEARTBEAT_SECONDS):
+        self.beat = beat
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name="heartbeat", daemon=True)
+        self.thread.start()
+        return self
+
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                beat_message = self.beat()
+            except Exception as e:
+                beat_message = str(e)
+            if beat_message != "OK": # keep beating, the next one may get through
+                print("Error writing heartbeat:", beat_message)
+
+
+    def stop(self):
+        """
+        Stops beating, returns once a beat in progress is written
+        """
+        self.stopped.set()
+        if self.thread != None:
+            self.thread.join()
+            self.thread = None
+
+
+    def __enter__(self):
+        return self.start()
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
@@ -2,6 +2,8 @@ from db_connect import *
 from db_access import *
 from secure import *
 from game_master import *
+from move_queue import bot_move_queue, QueueFull
+from metrics import registry, CONTENT_TYPE
 #from send_email import *
 
 
@@ -25,9 +27,13 @@ def game_master_run_games():
     """
     Launches chess game master and runs games, uploads player and match data into db
     Receives -> launch_key and launches if validated against secret
-    Returns -> nothing
+    Optionally receives -> profile=1 to write a profile of the batch
+    Optionally receives -> sharded=1 to split the batch into shards other instances can play (/playshards)
+    Optionally receives -> dry_run=1 (with workers, depth & instances) to only simulate the batch
+    Returns -> nothing | predicted makespan, peak memory & db writes of a dry run
     """
     launch_status = "NOT OK"
+    dry_run = False
 
     try:
         # try validate call to rungames
@@ -40,7 +46,13 @@ def game_master_run_games():
         with db.connect() as conn:
             chess_game_master = ChessGameMaster(conn)
 
-            launch_status = chess_game_master.run_games()
+            profile = request.values.get("profile", "0") == "1"
+            sharded = request.values.get("sharded", "1" if SHARDED_BATCHES else "0") == "1"
+            dry_run = request.values.get("dry_run", "0") == "1"
+            workers = int(request.values.get("workers", BATCH_GAME_WORKERS))
+            depth = int(request.values.get("depth", MINIMAX_DEPTH))
+            instances = int(request.values.get("instances", 1))
+            launch_status = chess_game_master.run_games(profile, sharded, dry_run, workers, depth, instances)
             conn.close()
             #threading.Thread(target=chess_game_master.run).start()
 
@@ -48,6 +60,49 @@ def game_master_run_games():
         print("Error launching game master:", str(e))
         launch_status = str(e)
 
+    if launch_status == "OK" and dry_run:
+        data = {'message': 'Simulated', 'code': 'SUCCESS', 'payload':chess_game_master.simulation_report}
+        status_code = 200
+    elif launch_status == "OK":
+        data = {'message': 'Launched', 'code': 'SUCCESS', 'payload':"OK"}
+        status_code = 201
+    else:
+        data = {'message': 'Failed', 'code': 'FAIL', 'payload':launch_status}
+        status_code = 500
+
+    response = make_response(jsonify(data), status_code)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+
+# on scheduler call join the running sharded batch and play shards until none are left
+@app.route("/playshards", methods=["POST"]) # POST
+def game_master_play_shards():
+    """
+    Claims and plays shards of the running sharded batch, uploads player and match data into db
+    The instance finishing the last shard finalises the batch
+    Receives -> launch_key and launches if validated against secret
+    Returns -> nothing
+    """
+    launch_status = "NOT OK"
+
+    try:
+        launch_key = request.headers.get("Authorisation")
+
+        if launch_key != os.environ["LAUNCH_KEY"]:
+            raise Exception("Launch key is invalid.")
+
+        db = connect_to_db()
+        with db.connect() as conn:
+            chess_game_master = ChessGameMaster(conn)
+            launch_status = chess_game_master.run_sharded_batch(create=False)
+            conn.close()
+
+    except Exception as e:
+        print("Error launching game master:", str(e))
+        launch_status = str(e)
+
     if launch_status == "OK":
         data = {'message': 'Launched', 'code': 'SUCCESS', 'payload':"OK"}
         status_code = 201
@@ -61,13 +116,58 @@ def game_master_run_games():
 
 
 
+# on admin call recalculate every player's elo from the full match history
+@app.route("/recalculateelo", methods=["POST"]) # POST
+def game_master_recalculate_elo():
+    """
+    Replays all matches through the elo engine and uploads recomputed player elo scores
+    Receives -> launch_key and launches if validated against secret
+    Returns -> nothing
+    """
+    launch_status = "NOT OK"
+
+    try:
+        launch_key = request.headers.get("Authorisation")
+
+        if launch_key != os.environ["LAUNCH_KEY"]:
+            raise Exception("Launch key is invalid.")
+
+        db = connect_to_db()
+        with db.connect() as conn:
+            chess_game_master = ChessGameMaster(conn)
+
+            launch_status = chess_game_master.recalculate_elo_scores()
+            conn.close()
+
+    except Exception as e:
+        print("Error recalculating elo:", str(e))
+        launch_status = str(e)
+
+    if launch_status == "OK":
+        data = {'message': 'Recalculated', 'code': 'SUCCESS', 'payload':"OK"}
+        status_code = 201
+    else:
+        data = {'message': 'Failed', 'code': 'FAIL', 'payload':launch_status}
+        status_code = 500
+
+    response = make_response(jsonify(data), status_code)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+
 # on next move request relaunch user vs. bot match and return bot's next move
 @app.route("/botmove", methods=["POST"])
 def game_master_bot_move():
     """
     On bot move request launch user vs. bot and return bot's next move.
+    Receives -> bot_player_id, fen and optionally session_id of an ongoing game
+    Returns -> new fen and session_id to send with the next move
+    Moves are searched by a fixed worker pool, 429 + Retry-After if its queue is full
     """
     launch_status = "NOT OK"
+    session_id = None
+    retry_after = None
 
     data_dict = request.form.to_dict()
 
@@ -75,21 +175,113 @@ def game_master_bot_move():
         # try validate call to startgame
         bot_player_id = data_dict["bot_player_id"]
         fen = data_dict["fen"]
+        session_id = data_dict.get("session_id") # None for a new game
+
+        launch_status, fen, session_id = bot_move_queue.run(run_bot_move, bot_player_id, fen, session_id)
+
+    except QueueFull as e:
+        print("Bot move queue full, rejecting request")
+        launch_status = str(e)
+        retry_after = e.retry_after
+
+    except Exception as e:
+        print("Error launching game master:", str(e))
+        launch_status = str(e)
+
+    if launch_status == "OK":
+        data = {'message': 'Runned', 'code': 'SUCCESS', 'payload':fen, 'session_id':session_id}
+        status_code = 201
+    elif retry_after != None:
+        data = {'message': 'Busy', 'code': 'BUSY', 'payload':launch_status}
+        status_code = 429
+    else:
+        data = {'message': 'Failed', 'code': 'FAIL', 'payload':launch_status}
+        status_code = 500
+
+    response = make_response(jsonify(data), status_code)
+    response.headers["Content-Type"] = "application/json"
+    if retry_after != None:
+        response.headers["Retry-After"] = str(retry_after)
+    return response
+
+
+
+def run_bot_move(bot_player_id, fen, session_id):
+    """
+    Runs one bot move on a move queue worker
+    Returns -> launch_status, fen, session_id
+    """
+    db = connect_to_db()
+    with db.connect() as conn:
+        chess_game_master = ChessGameMaster(conn)
+
+        launch_status, fen, session_id = chess_game_master.bot_move(bot_player_id, fen, session_id)
+        conn.close()
+
+    return launch_status, fen, session_id
+
+
+
+# expose operational metrics in Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def game_master_metrics():
+    """
+    Returns all counters, gauges and histograms of this process
+    """
+    response = make_response(registry.render(), 200)
+    response.headers["Content-Type"] = CONTENT_TYPE
+    return response
+
+
+
+# return bot move queue depth, worker usage and wait time stats
+@app.route("/botmove/stats", methods=["GET"])
+def game_master_bot_move_stats():
+    """
+    Returns bot move queue stats (depth, busy workers, rejections, wait/service times)
+    """
+    data = {'message': 'Retrieved', 'code': 'SUCCESS', 'payload':bot_move_queue.stats()}
+
+    response = make_response(jsonify(data), 200)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+
+
+# on admin call pre-warm a bot's reply cache with its common opening positions
+@app.route("/prewarm", methods=["POST"]) # POST
+def game_master_prewarm():
+    """
+    Plays out the common opening tree for given bot and caches its replies
+    Receives -> launch_key and bot_player_id, launches if validated against secret
+    Returns -> nothing
+    """
+    launch_status = "NOT OK"
+
+    data_dict = request.form.to_dict()
+
+    try:
+        launch_key = request.headers.get("Authorisation")
+
+        if launch_key != os.environ["LAUNCH_KEY"]:
+            raise Exception("Launch key is invalid.")
+
+        bot_player_id = data_dict["bot_player_id"]
 
         db = connect_to_db()
         with db.connect() as conn:
             chess_game_master = ChessGameMaster(conn)
 
-            launch_status, fen = chess_game_master.bot_move(bot_player_id, fen)
+            launch_status = chess_game_master.prewarm_bot_cache(bot_player_id)
             conn.close()
-            #threading.Thread(target=chess_game_master.run).start()
 
     except Exception as e:
-        print("Error launching game master:", str(e))
+        print("Error pre-warming bot cache:", str(e))
         launch_status = str(e)
 
     if launch_status == "OK":
-        data = {'message': 'Runned', 'code': 'SUCCESS', 'payload':fen}
+        data = {'message': 'Pre-warmed', 'code': 'SUCCESS', 'payload':"OK"}
         status_code = 201
     else:
         data = {'message': 'Failed', 'code': 'FAIL', 'payload':launch_status}
@@ -101,6 +293,77 @@ def game_master_bot_move():
 
 
 
+# on model upload store the player's model and ingest it (validated once, precompiled artifact)
+@app.route("/uploadmodel", methods=["POST"]) # POST
+def game_master_upload_model():
+    """
+    Stores a player's uploaded model (if a model file is sent) and ingests their stored model
+    Receives -> launch_key and player_id, optionally model (.h5 file), launches if validated against secret
+    Returns -> nothing
+    """
+    launch_status = "NOT OK"
+
+    data_dict = request.form.to_dict()
+
+    try:
+        launch_key = request.headers.get("Authorisation")
+
+        if launch_key != os.environ["LAUNCH_KEY"]:
+            raise Exception("Launch key is invalid.")
+
+        player_id = int(data_dict["player_id"])
+        model_file = request.files.get("model")
+        model_bytes = model_file.read() if model_file != None else None
+
+        db = connect_to_db()
+        with db.connect() as conn:
+            chess_game_master = ChessGameMaster(conn)
+
+            launch_status = chess_game_master.register_player_model(player_id, model_bytes)
+            conn.close()
+
+    except Exception as e:
+        print("Error ingesting model:", str(e))
+        launch_status = str(e)
+
+    if launch_status == "OK":
+        data = {'message': 'Ingested', 'code': 'SUCCESS', 'payload':"OK"}
+        status_code = 201
+    else:
+        data = {'message': 'Failed', 'code': 'FAIL', 'payload':launch_status}
+        status_code = 500
+
+    response = make_response(jsonify(data), status_code)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
+
+
+# return leaderboard from the incrementally maintained summary table
+@app.route("/leaderboard", methods=["GET"])
+def game_master_leaderboard():
+    """
+    Returns players ranked by elo_score with their match summary
+    Reads O(players) rows, never the whole matches table
+    """
+    try:
+        db = connect_to_db()
+        with db.connect() as conn:
+            leaderboard = db_retrieve_leaderboard(conn)
+            conn.close()
+
+        data = {'message': 'Retrieved', 'code': 'SUCCESS', 'payload':leaderboard}
+        status_code = 200
+
+    except Exception as e:
+        print("Error retrieving leaderboard:", str(e))
+        data = {'message': 'Failed', 'code': 'FAIL', 'payload':str(e)}
+        status_code = 500
+
+    response = make_response(jsonify(data), status_code)
+    response.headers["Content-Type"] = "application/json"
+    return response
+
 
 
 def main():
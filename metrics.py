@@ -0,0 +1,243 @@
+# Functions and classes to support exposing operational metrics.
+#
+# Minimal in-process counters, gauges and histograms rendered in the
+# Prometheus text exposition format by the /metrics endpoint. Everything is
+# kept in memory (no external service) and each update is one lock and a few
+# additions, so metrics stay on in production.
+
+import bisect
+import functools
+import inspect
+import threading
+import time
+
+
+# latency buckets in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def format_labels(label_names, label_values, extra=()):
+    pairs = list(zip(label_names, label_values)) + list(extra)
+    if len(pairs) == 0:
+        return ""
+    escaped = [(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for name, value in pairs]
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    """
+    Base of all metrics: a name, help text, label names and a value per label set
+    Counters and gauges can instead be read from a function when rendered
+    (returns value, or {label values tuple: value} if labelled)
+    """
+    metric_type = None
+
+    def __init__(self, name, help, label_names=(), function=None):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(label_names)
+        self.function = function
+        self.lock = threading.Lock()
+        self.values = {} # label values tuple -> value
+        registry.register(self)
+
+
+    def label_key(self, labels):
+        return tuple(str(labels.get(name, "")) for name in self.label_names)
+
+
+    def render(self):
+        if self.function != None:
+            value = self.function()
+            with self.lock:
+                if isinstance(value, dict):
+                    self.values = dict(value)
+                else:
+                    self.values = {(): value}
+
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            items = sorted(self.values.items())
+        for label_values, value in items:
+            lines.append(f"{self.name}{format_labels(self.label_names, label_values)} {format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    """
+    Value that only goes up
+    """
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that goes up and down, or is read from a function when rendered
+    """
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = value
+
+
+    def inc(self, amount=1, **labels):
+        key = self.label_key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """
+    Distribution of observed values in cumulative buckets, with sum and count
+    """
+    metric_type = "histogram"
+
+    def __init__(self, name, help, label_names=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, help, label_names)
+
+
+    def observe(self, value, **labels):
+        key = self.label_key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts == None:
+                counts = [0] * (len(self.buckets) + 1) + [0.0] # bucket counts, +Inf count, sum
+                self.values[key] = counts
+            counts[index] += 1
+            counts[-1] += value
+
+
+    def time(self, **labels):
+        """
+        Returns context manager observing the seconds spent in its block
+        """
+        return Timer(self, labels)
+
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.metric_type}"]
+        with self.lock:
+            items = sorted((key, list(counts)) for key, counts in self.values.items())
+        for label_values, counts in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts[:-1]):
+                cumulative += count
+                labels = format_labels(self.label_names, label_values, (("le", format_value(bound)),))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.label_names, label_values)
+            lines.append(f"{self.name}_sum{labels} {format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+
+class Registry:
+    """
+    All metrics of this process, rendered together
+    """
+    def __init__(self):
+        self.metrics = []
+        self.lock = threading.Lock()
+
+
+    def register(self, metric):
+        with self.lock:
+            self.metrics.append(metric)
+
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text exposition format
+        """
+        with self.lock:
+            metrics = list(self.metrics)
+        lines = []
+        for metric in metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def timed(histogram, **labels):
+    """
+    Decorator observing each call's duration in given -> histogram
+    For generator functions the time spent producing items is summed and
+    observed once the generator finishes
+    """
+    def decorator(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generator_wrapper(*args, **kwargs):
+                elapsed = 0.0
+                generator = function(*args, **kwargs)
+                try:
+                    while True:
+                        start = time.perf_counter()
+                        try:
+                            item = next(generator)
+                        finally:
+                            elapsed += time.perf_counter() - start
+                        yield item
+                except StopIteration:
+                    pass
+                finally:
+                    generator.close()
+                    histogram.observe(elapsed, **labels)
+            return generator_wrapper
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+## metrics shared across modules
+
+GAMES_PLAYED = Counter("chess_games_total", "Matches recorded by batch games, by match status_flag.", ("status_flag",))
+MOVE_SECONDS = Histogram("chess_move_seconds", "Time to choose one bot move (search including inference).", ("source",))
+INFERENCE_SECONDS = Histogram("chess_inference_seconds", "Time of one model evaluation call.")
+MODEL_LOAD_SECONDS = Histogram("chess_model_load_seconds", "Time to load a keras model from file.", ("source",))
+MODEL_STORE_REQUESTS = Counter("chess_model_store_requests_total", "Local model store lookups by result (hit, download).", ("result",))
+DB_QUERY_SECONDS = Histogram("chess_db_query_seconds", "Time spent in each db_access function.", ("function",))
+ACTIVE_THREADS = Gauge("chess_active_threads", "Threads alive in this process.", function=threading.active_count)
@@ -0,0 +1,167 @@
+# Functions and classes to support ingesting player models into precompiled artifacts.
+#
+# Parsing a keras .h5 model and validating it takes seconds and used to be paid
+# by every batch and every bot session loading the model. A model is ingested
+# once, when it is uploaded (/uploadmodel) or first seen by a batch or a bot:
+# it is validated and the result stored as an artifact named by the model's
+# hash (sha256 of the .h5, as players.model_hash) and ARTIFACT_VERSION, so a new
+# upload or a new artifact format is ingested afresh:
+#   - models the dense evaluator runs (dense_eval.py) are stored as a numpy
+#     weight bundle, later loads build the evaluator from it and never parse
+#     the keras model
+#   - other models only keep their validation (their .h5 is still loaded)
+#   - invalid models keep why, so they aren't loaded again
+# Artifacts are written to a temporary file and renamed into place, like the
+# model store's models, and kept within MODEL_ARTIFACT_MAX_BYTES by evicting
+# the least recently used (an evicted model is ingested again when next seen).
+
+import hashlib
+import json
+import numpy
+import os
+import tempfile
+from model_store import MODEL_STORE_DIR, touch_model, evict_models
+from model_validation import validate_model
+from dense_eval import DenseEvaluator, build_dense_evaluator, DENSE_EVALUATOR
+from model_groups import architecture_fingerprint
+from metrics import MODEL_LOAD_SECONDS
+
+
+# "0" loads and validates keras models as before
+MODEL_ARTIFACTS = os.environ.get("MODEL_ARTIFACTS", "1") == "1"
+MODEL_ARTIFACT_DIR = os.environ.get("MODEL_ARTIFACT_DIR", os.path.join(MODEL_STORE_DIR, "artifacts"))
+MODEL_ARTIFACT_MAX_BYTES = int(os.environ.get("MODEL_ARTIFACT_MAX_BYTES", 1024 ** 3)) # 1 GiB, on top of the model store's
+
+ARTIFACT_VERSION = 1 # bump when the artifact format or the dense conversion changes
+ARTIFACT_SUFFIX = ".npz"
+HASH_CHUNK_SIZE = 1024 ** 2
+
+
+class ModelArtifact:
+    """
+    Ingested model: its validation and dense evaluator (if the model has one)
+    """
+    def __init__(self, model_hash, validation_message, latency, evaluator=None):
+        self.model_hash = model_hash
+        self.validation_message = validation_message # "OK" or why the model is invalid
+        self.latency = latency # seconds per evaluation of the keras model (None if invalid)
+        self.evaluator = evaluator
+
+
+def file_hash(path):
+    """
+    Returns sha256 hex of file at given -> path (same as players.model_hash of its blob)
+    """
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def artifact_path(model_hash):
+    return os.path.join(MODEL_ARTIFACT_DIR, f"{model_hash}-v{ARTIFACT_VERSION}{ARTIFACT_SUFFIX}")
+
+
+def write_artifact(model_hash, validation_message, latency, evaluator=None):
+    """
+    Stores artifact of model with given -> model_hash, validation and dense evaluator
+    Returns -> message
+    """
+    info = {"validation_message": validation_message, "latency": latency}
+    arrays = {}
+    if evaluator != None:
+        info["activation"] = evaluator.activation_name
+        info["fingerprint"] = evaluator.fingerprint
+        info["steps"] = []
+        arrays["kernel"] = numpy.concatenate([evaluator.piece_kernel, evaluator.attack_kernel])
+        arrays["bias"] = evaluator.bias
+        for i, step in enumerate(evaluator.steps):
+            if step[0] == "activation":
+                info["steps"].append(["activation", step[1]])
+            else:
+                info["steps"].append([step[0]])
+                arrays[f"step_{i}_weights"], arrays[f"step_{i}_bias"] = step[1], step[2]
+
+    try:
+        os.makedirs(MODEL_ARTIFACT_DIR, exist_ok=True)
+        temp_fd, temp_path = tempfile.mkstemp(dir=MODEL_ARTIFACT_DIR, suffix=".part")
+        try:
+            with os.fdopen(temp_fd, "wb") as f:
+                numpy.savez(f, info=numpy.array(json.dumps(info)), **arrays)
+            os.replace(temp_path, artifact_path(model_hash))
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        evict_models(keep=artifact_path(model_hash), directory=MODEL_ARTIFACT_DIR,
+                     suffix=ARTIFACT_SUFFIX, max_bytes=MODEL_ARTIFACT_MAX_BYTES)
+        return "OK"
+    except Exception as e:
+        return str(e)
+
+
+def load_artifact(model_hash):
+    """
+    Loads artifact of model with given -> model_hash (its evaluator only if DENSE_EVALUATOR is set)
+    Returns -> ModelArtifact | None if the model isn't ingested
+    """
+    path = artifact_path(model_hash)
+    if not os.path.exists(path):
+        return None
+    touch_model(path)
+
+    try:
+        with numpy.load(path, allow_pickle=False) as bundle:
+            info = json.loads(str(bundle["info"]))
+            evaluator = None
+            if "kernel" in bundle and DENSE_EVALUATOR:
+                steps = []
+                for i, step in enumerate(info["steps"]):
+                    if step[0] == "activation":
+                        steps.append(("activation", step[1]))
+                    else:
+                        steps.append((step[0], bundle[f"step_{i}_weights"], bundle[f"step_{i}_bias"]))
+                evaluator = DenseEvaluator(bundle["kernel"], bundle["bias"], info["activation"], steps)
+                evaluator.fingerprint = info["fingerprint"]
+    except Exception as e:
+        print(f"Error loading model artifact {model_hash[:8]}:", str(e))
+        return None
+
+    return ModelArtifact(model_hash, info["validation_message"], info["latency"], evaluator)
+
+
+def ingest_model(model_path, model_hash=None, model=None):
+    """
+    Validates model at given -> model_path (or the already loaded keras model) and stores its
+    artifact, unless it is already ingested. model_hash is taken from the file unless given
+    Returns -> message, ModelArtifact | None, keras model if it was loaded | None
+    """
+    if model_hash == None:
+        model_hash = file_hash(model_path)
+
+    artifact = load_artifact(model_hash)
+    if artifact != None:
+        return "OK", artifact, model
+
+    if model == None:
+        from tensorflow import keras
+        try:
+            with MODEL_LOAD_SECONDS.time(source="ingest"):
+                model = keras.models.load_model(model_path)
+        except Exception as e:
+            return f"Model can't be loaded: {str(e)}", None, None
+
+    validation_message, latency = validate_model(model)
+    evaluator = None
+    if validation_message == "OK":
+        evaluator_message, evaluator = build_dense_evaluator(model)
+        if evaluator != None:
+            evaluator.fingerprint = architecture_fingerprint(model)
+
+    write_message = write_artifact(model_hash, validation_message, latency, evaluator)
+    if write_message != "OK":
+        print(f"Error storing model artifact {model_hash[:8]}:", write_message)
+    else:
+        print(f"Ingested model {model_hash[:8]}" + (" (dense weights)" if evaluator != None else ""))
+
+    return "OK", ModelArtifact(model_hash, validation_message, latency, evaluator), model
@@ -0,0 +1,89 @@
+# Functions to support sharing evaluators between players whose models are the same.
+#
+# Students often submit the same architecture (a tutorial's), and sometimes the
+# very same trained model, and each model used to stay loaded as its own keras
+# graph. Players with a dense evaluator (dense_eval.py) don't need their keras
+# model during games, so it is released, and players are grouped by a
+# fingerprint of their model's architecture and then by a hash of its weights:
+#   - players whose weights are identical share one evaluator (and its arrays),
+#     so a duplicated model is held in memory once
+#   - models differing in weights keep their own evaluator, evaluations stay
+#     one position of one player per call as search makes them
+#   - the fingerprint is taken when the evaluator is built, so models can be
+#     released (model_lifecycle.py) before the players are grouped
+# A shared evaluator is stateless (accumulators live on the boards), so
+# players in concurrent games can use it at once.
+# Weights of models that only share an architecture are not stacked into one
+# vectorised pass: search asks for one position of one player at a time, so a
+# stacked pass would have to gather positions from concurrent games across
+# threads, and handing a position to another thread costs more than the tens
+# of microseconds a dense evaluation takes.
+
+import hashlib
+import json
+import numpy
+import os
+
+
+# "0" keeps every player's model and evaluator separate
+MODEL_GROUPS = os.environ.get("MODEL_GROUPS", "1") == "1"
+
+# layer config keys which don't change what a trained layer computes
+IGNORED_CONFIG_KEYS = {"name", "trainable", "kernel_initializer", "bias_initializer", "kernel_regularizer",
+                       "bias_regularizer", "activity_regularizer", "kernel_constraint", "bias_constraint",
+                       "beta_initializer", "gamma_initializer", "moving_mean_initializer", "moving_variance_initializer",
+                       "beta_regularizer", "gamma_regularizer", "beta_constraint", "gamma_constraint", "seed", "build_config"}
+
+
+def architecture_fingerprint(model):
+    """
+    Returns hash of given -> keras model's layers (types, configs and weight shapes), same for models
+    differing only in weights and layer names
+    """
+    layers = []
+    for layer in model.layers:
+        config = {key: value for key, value in layer.get_config().items() if key not in IGNORED_CONFIG_KEYS}
+        layers.append([layer.__class__.__name__, config, [list(weight.shape) for weight in layer.weights]])
+    return hashlib.sha1(json.dumps(layers, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def weights_hash(evaluator):
+    """
+    Returns hash of given -> dense evaluator's weights (and activations)
+    """
+    sha1 = hashlib.sha1(evaluator.activation_name.encode())
+    for array in (evaluator.piece_kernel, evaluator.attack_kernel, evaluator.bias):
+        sha1.update(numpy.ascontiguousarray(array).tobytes())
+    for step in evaluator.steps:
+        sha1.update(step[0].encode())
+        for part in step[1:]:
+            sha1.update(part.encode() if isinstance(part, str) else numpy.ascontiguousarray(part).tobytes())
+    return sha1.hexdigest()
+
+
+def group_players(players):
+    """
+    Releases the keras model of given -> players with a dense evaluator and makes players
+    whose models have the same architecture and weights share one evaluator
+    Returns -> [[players sharing an evaluator],...] (groups of more than one player)
+    """
+    if not MODEL_GROUPS:
+        return []
+
+    by_model = {}
+    for player in players:
+        if player.evaluator == None or player.evaluator.fingerprint == None:
+            continue
+        player.model = None # evaluated by its evaluator, keras model isn't needed
+        key = (player.evaluator.fingerprint, weights_hash(player.evaluator))
+        by_model.setdefault(key, []).append(player)
+
+    groups = []
+    for members in by_model.values():
+        if len(members) < 2:
+            continue
+        for player in members[1:]:
+            player.evaluator = members[0].evaluator
+        groups.append(members)
+
+    return groups
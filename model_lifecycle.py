@@ -0,0 +1,232 @@
+# Functions and classes to support keeping few player models loaded during a batch.
+#
+# Keeping every model loaded from validation until the batch ends makes the
+# batch's peak memory the sum of all its models. With MODEL_LIFECYCLE a model is
+# released once validated and loaded again just before its player's first
+# game. The lifecycle manager counts each player's remaining scheduled games
+# and releases the model after the last one (clearing the keras session state
+# once no model is loaded).
+# Games keep the scheduler's longest first order, which gives the shortest
+# batch; the trade-off is that a player's last game can come anywhere in the
+# batch, so models are released later than they could be. MAX_RESIDENT_MODELS
+# trades makespan for memory instead: it caps the loaded models (past it, an
+# idle model whose next game is furthest away is released early and loaded
+# again when needed) and games are ordered in waves, one per player, so players
+# finish and are released one after another. Waves start with the players with
+# the most estimated game time and each wave plays longest first, so long games
+# still start early, but a short wave can leave workers idle at its end.
+# Players with a dense evaluator (dense_eval.py) play without their keras model,
+# their evaluator is dropped after their last game instead (an evaluator shared
+# by identical models, model_groups.py, is freed once the last of them finishes).
+# A model is only released while none of its player's games is running (checked
+# under the player's lock, which loads hold) and the keras session is only
+# cleared while no model is loaded or being loaded.
+# Resident memory is sampled at every load/release and its peak reported per batch.
+
+import gc
+import os
+import threading
+from metrics import Gauge
+from tensorflow import keras
+
+
+MODEL_LIFECYCLE = os.environ.get("MODEL_LIFECYCLE", "1") == "1"
+MAX_RESIDENT_MODELS = int(os.environ.get("MAX_RESIDENT_MODELS", 0)) # 0: no cap
+
+BATCH_PEAK_RSS_BYTES = Gauge("chess_batch_peak_rss_bytes", "Peak resident memory sampled during the last batch's games.")
+RESIDENT_MODELS = Gauge("chess_resident_models", "Player models loaded for batch games.")
+
+
+def current_rss():
+    """
+    Returns resident memory of this process in bytes (peak so far where /proc is unavailable)
+    """
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 # kilobytes on linux
+
+
+def order_games_in_waves(games):
+    """
+    Orders given -> games [(cost, player_1, player_2),...] in waves: players are ranked by the total cost
+    of their games, most first, and each game belongs to the wave of its first ranked player, longest first
+    Returns -> ordered games
+    """
+    player_costs = {}
+    for cost, player_1, player_2 in games:
+        for player in (player_1, player_2):
+            player_costs[player.player_id] = player_costs.get(player.player_id, 0) + cost
+    ranking = sorted(player_costs, key=lambda player_id: -player_costs[player_id]) # stable, ties keep first appearance
+    ranks = {player_id: rank for rank, player_id in enumerate(ranking)}
+
+    return sorted(games, key=lambda game: (min(ranks[game[1].player_id], ranks[game[2].player_id]), -game[0]))
+
+
+def order_lifecycle_games(games, max_resident=MAX_RESIDENT_MODELS):
+    """
+    Orders given -> games [(cost, player_1, player_2),...] to start under ModelLifecycle:
+    longest first, or in waves (order_games_in_waves) if max_resident caps the loaded models
+    Returns -> ordered games
+    """
+    if max_resident > 0:
+        return order_games_in_waves(games)
+    return sorted(games, key=lambda game: game[0], reverse=True)
+
+
+class ModelLifecycle:
+    """
+    Loads players' models before their first game of a schedule and releases them after their last
+    """
+    def __init__(self, games, load_model, max_resident=MAX_RESIDENT_MODELS):
+        self.load_model = load_model # function(player) loading player.model
+        self.max_resident = max_resident
+        self.lock = threading.Lock()
+        self.remaining = {} # player_id -> games left to finish
+        self.next_games = {} # player_id -> positions in games of games not started yet, ascending
+        self.game_positions = {} # (player_1_id, player_2_id) -> position in games
+        self.running = {} # player_id -> games in progress
+        self.player_locks = {} # player_id -> lock held while loading their model
+        self.resident = {} # player_id -> player whose model is loaded
+        self.loading = 0 # models being loaded (not resident yet)
+        self.peak_resident = 0
+        self.peak_rss = current_rss()
+
+        for position, (cost, player_1, player_2) in enumerate(games):
+            self.game_positions[(player_1.player_id, player_2.player_id)] = position
+            for player in (player_1, player_2):
+                self.remaining[player.player_id] = self.remaining.get(player.player_id, 0) + 1
+                self.next_games.setdefault(player.player_id, []).append(position)
+                self.running.setdefault(player.player_id, 0)
+                self.player_locks.setdefault(player.player_id, threading.Lock())
+                if player.model != None: # still loaded (e.g. lifecycle turned off during validation)
+                    self.resident[player.player_id] = player
+
+
+    def needs_model(self, player):
+        return player.evaluator == None and player.model_path != None
+
+
+    def acquire(self, player_1, player_2):
+        """
+        Marks game of given -> players started and loads their models if needed
+        """
+        with self.lock:
+            position = self.game_positions.get((player_1.player_id, player_2.player_id))
+            for player in (player_1, player_2):
+                self.running[player.player_id] += 1
+                if position in self.next_games[player.player_id]:
+                    self.next_games[player.player_id].remove(position)
+
+        for player in (player_1, player_2):
+            if self.needs_model(player):
+                with self.player_locks[player.player_id]:
+                    if player.model == None:
+                        self.make_room()
+                        with self.lock:
+                            self.loading += 1
+                        try:
+                            self.load_model(player)
+                        finally:
+                            with self.lock:
+                                self.loading -= 1
+                                if player.model != None:
+                                    self.resident[player.player_id] = player
+                                    self.peak_resident = max(self.peak_resident, len(self.resident))
+                                    RESIDENT_MODELS.set(len(self.resident))
+        self.sample_rss()
+
+
+    def release(self, player_1, player_2):
+        """
+        Marks game of given -> players finished, releasing models of players with no games left
+        """
+        self.sample_rss()
+        finished = []
+        with self.lock:
+            for player in (player_1, player_2):
+                self.running[player.player_id] -= 1
+                self.remaining[player.player_id] -= 1
+                if self.remaining[player.player_id] == 0:
+                    finished.append(player)
+
+        for player in finished:
+            player.evaluator = None
+            self.unload(player)
+
+
+    def make_room(self):
+        """
+        Releases an idle model (next game furthest away) if MAX_RESIDENT_MODELS are loaded
+        """
+        if self.max_resident <= 0:
+            return
+
+        with self.lock:
+            if len(self.resident) < self.max_resident:
+                return
+            idle = [player for player_id, player in self.resident.items() if self.running[player_id] == 0]
+            idle.sort(key=lambda player: self.next_games[player.player_id][0] if len(self.next_games[player.player_id]) > 0 else len(self.game_positions), reverse=True)
+
+        for player in idle:
+            # a worker holding the player's lock is loading it, or starting its game
+            player_lock = self.player_locks[player.player_id]
+            if not player_lock.acquire(blocking=False):
+                continue
+            try:
+                with self.lock:
+                    # a game may have started since, only release a model still idle
+                    if self.running[player.player_id] != 0 or player.player_id not in self.resident:
+                        continue
+                    self.remove_resident(player)
+            finally:
+                player_lock.release()
+            self.collect()
+            return
+        # every loaded model is playing, go over the cap rather than wait
+
+
+    def unload(self, player):
+        """
+        Releases given -> player's model, and the keras session state once no model is loaded
+        """
+        with self.player_locks[player.player_id]:
+            with self.lock:
+                self.remove_resident(player)
+        self.collect()
+
+
+    def remove_resident(self, player):
+        """
+        Drops given -> player's model (call with lock held)
+        """
+        player.model = None
+        self.resident.pop(player.player_id, None)
+        RESIDENT_MODELS.set(len(self.resident))
+
+
+    def collect(self):
+        """
+        Frees released models, clearing the keras session state if no model is loaded or being loaded
+        """
+        gc.collect()
+        with self.lock: # loads wait, so none starts while the session is cleared
+            if len(self.resident) == 0 and self.loading == 0:
+                keras.backend.clear_session()
+
+
+    def sample_rss(self):
+        rss = current_rss()
+        with self.lock:
+            self.peak_rss = max(self.peak_rss, rss)
+
+
+    def report(self):
+        """
+        Records and returns peak memory of the schedule's games -> report line
+        """
+        self.sample_rss()
+        BATCH_PEAK_RSS_BYTES.set(self.peak_rss)
+        return f"Peak RSS {self.peak_rss / 2 ** 20:.0f} MB, at most {self.peak_resident} models loaded"
@@ -0,0 +1,165 @@
+# Functions to support a local content-addressed store of player models.
+#
+# Models are saved as <model_hash>.h5 where model_hash is the players.model_hash
+# column (sha256 of the model blob), so a new upload is picked up automatically
+# and a stale file is never served. Blobs are streamed from the db in chunks to
+# a temporary file and atomically renamed into place, so concurrent requests
+# never read a half written model. The directory is kept under a size bound by
+# evicting least recently used models (model_artifacts.py bounds its artifacts
+# the same way).
+
+from db_access import *
+from metrics import MODEL_STORE_REQUESTS
+import hashlib
+import os
+import tempfile
+import threading
+
+
+MODEL_STORE_DIR = os.environ.get("MODEL_STORE_DIR", os.path.join(os.getcwd(), "final_models"))
+MODEL_STORE_MAX_BYTES = int(os.environ.get("MODEL_STORE_MAX_BYTES", 2 * 1024 ** 3)) # 2 GiB
+MODEL_CHUNK_SIZE = 1024 ** 2 # 1 MiB per db round trip
+
+MODEL_SUFFIX = ".h5"
+
+
+# one lock per model hash so each model is only downloaded once at a time,
+# model_hash -> [lock, requests using it], dropped when the last request is done
+store_lock = threading.Lock()
+download_locks = {}
+
+
+def get_model_path(conn, player_id, model_hash=None):
+    """
+    Returns local path to player's current model, downloading it into the store if missing
+    Player's model_hash is looked up in db unless given
+    Returns -> db_check_message, model_hash, model_path | db_check_message, None, None
+    """
+    db_check_message = "OK"
+    if model_hash == None:
+        db_check_message, model_hash = db_get_player_model_hash(conn, player_id)
+        if db_check_message != "OK":
+            return db_check_message, None, None
+
+    model_path = os.path.join(MODEL_STORE_DIR, model_hash + MODEL_SUFFIX)
+
+    if os.path.exists(model_path):
+        touch_model(model_path)
+        MODEL_STORE_REQUESTS.inc(result="hit")
+        return db_check_message, model_hash, model_path
+
+    download_lock = acquire_download_lock(model_hash)
+    try:
+        with download_lock:
+            # another request may have finished downloading while we waited
+            if not os.path.exists(model_path):
+                MODEL_STORE_REQUESTS.inc(result="download")
+                db_check_message = download_model_blob(conn, player_id, model_hash, model_path)
+                if db_check_message != "OK":
+                    return db_check_message, None, None
+                evict_models(keep=model_path)
+            else:
+                touch_model(model_path)
+                MODEL_STORE_REQUESTS.inc(result="hit")
+    finally:
+        release_download_lock(model_hash)
+
+    return db_check_message, model_hash, model_path
+
+
+def acquire_download_lock(model_hash):
+    """
+    Returns the lock guarding downloads of given -> model_hash, release_download_lock when done with it
+    """
+    with store_lock:
+        entry = download_locks.setdefault(model_hash, [threading.Lock(), 0])
+        entry[1] += 1
+        return entry[0]
+
+
+def release_download_lock(model_hash):
+    """
+    Drops the download lock of given -> model_hash once no request uses it
+    """
+    with store_lock:
+        entry = download_locks[model_hash]
+        entry[1] -= 1
+        if entry[1] == 0:
+            del download_locks[model_hash]
+
+
+def download_model_blob(conn, player_id, model_hash, model_path):
+    """
+    Streams player's model blob from db in chunks into model_path
+    Written to a temporary file first, checked against model_hash, then renamed into place
+    Returns -> db_check_message
+    """
+    db_check_message = "OK"
+
+    if not os.path.exists(MODEL_STORE_DIR):
+        os.makedirs(MODEL_STORE_DIR, exist_ok=True)
+
+    temp_fd, temp_path = tempfile.mkstemp(dir=MODEL_STORE_DIR, suffix=".part")
+    try:
+        sha256 = hashlib.sha256()
+        with os.fdopen(temp_fd, "wb") as f:
+            for chunk in db_iter_player_model_chunks(conn, player_id, MODEL_CHUNK_SIZE):
+                sha256.update(chunk)
+                f.write(chunk)
+            f.flush()
+            os.fsync(f.fileno())
+
+        if sha256.hexdigest() != model_hash:
+            # model was replaced mid download, next request will fetch the new one
+            db_check_message = "Model changed during download"
+            os.remove(temp_path)
+            return db_check_message
+
+        os.replace(temp_path, model_path) # atomic on the same filesystem
+        return db_check_message
+
+    except Exception as e:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        db_check_message = str(e)
+        return db_check_message
+
+
+def touch_model(model_path):
+    """
+    Marks model as recently used (mtime orders eviction)
+    """
+    try:
+        os.utime(model_path, None)
+    except OSError:
+        pass # evicted concurrently
+
+
+def evict_models(keep=None, directory=MODEL_STORE_DIR, suffix=MODEL_SUFFIX, max_bytes=MODEL_STORE_MAX_BYTES):
+    """
+    Removes least recently used files ending in suffix from directory until they are within max_bytes
+    (models of the store by default). Never removes given -> keep path
+    """
+    models = []
+    for filename in os.listdir(directory):
+        if not filename.endswith(suffix):
+            continue
+        path = os.path.join(directory, filename)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        models.append((stat.st_mtime, stat.st_size, path))
+
+    total_bytes = sum(size for _, size, _ in models)
+
+    for _, size, path in sorted(models):
+        if total_bytes <= max_bytes:
+            break
+        if path == keep:
+            continue
+        try:
+            os.remove(path) # open readers keep their file until closed
+            total_bytes -= size
+        except OSError:
+            pass
@@ -0,0 +1,84 @@
+# Functions to support validating player models before a batch is scheduled.
+#
+# Loading a model only proves the file is a keras model. Before any game is
+# scheduled each model is run on a fixed batch of encoded positions to check it
+# accepts the 14x8x8 board tensor and returns one finite evaluation per
+# position, then timed on single positions (how search calls it). The first
+# calls also warm up the model (graph tracing) so game moves don't pay for it.
+# Models slower than MODEL_LATENCY_BUDGET are throttled (one game at a time)
+# and models slower than MODEL_LATENCY_LIMIT are excluded from the batch.
+
+from search import split_dims
+from tf_config import evaluate_boards
+import chess
+import numpy
+import os
+import time
+
+
+MODEL_LATENCY_BUDGET = float(os.environ.get("MODEL_LATENCY_BUDGET", 0.1)) # seconds per evaluation, throttled above
+MODEL_LATENCY_LIMIT = float(os.environ.get("MODEL_LATENCY_LIMIT", 1.0)) # seconds per evaluation, excluded above
+MODEL_TIMING_RUNS = int(os.environ.get("MODEL_TIMING_RUNS", 5))
+
+# fixed positions every model is checked on (opening, middlegame, endgame, mates)
+VALIDATION_FENS = (
+    chess.STARTING_FEN,
+    "r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - 2 3",
+    "r1bq1rk1/pp2bppp/2n1pn2/2pp4/3P4/2PBPN2/PP1N1PPP/R2QK2R w KQ - 0 8",
+    "2r3k1/pp3ppp/4p3/3pP3/3P4/P4N2/1P3PPP/2R3K1 b - - 0 24",
+    "8/5pk1/6p1/8/3K4/8/5P2/8 w - - 0 45",
+    "8/8/8/4k3/8/8/4P3/4K3 w - - 0 60",
+    "rnb1kbnr/pppp1ppp/8/4p3/6Pq/5P2/PPPPP2P/RNBQKBNR w KQkq - 1 3",
+    "7k/6Q1/6K1/8/8/8/8/8 b - - 0 70",
+)
+
+# encoded once, shared by every validation
+validation_boards = None
+
+
+def get_validation_boards():
+    """
+    Returns validation positions encoded as one batch -> numpy array (positions, 14, 8, 8)
+    """
+    global validation_boards
+
+    if validation_boards is None:
+        validation_boards = numpy.stack([split_dims(chess.Board(fen)) for fen in VALIDATION_FENS])
+    return validation_boards
+
+
+def validate_model(model):
+    """
+    Checks model evaluates the validation positions (one finite value each), warms it up
+    and times single position evaluations
+    Returns -> validation_message, latency seconds (median evaluation) | None if invalid
+    """
+    boards = get_validation_boards()
+
+    # keras may reshape a same size input (e.g. 8x8x14) without complaint, which plays garbage
+    input_shape = getattr(model, "input_shape", None)
+    if isinstance(input_shape, tuple) and tuple(input_shape[1:]) != boards.shape[1:]:
+        return f"Model input shape {input_shape} should be (None, 14, 8, 8).", None
+
+    try:
+        evaluations = numpy.asarray(evaluate_boards(model, boards))
+    except Exception as e:
+        return f"Model can't evaluate board tensor: {str(e)}", None
+
+    if evaluations.ndim != 2 or evaluations.shape[0] != len(boards) or evaluations.shape[1] != 1:
+        return f"Model output shape {evaluations.shape} should be ({len(boards)}, 1).", None
+    if not numpy.all(numpy.isfinite(evaluations)):
+        return "Model output is not finite.", None
+
+    # search evaluates one position per call, time that (first call warms up)
+    single_board = boards[:1]
+    evaluate_boards(model, single_board)
+    timings = []
+    for i in range(MODEL_TIMING_RUNS):
+        start = time.perf_counter()
+        evaluate_boards(model, single_board)
+        timings.append(time.perf_counter() - start)
+        if timings[-1] > MODEL_LATENCY_LIMIT: # already too slow, stop timing it
+            break
+
+    return "OK", float(numpy.median(timings))
@@ -0,0 +1,190 @@
+# Functions and classes to support admission control of bot move requests.
+#
+# Bot move searches are CPU bound, so instead of letting every request thread
+# search at once (and slow down every request), requests are put on a bounded
+# queue served by a fixed pool of workers sized to the cores available. When
+# the queue is full the request is rejected straight away (429 + Retry-After)
+# rather than waiting behind work it can't overtake.
+
+from metrics import Counter, Gauge, Histogram
+import math
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+
+
+BOT_MOVE_WORKERS = int(os.environ.get("BOT_MOVE_WORKERS", os.cpu_count() or 1))
+BOT_MOVE_QUEUE_SIZE = int(os.environ.get("BOT_MOVE_QUEUE_SIZE", 2 * BOT_MOVE_WORKERS))
+
+STATS_WINDOW = 1000 # recent requests used for wait/service time stats
+
+
+class QueueFull(Exception):
+    """
+    Raised when a request can't be admitted, with seconds the client should wait
+    """
+    def __init__(self, retry_after):
+        super().__init__("Bot move queue is full.")
+        self.retry_after = retry_after
+
+
+class MoveQueue:
+    """
+    Bounded queue of jobs served by a fixed pool of worker threads
+    """
+    def __init__(self, workers=BOT_MOVE_WORKERS, max_queued=BOT_MOVE_QUEUE_SIZE):
+        self.workers = workers
+        self.max_queued = max_queued
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.in_flight = 0 # admitted jobs, queued or running (at most workers + max_queued)
+        self.busy = 0
+        self.submitted = 0
+        self.rejected = 0
+        self.completed = 0
+        self.wait_times = deque(maxlen=STATS_WINDOW) # seconds queued before a worker took the job
+        self.service_times = deque(maxlen=STATS_WINDOW) # seconds a worker spent on the job
+
+
+    def start(self):
+        """
+        Starts worker threads (once, on first use)
+        """
+        with self.lock:
+            if len(self.threads) > 0:
+                return
+            for i in range(self.workers):
+                t = threading.Thread(target=self.work, name=f"move-worker-{i}", daemon=True)
+                t.start()
+                self.threads.append(t)
+
+
+    def submit(self, fn, *args):
+        """
+        Queues fn(*args) for a worker
+        Returns -> Future | raises QueueFull
+        """
+        self.start()
+
+        with self.lock:
+            admitted = self.in_flight < self.workers + self.max_queued
+            if admitted:
+                self.in_flight += 1
+                self.submitted += 1
+            else:
+                self.rejected += 1
+
+        if not admitted:
+            raise QueueFull(self.retry_after())
+
+        future = Future()
+        self.jobs.put((time.monotonic(), future, fn, args))
+        return future
+
+
+    def run(self, fn, *args):
+        """
+        Runs fn(*args) on a worker and waits for its result
+        Returns -> fn result | raises QueueFull
+        """
+        return self.submit(fn, *args).result()
+
+
+    def work(self):
+        while True:
+            queued_at, future, fn, args = self.jobs.get()
+            if not future.set_running_or_notify_cancel():
+                with self.lock:
+                    self.in_flight -= 1
+                continue
+
+            started_at = time.monotonic()
+            with self.lock:
+                self.busy += 1
+                self.wait_times.append(started_at - queued_at)
+            BOT_MOVE_WAIT_SECONDS.observe(started_at - queued_at)
+
+            try:
+                future.set_result(fn(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+                    self.busy -= 1
+                    self.completed += 1
+                    self.service_times.append(time.monotonic() - started_at)
+
+
+    def retry_after(self):
+        """
+        Estimates whole seconds until a queue slot frees up (at least 1)
+        """
+        with self.lock:
+            service_times = list(self.service_times)
+        if len(service_times) == 0:
+            return 1
+        mean_service = sum(service_times) / len(service_times)
+        return max(1, math.ceil(mean_service * (self.queue_depth() + 1) / self.workers))
+
+
+    def queue_depth(self):
+        """
+        Returns number of admitted jobs waiting for a worker
+        """
+        with self.lock:
+            return max(0, self.in_flight - self.busy)
+
+
+    def stats(self):
+        """
+        Returns queue depth, worker usage, counters and wait/service time summaries
+        Returns -> {...}
+        """
+        with self.lock:
+            wait_times = sorted(self.wait_times)
+            service_times = sorted(self.service_times)
+            stats = {
+                "queue_depth": max(0, self.in_flight - self.busy),
+                "queue_size": self.max_queued,
+                "workers": self.workers,
+                "busy_workers": self.busy,
+                "submitted": self.submitted,
+                "rejected": self.rejected,
+                "completed": self.completed,
+            }
+
+        stats["wait_seconds"] = summarise_times(wait_times)
+        stats["service_seconds"] = summarise_times(service_times)
+        return stats
+
+
+def summarise_times(sorted_times):
+    """
+    Returns mean, p50, p95 and max of given -> sorted list of seconds
+    """
+    if len(sorted_times) == 0:
+        return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "max": 0.0}
+
+    def percentile(p):
+        return sorted_times[min(len(sorted_times) - 1, int(p * len(sorted_times)))]
+
+    return {
+        "mean": sum(sorted_times) / len(sorted_times),
+        "p50": percentile(0.50),
+        "p95": percentile(0.95),
+        "max": sorted_times[-1],
+    }
+
+
+# one queue in front of every bot move in this process
+bot_move_queue = MoveQueue()
+
+BOT_MOVE_WAIT_SECONDS = Histogram("chess_bot_move_queue_wait_seconds", "Time bot move requests waited for a worker.")
+BOT_MOVE_QUEUE_DEPTH = Gauge("chess_bot_move_queue_depth", "Bot move requests waiting for a worker.", function=bot_move_queue.queue_depth)
+BOT_MOVE_BUSY_WORKERS = Gauge("chess_bot_move_busy_workers", "Bot move workers currently searching.", function=lambda: bot_move_queue.busy)
+BOT_MOVE_REJECTED = Counter("chess_bot_move_rejected_total", "Bot move requests rejected because the queue was full.", function=lambda: bot_move_queue.rejected)
@@ -0,0 +1,109 @@
+# Functions and classes to support pondering (searching on the human's time).
+#
+# After the bot replies in a session game, a background worker searches the
+# human's most likely replies (ordered by the bot's own evaluation, so moves
+# best for white come first) and stores the bot's answer to each in the reply
+# cache. If the human plays one of them the next /botmove is answered straight
+# from the cache. Pondering stops when its time budget runs out or as soon as
+# the human's next request arrives for the session.
+
+from bot_cache import bot_move_cache
+from search import split_dims, get_ai_move, TranspositionTable
+from tf_config import evaluate_boards
+from metrics import INFERENCE_SECONDS, MOVE_SECONDS
+import numpy
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+
+BOT_PONDER = os.environ.get("BOT_PONDER", "0") == "1" # off unless enabled
+BOT_PONDER_SECONDS = float(os.environ.get("BOT_PONDER_SECONDS", 5)) # budget per bot move
+BOT_PONDER_WORKERS = int(os.environ.get("BOT_PONDER_WORKERS", 1)) # sessions pondered at once
+
+
+def order_human_replies(board, bot_player):
+    """
+    Returns human's legal moves ordered most likely first.
+    All reply positions are evaluated by the bot's model in one batch and
+    sorted best for white first (human is always white).
+    Returns -> [chess.Move, ...]
+    """
+    replies = list(board.legal_moves)
+    if len(replies) == 0:
+        return replies
+
+    boards3d = []
+    for move in replies:
+        board.push(move)
+        boards3d.append(split_dims(board))
+        board.pop()
+
+    with INFERENCE_SECONDS.time():
+        if bot_player.model == None: # evaluator only (model_artifacts.py)
+            evals = bot_player.evaluator.evaluate_batch(numpy.stack(boards3d))[:, 0]
+        else:
+            evals = evaluate_boards(bot_player.model, numpy.stack(boards3d))[:, 0]
+    order = numpy.argsort(-evals, kind="stable")
+
+    return [replies[i] for i in order]
+
+
+class Ponderer:
+    """
+    Runs pondering jobs for sessions on a small pool of background workers
+    """
+    def __init__(self, max_workers=BOT_PONDER_WORKERS, budget_seconds=BOT_PONDER_SECONDS):
+        self.budget_seconds = budget_seconds
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ponder")
+        self.lock = threading.Lock()
+        self.positions_pondered = 0
+
+
+    def start(self, session, depth):
+        """
+        Starts pondering the human's replies to the session's current position.
+        Call with session lock held, after the bot's move has been pushed.
+        """
+        if session.bot_player == None or session.board.is_game_over():
+            return
+
+        generation = session.ponder_generation
+        board = session.board.copy()
+        self.executor.submit(self.ponder, session, generation, board, depth)
+
+
+    def ponder(self, session, generation, board, depth):
+        """
+        Searches bot replies to the human's likely moves until cancelled or out of time
+        """
+        with session.ponder_lock: # one ponder job per session at a time
+            self.ponder_replies(session, generation, board, depth)
+
+
+    def ponder_replies(self, session, generation, board, depth):
+        deadline = time.monotonic() + self.budget_seconds
+        if session.ponder_table == None:
+            session.ponder_table = TranspositionTable() # only used by ponder workers
+
+        try:
+            for human_move in order_human_replies(board, session.bot_player):
+                if session.ponder_generation != generation or time.monotonic() > deadline:
+                    break # human has moved or budget is spent
+
+                board.push(human_move)
+                if not board.is_game_over() and not bot_move_cache.contains(session.bot_player_id, session.model_hash, board, depth):
+                    with MOVE_SECONDS.time(source="ponder"):
+                        move = get_ai_move(board, depth, session.bot_player, session.ponder_table)
+                    bot_move_cache.put(session.bot_player_id, session.model_hash, board, depth, move)
+                    with self.lock:
+                        self.positions_pondered += 1
+                board.pop()
+
+        except Exception as e:
+            print("Error pondering:", str(e))
+
+
+# one pool shared by every session in this process
+ponderer = Ponderer()
@@ -0,0 +1,241 @@
+# Functions and classes to support profiling batches of games.
+#
+# Profiling is opt-in (PROFILE_GAMES=1 or a "profile" field on /rungames).
+# While a batch is profiled:
+#   - stage hooks time board encoding, move generation, inference and db writes
+#   - each game thread runs under cProfile, merged into one .pstats file
+#   - a sampling thread records every thread's stack into collapsed stacks
+#     (flamegraph.pl / speedscope compatible)
+# Artifacts are written per batch to PROFILE_DIR. When no batch is profiled the
+# stage hooks return a shared no-op context, so they cost almost nothing.
+#
+# Compare two batches with:
+#   python profiling.py diff profiles/batch-1/profile.pstats profiles/batch-2/profile.pstats
+
+import cProfile
+import json
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+
+PROFILE_GAMES = os.environ.get("PROFILE_GAMES", "0") == "1"
+PROFILE_DIR = os.environ.get("PROFILE_DIR", os.path.join(os.getcwd(), "profiles"))
+PROFILE_SAMPLE_SECONDS = float(os.environ.get("PROFILE_SAMPLE_SECONDS", 0.005)) # sampling interval
+
+
+class NullStage:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+null_stage = NullStage()
+
+# profiler of the batch currently being profiled (None when profiling is off)
+active_profiler = None
+
+
+def stage(name):
+    """
+    Returns context manager timing its block as given -> stage of the active profiler
+    """
+    profiler = active_profiler
+    if profiler == None:
+        return null_stage
+    return StageTimer(profiler, name)
+
+
+class StageTimer:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profiler.add_stage_time(self.name, time.perf_counter() - self.start)
+        return False
+
+
+class BatchProfiler:
+    """
+    Collects stage timings, cProfile stats and stack samples for one batch
+    """
+    def __init__(self, sample_seconds=PROFILE_SAMPLE_SECONDS):
+        self.sample_seconds = sample_seconds
+        self.lock = threading.Lock()
+        self.stage_seconds = {} # stage -> total seconds (summed across threads)
+        self.stage_calls = {} # stage -> number of timed blocks
+        self.thread_profiles = []
+        self.stacks = Counter() # collapsed stack -> samples
+        self.sampling = False
+        self.sampler = None
+        self.started_at = None
+        self.elapsed = None
+
+
+    def start(self):
+        """
+        Activates stage hooks and starts stack sampling
+        """
+        global active_profiler
+
+        self.started_at = time.perf_counter()
+        active_profiler = self
+        self.sampling = True
+        self.sampler = threading.Thread(target=self.sample_stacks, name="profile-sampler", daemon=True)
+        self.sampler.start()
+
+
+    def stop(self):
+        """
+        Deactivates stage hooks and stops stack sampling
+        """
+        global active_profiler
+
+        if active_profiler is self:
+            active_profiler = None
+        self.sampling = False
+        if self.sampler != None:
+            self.sampler.join()
+        self.elapsed = time.perf_counter() - self.started_at
+
+
+    def add_stage_time(self, name, seconds):
+        with self.lock:
+            self.stage_seconds[name] = self.stage_seconds.get(name, 0.0) + seconds
+            self.stage_calls[name] = self.stage_calls.get(name, 0) + 1
+
+
+    def profile_thread(self, target, *args):
+        """
+        Runs target(*args) under cProfile (call as a thread's target)
+        """
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError: # another profiler already active in this interpreter
+            return target(*args)
+
+        try:
+            return target(*args)
+        finally:
+            profile.disable()
+            with self.lock:
+                self.thread_profiles.append(profile)
+
+
+    def sample_stacks(self):
+        """
+        Records the stack of every other thread every sample_seconds
+        """
+        own_id = threading.get_ident()
+        while self.sampling:
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                stack = []
+                while frame != None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{code.co_name}")
+                    frame = frame.f_back
+                self.stacks[";".join(reversed(stack))] += 1
+            time.sleep(self.sample_seconds)
+
+
+    def write(self, name):
+        """
+        Writes profile.pstats, stacks.folded and stages.json to PROFILE_DIR/<name>
+        Returns -> profile directory
+        """
+        profile_dir = os.path.join(PROFILE_DIR, name)
+        os.makedirs(profile_dir, exist_ok=True)
+
+        with self.lock:
+            thread_profiles = list(self.thread_profiles)
+            stage_seconds = dict(self.stage_seconds)
+            stage_calls = dict(self.stage_calls)
+
+        if len(thread_profiles) > 0:
+            stats = pstats.Stats(thread_profiles[0])
+            for profile in thread_profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(profile_dir, "profile.pstats"))
+
+        with open(os.path.join(profile_dir, "stacks.folded"), "w") as f:
+            for stack, samples in self.stacks.most_common():
+                f.write(f"{stack} {samples}\n")
+
+        with open(os.path.join(profile_dir, "stages.json"), "w") as f:
+            json.dump({
+                "elapsed_seconds": self.elapsed,
+                "threads_profiled": len(thread_profiles),
+                "stage_seconds": stage_seconds,
+                "stage_calls": stage_calls,
+            }, f, indent=2)
+
+        print(f"Wrote profile to {profile_dir}")
+        return profile_dir
+
+
+def load_function_times(path):
+    """
+    Returns {function: (calls, tottime, cumtime)} from given -> .pstats path
+    """
+    stats = pstats.Stats(path)
+    function_times = {}
+    for (filename, line, function), (cc, nc, tottime, cumtime, callers) in stats.stats.items():
+        key = f"{os.path.basename(filename)}:{line}({function})"
+        function_times[key] = (nc, tottime, cumtime)
+    return function_times
+
+
+def diff_profiles(path_a, path_b, top=30):
+    """
+    Returns lines comparing per function tottime of two .pstats files,
+    largest absolute change first
+    """
+    times_a = load_function_times(path_a)
+    times_b = load_function_times(path_b)
+
+    rows = []
+    for key in set(times_a) | set(times_b):
+        calls_a, tottime_a, cumtime_a = times_a.get(key, (0, 0.0, 0.0))
+        calls_b, tottime_b, cumtime_b = times_b.get(key, (0, 0.0, 0.0))
+        rows.append((tottime_b - tottime_a, key, calls_a, calls_b, tottime_a, tottime_b, cumtime_a, cumtime_b))
+    rows.sort(key=lambda row: abs(row[0]), reverse=True)
+
+    total_a = sum(tottime for calls, tottime, cumtime in times_a.values())
+    total_b = sum(tottime for calls, tottime, cumtime in times_b.values())
+
+    lines = [f"total tottime: {total_a:.3f}s -> {total_b:.3f}s ({total_b - total_a:+.3f}s)", ""]
+    lines.append(f"{'delta':>10} {'tottime a':>10} {'tottime b':>10} {'cumtime a':>10} {'cumtime b':>10} {'calls a':>9} {'calls b':>9}  function")
+    for delta, key, calls_a, calls_b, tottime_a, tottime_b, cumtime_a, cumtime_b in rows[:top]:
+        lines.append(f"{delta:>+10.3f} {tottime_a:>10.3f} {tottime_b:>10.3f} {cumtime_a:>10.3f} {cumtime_b:>10.3f} {calls_a:>9} {calls_b:>9}  {key}")
+    return lines
+
+
+def main(argv):
+    usage = "usage: python profiling.py diff <a.pstats> <b.pstats> [top]"
+    if len(argv) < 3 or argv[0] != "diff":
+        print(usage)
+        return 1
+
+    top = int(argv[3]) if len(argv) > 3 else 30
+    for line in diff_profiles(argv[1], argv[2], top):
+        print(line)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,191 @@
+# Functions and classes to support searching a bot's move on several cores.
+#
+# A search runs on one python thread, so a /botmove only uses one core however
+# many the instance has. With BOT_SEARCH_PROCESSES > 1 the root moves are split
+# across a pool of worker processes, each holding the bot's model (loaded from
+# the local model store on first use, a few models kept per worker):
+#   - root moves are dealt round robin so every worker gets a mix of them
+#   - the best root evaluation found so far is shared between the workers of a
+#     search (a slot of a shared array), each root move is searched with it as
+#     its alpha (beta for black) bound so workers prune with each other's results
+#   - each root move is searched with the bound loosened by one ulp, so a move
+#     equal to the best so far still comes back with its exact value; a value
+#     only counts if it beat the loosened bound, the best one wins and ties go
+#     to the first move in legal move order like the single threaded search
+# Searches fall back to the request thread when the pool is off, broken or all
+# bound slots are taken.
+
+import multiprocessing
+import os
+import threading
+import numpy
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from collections import OrderedDict
+from move_queue import BOT_MOVE_WORKERS
+from search import get_ai_move
+
+
+BOT_SEARCH_PROCESSES = int(os.environ.get("BOT_SEARCH_PROCESSES", 0)) # 0 or 1 searches in the request thread
+BOT_SEARCH_MODELS = int(os.environ.get("BOT_SEARCH_MODELS", 4)) # models kept loaded per worker process
+
+
+class SearchPlayer:
+    """
+    Bot model as search uses it, held by a worker process
+    """
+    def __init__(self, model, evaluator, colour):
+        self.model = model
+        self.evaluator = evaluator
+        self.colour = colour
+
+
+# worker process state, set by init_worker
+worker_bounds = None
+worker_players = OrderedDict() # model_path -> (SearchPlayer, TranspositionTable), least recently used first
+
+
+def init_worker(bounds, processes):
+    """
+    Sets up a worker process: shared bounds and tensorflow threads for its share of the cores
+    """
+    global worker_bounds
+    worker_bounds = bounds
+
+    from tf_config import configure_tensorflow, available_cpus
+    configure_tensorflow(max(1, available_cpus() // processes), 1)
+
+
+def get_worker_player(model_path):
+    """
+    Returns (SearchPlayer, TranspositionTable) of the model at given -> model_path, loading it if needed
+    """
+    entry = worker_players.get(model_path)
+    if entry == None:
+        from tensorflow import keras
+        from dense_eval import build_dense_evaluator
+        from model_artifacts import load_artifact, file_hash, MODEL_ARTIFACTS
+        from search import TranspositionTable
+
+        # the request ingested the model, dense ones don't need tensorflow here
+        artifact = load_artifact(file_hash(model_path)) if MODEL_ARTIFACTS else None
+        if artifact != None and artifact.evaluator != None:
+            model, evaluator = None, artifact.evaluator
+        else:
+            model = keras.models.load_model(model_path)
+            evaluator_message, evaluator = build_dense_evaluator(model)
+        entry = (SearchPlayer(model, evaluator, None), TranspositionTable())
+        worker_players[model_path] = entry
+        while len(worker_players) > BOT_SEARCH_MODELS:
+            worker_players.popitem(last=False)
+    else:
+        worker_players.move_to_end(model_path)
+    return entry
+
+
+def search_root_moves(model_path, root_fen, moves, root_moves, depth, colour, slot):
+    """
+    Searches given -> root_moves [(index, uci),...] of the position after moves (ucis) from root_fen,
+    sharing the best root evaluation through bound slot
+    Returns -> [(index, eval, exact),...]
+    """
+    from search import EncodedBoard, minimax
+
+    player, table = get_worker_player(model_path)
+    player.colour = colour
+
+    board = EncodedBoard(root_fen)
+    for uci in moves:
+        board.push_uci(uci)
+
+    results = []
+    for index, uci in root_moves:
+        board.push_uci(uci)
+        if colour == "white":
+            alpha = numpy.nextafter(worker_bounds[slot], -numpy.inf) # equal values stay exact
+            eval = minimax(board, depth - 1, alpha, numpy.inf, player, False, table)
+            exact = eval > alpha
+            if exact:
+                with worker_bounds.get_lock():
+                    worker_bounds[slot] = max(worker_bounds[slot], eval)
+        else:
+            beta = numpy.nextafter(worker_bounds[slot], numpy.inf)
+            eval = minimax(board, depth - 1, -numpy.inf, beta, player, True, table)
+            exact = eval < beta
+            if exact:
+                with worker_bounds.get_lock():
+                    worker_bounds[slot] = min(worker_bounds[slot], eval)
+        board.pop()
+        results.append((index, float(eval), bool(exact)))
+    return results
+
+
+class RootSearchPool:
+    """
+    Pool of worker processes splitting the root moves of bot move searches
+    """
+    def __init__(self, processes=BOT_SEARCH_PROCESSES, slots=BOT_MOVE_WORKERS):
+        self.processes = processes
+        self.lock = threading.Lock()
+        self.executor = None
+        self.context = multiprocessing.get_context("spawn") # workers load their own tensorflow
+        self.slots = max(1, slots) # searches on the pool at once
+        self.bounds = None # best root evaluation of each running search, shared with the workers
+        self.free_slots = list(range(self.slots))
+
+
+    def get_executor(self):
+        with self.lock:
+            if self.executor == None:
+                if self.bounds == None:
+                    self.bounds = self.context.Array("d", self.slots)
+                self.executor = ProcessPoolExecutor(max_workers=self.processes, mp_context=self.context,
+                                                    initializer=init_worker, initargs=(self.bounds, self.processes))
+            return self.executor
+
+
+    def get_move(self, board, depth, player, table=None):
+        """
+        Returns best move for player in given -> board (chess.Board with move stack) searched to depth,
+        on the pool if it is on and player's model is stored locally, otherwise in this thread
+        """
+        legal_moves = list(board.legal_moves)
+        if self.processes <= 1 or player.model_path == None or len(legal_moves) < 2:
+            return get_ai_move(board, depth, player, table)
+
+        with self.lock:
+            slot = self.free_slots.pop() if len(self.free_slots) > 0 else None
+        if slot == None: # every slot in use, search here
+            return get_ai_move(board, depth, player, table)
+
+        try:
+            executor = self.get_executor()
+            self.bounds[slot] = -numpy.inf if player.colour == "white" else numpy.inf
+            root_fen = board.root().fen()
+            moves = [move.uci() for move in board.move_stack]
+            indexed_moves = list(enumerate(move.uci() for move in legal_moves))
+            chunks = [indexed_moves[i::self.processes] for i in range(min(self.processes, len(legal_moves)))]
+
+            futures = [executor.submit(search_root_moves, player.model_path, root_fen, moves, chunk, depth, player.colour, slot) for chunk in chunks]
+            results = [result for future in futures for result in future.result()]
+
+        except BrokenProcessPool as e: # a worker died (e.g. out of memory), start a new pool next time
+            print("Root search pool broken, searching in thread:", str(e))
+            with self.lock:
+                self.executor = None
+            return get_ai_move(board, depth, player, table)
+
+        finally:
+            with self.lock:
+                self.free_slots.append(slot)
+
+        exact_results = [result for result in results if result[2]] or results
+        if player.colour == "white":
+            index, eval, exact = min(exact_results, key=lambda result: (-result[1], result[0]))
+        else:
+            index, eval, exact = min(exact_results, key=lambda result: (result[1], result[0]))
+        return legal_moves[index]
+
+
+# one pool shared by every bot move in this process
+root_search = RootSearchPool()
@@ -0,0 +1,99 @@
+# Functions and classes to support scheduling the games of a batch.
+#
+# A batch finishes when its last game does, so games are started longest first
+# (LPT scheduling) on a bounded pool of game workers: long games overlap with
+# many short ones instead of starting last and running alone. A game's length
+# is estimated from its players' measured model latency (model validation) and
+# their recent average game length in matches.
+# Throttled (slow) players play one game at a time; a worker skips over games
+# whose throttled player is busy rather than waiting on them.
+
+import os
+import threading
+
+
+BATCH_GAME_WORKERS = int(os.environ.get("BATCH_GAME_WORKERS", os.cpu_count() or 1))
+
+DEFAULT_GAME_PLIES = 120 # assumed game length of players without recorded games
+EVALUATIONS_PER_MOVE = 30 # positions evaluated per move at search depth 1 (about one per legal move)
+GAME_LENGTH_BATCHES = 10 # recent batches used for players' average game length
+
+
+def estimate_game_cost(player_1, player_2, game_plies, default_latency):
+    """
+    Estimates seconds a game takes given -> players, {player_id: average plies} & latency of unmeasured models
+    Each player makes half the moves, each move evaluates about EVALUATIONS_PER_MOVE positions
+    Returns -> seconds
+    """
+    plies = (game_plies.get(player_1.player_id, DEFAULT_GAME_PLIES) + game_plies.get(player_2.player_id, DEFAULT_GAME_PLIES)) / 2
+
+    latency_1 = player_1.latency if player_1.latency != None else default_latency
+    latency_2 = player_2.latency if player_2.latency != None else default_latency
+
+    return plies / 2 * EVALUATIONS_PER_MOVE * (latency_1 + latency_2)
+
+
+class GameScheduler:
+    """
+    Plays games on a bounded pool of worker threads, longest estimated game first
+    """
+    def __init__(self, workers=BATCH_GAME_WORKERS):
+        self.workers = workers
+        self.condition = threading.Condition()
+        self.pending = [] # [(cost, player_1, player_2),...] in the order games start
+        self.busy_player_ids = set() # throttled players in a game
+
+
+    def run(self, games, play_game, ordered=False):
+        """
+        Plays given -> games [(cost, player_1, player_2),...] with play_game(player_1, player_2),
+        longest first unless ordered (started in the given order)
+        Returns once every game has finished
+        """
+        with self.condition:
+            self.pending = list(games) if ordered else sorted(games, key=lambda game: game[0], reverse=True)
+
+        threads = []
+        for i in range(min(self.workers, len(games))):
+            t = threading.Thread(target=self.work, args=(play_game,), name=f"game-worker-{i}")
+            t.start()
+            threads.append(t)
+
+        # wait for games to finish
+        for t in threads:
+            t.join()
+
+
+    def next_game(self):
+        """
+        Returns longest pending game none of whose throttled players is busy or None (call with condition held)
+        """
+        for index, (cost, player_1, player_2) in enumerate(self.pending):
+            if not any(player.throttled and player.player_id in self.busy_player_ids for player in (player_1, player_2)):
+                return self.pending.pop(index)
+        return None
+
+
+    def work(self, play_game):
+        while True:
+            with self.condition:
+                game = None
+                while game == None:
+                    if len(self.pending) == 0:
+                        return
+                    game = self.next_game()
+                    if game == None:
+                        self.condition.wait() # every pending game waits on a busy throttled player
+
+                cost, player_1, player_2 = game
+                throttled_ids = {player.player_id for player in (player_1, player_2) if player.throttled}
+                self.busy_player_ids.update(throttled_ids)
+
+            try:
+                play_game(player_1, player_2)
+            except Exception as e:
+                print(f"Error playing {player_1.name} against {player_2.name}:", str(e))
+            finally:
+                with self.condition:
+                    self.busy_player_ids.difference_update(throttled_ids)
+                    self.condition.notify_all()
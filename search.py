@@ -0,0 +1,474 @@
+# Functions and classes to support searching for a bot's move.
+#
+# Positions are encoded into the 14x8x8 board tensor the players' models were
+# trained on (split_dims) and searched with minimax + alpha-beta pruning.
+# White tries to maximise the model's evaluation, black to minimise it.
+# During search the board is an EncodedBoard, which keeps the 12 piece planes
+# up to date on push/pop instead of rebuilding the tensor at every leaf.
+# Players with a dense evaluator (dense_eval.py) are evaluated in numpy from the
+# board's first layer accumulator instead of calling their model.
+# Positions in the syzygy tablebases (tablebase.py) are scored from their
+# WDL/DTZ instead of the model.
+
+import chess
+import chess.polyglot
+import numpy
+import weakref
+from metrics import INFERENCE_SECONDS
+from profiling import stage
+from tablebase import probe_tablebase, TABLEBASE_WIN
+from tf_config import evaluate_boards
+
+
+## split dimensions of board to translate move to the model
+squares_index = {
+    'a': 0,
+    'b': 1,
+    'c': 2,
+    'd': 3,
+    'e': 4,
+    'f': 5,
+    'g': 6,
+    'h': 7
+}
+
+# transposition table entry flags
+EXACT = 0
+LOWER_BOUND = 1 # search failed high, value is at least this
+UPPER_BOUND = 2 # search failed low, value is at most this
+
+TRANSPOSITION_TABLE_SIZE = 200000 # max entries before the table is cleared
+
+DRAWN_FEN = "8/8/8/4k3/8/8/8/4K3 w - - 0 1" # bare kings, a dead draw
+
+
+def square_to_index(square):
+    letter = chess.square_name(square)
+    return 8 - int(letter[1]), squares_index[letter[0]]
+
+
+def split_dims(board):
+    # this is the 3d matrix
+    # 14: 6 for white chess pieces, 6 for black chess pieces, 2 for valid attacks and moves for white and black
+    # 8:8 is the chess board size
+    # order is (pawns, knights, bishops, rooks, queen,king)
+
+    board3d = numpy.zeros((14, 8, 8), dtype=numpy.int8)
+
+    # here we add the pieces's view on the matrix
+    for piece in chess.PIECE_TYPES:
+        for square in board.pieces(piece, chess.WHITE):
+            board3d[piece - 1][7 - square // 8][square % 8] = 1
+        for square in board.pieces(piece, chess.BLACK):
+            board3d[piece + 5][7 - square // 8][square % 8] = 1
+
+    add_move_planes(board, board3d)
+
+    return board3d
+
+
+def add_move_planes(board, board3d):
+    """
+    Sets the 2 attack planes (12 white, 13 black) of given -> board3d to the
+    destination squares of each side's legal moves
+    """
+    # add attacks and valid moves too
+    # so the network knows what is being attacked
+    aux = board.turn
+    for plane, colour in ((12, chess.WHITE), (13, chess.BLACK)):
+        board.turn = colour
+        destinations = legal_destinations(board)
+        if destinations != None:
+            board3d[plane] = bitboard_plane(destinations)
+        else:
+            board3d[plane] = 0
+            to_squares = numpy.fromiter((move.to_square for move in board.legal_moves), dtype=numpy.int64)
+            board3d[plane, 7 - to_squares // 8, to_squares % 8] = 1
+    board.turn = aux
+
+
+def bitboard_plane(bitboard):
+    """
+    Returns 8x8 plane (split_dims orientation, rank 8 first) of given -> bitboard
+    """
+    bits = numpy.unpackbits(numpy.array([bitboard], dtype="<u8").view(numpy.uint8), bitorder="little")
+    return bits.reshape(8, 8)[::-1]
+
+
+def legal_destinations(board):
+    """
+    Returns bitboard of the squares the side to move's legal moves go to, worked out
+    from attack bitboards instead of generating every move (same squares as legal_moves)
+    Returns None when not in check, en passant or one king positions (generate moves instead)
+    """
+    turn = board.turn
+    own = board.occupied_co[turn]
+    king_mask = board.kings & own
+    if board.ep_square != None or king_mask == 0 or king_mask & (king_mask - 1):
+        return None
+
+    king = chess.msb(king_mask)
+    if board.attackers_mask(not turn, king):
+        return None # in check, only evasions are legal
+
+    # own pieces pinned to the king may only move along the pin
+    pinned = 0
+    rooks_and_queens = board.rooks | board.queens
+    bishops_and_queens = board.bishops | board.queens
+    snipers = ((chess.BB_RANK_ATTACKS[king][0] & rooks_and_queens) |
+               (chess.BB_FILE_ATTACKS[king][0] & rooks_and_queens) |
+               (chess.BB_DIAG_ATTACKS[king][0] & bishops_and_queens)) & board.occupied_co[not turn]
+    for sniper in chess.scan_reversed(snipers):
+        between = chess.between(king, sniper) & board.occupied
+        if between and between & (between - 1) == 0:
+            pinned |= between
+    pinned &= own
+
+    destinations = 0
+
+    # pieces (not pawns), king only to squares not attacked
+    for square in chess.scan_reversed(own & ~board.pawns):
+        targets = board.attacks_mask(square) & ~own
+        if square == king:
+            for target in chess.scan_reversed(targets):
+                if not board.is_attacked_by(not turn, target):
+                    destinations |= chess.BB_SQUARES[target]
+            continue
+        if pinned & chess.BB_SQUARES[square]:
+            targets &= chess.ray(king, square)
+        destinations |= targets
+
+    for move in board.generate_castling_moves():
+        destinations |= chess.BB_SQUARES[move.to_square]
+
+    # pawn captures and advances
+    empty = ~board.occupied & chess.BB_ALL
+    for square in chess.scan_reversed(board.pawns & own):
+        pawn = chess.BB_SQUARES[square]
+        targets = chess.BB_PAWN_ATTACKS[turn][square] & board.occupied_co[not turn]
+        if turn == chess.WHITE:
+            single = pawn << 8 & empty
+            targets |= single | (single << 8 & empty & (chess.BB_RANK_3 | chess.BB_RANK_4))
+        else:
+            single = pawn >> 8 & empty
+            targets |= single | (single >> 8 & empty & (chess.BB_RANK_6 | chess.BB_RANK_5))
+        if pinned & pawn:
+            targets &= chess.ray(king, square)
+        destinations |= targets
+
+    return destinations
+
+
+def piece_plane(piece):
+    """
+    Returns split_dims plane of given -> chess.Piece
+    """
+    return piece.piece_type - 1 if piece.color == chess.WHITE else piece.piece_type + 5
+
+
+class EncodedBoard(chess.Board):
+    """
+    chess.Board keeping its split_dims piece planes up to date on push/pop.
+    Each push records the squares it changed (make/unmake stack of deltas) and
+    pop reverts them, so encode only recomputes the 2 attack planes.
+    Other ways of changing the position (set_fen, set_piece_at, ...) drop the
+    planes and the next encode rebuilds them.
+    An accumulator (dense_eval.Accumulator) set by an evaluator gets the same deltas.
+    """
+    def __init__(self, fen=chess.STARTING_FEN, *, chess960=False):
+        self.planes = None # split_dims tensor, built on first encode
+        self.plane_deltas = [] # per push since planes were built: [(square, old piece, new piece),...]
+        self.accumulator = None # first layer output of a dense evaluator, kept with the planes
+        super().__init__(fen, chess960=chess960)
+
+
+    @classmethod
+    def from_board(cls, board):
+        """
+        Returns EncodedBoard of given -> chess.Board (same position and move stack)
+        """
+        encoded = cls(board.root().fen(), chess960=board.chess960)
+        for move in board.move_stack:
+            encoded.push(move)
+        return encoded
+
+
+    def encode(self):
+        """
+        Returns split_dims tensor (14, 8, 8) of the position
+        The array is reused: it changes with the next push/pop/encode
+        """
+        if self.planes is None:
+            self.planes = split_dims(self)
+            self.plane_deltas = []
+            self.accumulator = None
+        else:
+            add_move_planes(self, self.planes)
+        return self.planes
+
+
+    def changed_squares(self, move):
+        """
+        Returns squares given -> move (about to be pushed) changes
+        """
+        if self.is_castling(move): # king and rook, wherever they start (chess960)
+            return chess.SquareSet(chess.BB_RANK_1 if self.turn == chess.WHITE else chess.BB_RANK_8)
+        squares = [move.from_square, move.to_square]
+        if self.is_en_passant(move):
+            squares.append(move.to_square - 8 if self.turn == chess.WHITE else move.to_square + 8)
+        return squares
+
+
+    def push(self, move):
+        if self.planes is None:
+            return super().push(move)
+
+        squares = self.changed_squares(move)
+        old_pieces = [self.piece_at(square) for square in squares]
+        super().push(move)
+
+        delta = []
+        for square, old_piece in zip(squares, old_pieces):
+            new_piece = self.piece_at(square)
+            if new_piece != old_piece:
+                row, column = 7 - square // 8, square % 8
+                if old_piece != None:
+                    self.planes[piece_plane(old_piece), row, column] = 0
+                if new_piece != None:
+                    self.planes[piece_plane(new_piece), row, column] = 1
+                delta.append((square, old_piece, new_piece))
+        self.plane_deltas.append(delta)
+        if self.accumulator != None:
+            self.accumulator.push(delta)
+
+
+    def pop(self):
+        move = super().pop()
+
+        if self.planes is not None:
+            if len(self.plane_deltas) == 0: # popped past the position the planes were built from
+                self.drop_planes()
+            else:
+                for square, old_piece, new_piece in reversed(self.plane_deltas.pop()):
+                    row, column = 7 - square // 8, square % 8
+                    if new_piece != None:
+                        self.planes[piece_plane(new_piece), row, column] = 0
+                    if old_piece != None:
+                        self.planes[piece_plane(old_piece), row, column] = 1
+                if self.accumulator != None and not self.accumulator.pop():
+                    self.accumulator = None # built after this push, rebuilt on next evaluation
+        return move
+
+
+    def drop_planes(self):
+        self.planes = None
+        self.accumulator = None
+
+
+    def set_fen(self, fen):
+        self.drop_planes()
+        return super().set_fen(fen)
+
+
+    def set_board_fen(self, fen):
+        self.drop_planes()
+        return super().set_board_fen(fen)
+
+
+    def set_piece_at(self, square, piece, promoted=False):
+        self.drop_planes()
+        return super().set_piece_at(square, piece, promoted)
+
+
+    def remove_piece_at(self, square):
+        self.drop_planes()
+        return super().remove_piece_at(square)
+
+
+    def clear_board(self):
+        self.drop_planes()
+        return super().clear_board()
+
+
+    def reset_board(self):
+        self.drop_planes()
+        return super().reset_board()
+
+
+class TranspositionTable:
+    """
+    Stores searched positions (by zobrist hash) so search can be reused
+    across moves of the same game. Not thread safe, one per game/session.
+    """
+    def __init__(self, max_entries=TRANSPOSITION_TABLE_SIZE):
+        self.max_entries = max_entries
+        self.entries = {} # zobrist hash -> (depth, flag, value)
+
+
+    def get(self, key):
+        return self.entries.get(key)
+
+
+    def put(self, key, depth, flag, value):
+        if len(self.entries) >= self.max_entries:
+            self.entries.clear() # simple replacement: start afresh when full
+        self.entries[key] = (depth, flag, value)
+
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# used for the minimax algorithm
+def minimax_eval(board, player):
+    with stage("encode"):
+        if isinstance(board, EncodedBoard):
+            board3d = board.encode()
+        else:
+            board3d = split_dims(board)
+    with stage("inference"), INFERENCE_SECONDS.time():
+        if player.evaluator != None and isinstance(board, EncodedBoard):
+            return player.evaluator.evaluate(board)
+        if player.model == None: # loaded from its artifact, evaluator only (model_artifacts.py)
+            return player.evaluator.evaluate_batch(numpy.expand_dims(board3d, 0))[0][0]
+        return evaluate_boards(player.model, numpy.expand_dims(board3d, 0))[0][0]
+
+
+# player -> model's evaluation of a dead draw, used for drawn tablebase positions
+draw_evals = weakref.WeakKeyDictionary()
+
+
+def draw_eval(player):
+    """
+    Returns player's model evaluation of bare kings (what a draw is worth on its scale)
+    """
+    eval = draw_evals.get(player)
+    if eval == None:
+        eval = draw_evals[player] = minimax_eval(EncodedBoard(DRAWN_FEN), player)
+    return eval
+
+
+def tablebase_eval(board, player):
+    """
+    Returns evaluation (white maximises) of given -> board from the tablebases | None if not in them
+    Wins/losses are beyond any model evaluation (the winner prefers the shortest DTZ, the loser the longest),
+    draws are worth the model's evaluation of a dead draw
+    """
+    probe = probe_tablebase(board)
+    if probe == None:
+        return None
+
+    wdl, dtz = probe
+    if -1 <= wdl <= 1: # cursed wins and blessed losses are drawn by the 50 move rule
+        return draw_eval(player)
+    eval = TABLEBASE_WIN - abs(dtz)
+    if wdl < 0:
+        eval = -eval
+    return eval if board.turn == chess.WHITE else -eval
+
+
+def minimax(board, depth, alpha, beta, player, maximising, table=None):
+    with stage("tablebase"):
+        eval = tablebase_eval(board, player)
+    if eval != None:
+        return eval
+
+    if table != None:
+        key = chess.polyglot.zobrist_hash(board)
+        entry = table.get(key)
+        if entry != None and entry[0] >= depth:
+            entry_depth, flag, value = entry
+            if flag == EXACT:
+                return value
+            elif flag == LOWER_BOUND:
+                alpha = max(alpha, value)
+            elif flag == UPPER_BOUND:
+                beta = min(beta, value)
+            if beta <= alpha:
+                return value
+        alpha_original, beta_original = alpha, beta
+
+    with stage("movegen"):
+        game_over = depth != 0 and board.is_game_over()
+
+    if depth == 0 or game_over:
+        eval = minimax_eval(board, player)
+        if table != None:
+            table.put(key, depth, EXACT, eval)
+        return eval
+
+    with stage("movegen"):
+        legal_moves = list(board.legal_moves)
+
+    if maximising == True: # maximizing_player
+        best_eval = -numpy.inf
+        for move in legal_moves:
+            board.push(move)
+            eval = minimax(board, depth - 1, alpha, beta, player, False, table)
+            board.pop()
+            best_eval = max(best_eval, eval)
+            alpha = max(alpha, eval)
+            if beta <= alpha:
+                break
+
+    else: # minimising_player
+        best_eval = numpy.inf
+        for move in legal_moves:
+            board.push(move)
+            eval = minimax(board, depth - 1, alpha, beta, player, True, table)
+            board.pop()
+            best_eval = min(best_eval, eval)
+            beta = min(beta, eval)
+            if beta <= alpha:
+                break
+
+    if table != None:
+        if best_eval <= alpha_original:
+            flag = UPPER_BOUND
+        elif best_eval >= beta_original:
+            flag = LOWER_BOUND
+        else:
+            flag = EXACT
+        table.put(key, depth, flag, best_eval)
+
+    return best_eval
+
+
+# This is the actual function that gets the move from the neural network
+def get_ai_move(board, depth, player, table=None):
+    # search on a copy which keeps its board tensor updated move by move
+    board = EncodedBoard.from_board(board)
+
+    with stage("movegen"):
+        legal_moves = list(board.legal_moves)
+
+    # White player tries to maximize score
+    if player.colour == "white":
+        max_move = None
+        # set max to -infinity
+        max_eval = -numpy.inf
+
+        for move in legal_moves:
+            board.push(move)
+            eval = minimax(board, depth - 1, -numpy.inf, numpy.inf, player, False, table)
+            board.pop()
+            if eval > max_eval:
+                max_eval = eval
+                max_move = move
+
+        return max_move
+
+    # Black player tries to minimize score
+    elif player.colour == "black":
+        min_move = None
+        # set min to infinity
+        min_eval = numpy.inf
+
+        for move in legal_moves:
+            board.push(move)
+            eval = minimax(board, depth - 1, -numpy.inf, numpy.inf, player, True, table)
+            board.pop()
+            if eval < min_eval:
+                min_eval = eval
+                min_move = move
+        return min_move
@@ -0,0 +1,120 @@
+# Functions and classes to support playing match series between two players.
+#
+# With SERIES_GAMES > 1 every pairing of a batch plays a series of games
+# (colours alternating) instead of one game. Playing a fixed number of games
+# wastes most of them on lopsided pairings, so a series stops as soon as its
+# outcome is settled by SERIES_STOP_RULE:
+#   - "sprt": sequential probability ratio test of player 1 being
+#     SERIES_ELO_MARGIN stronger against being SERIES_ELO_MARGIN weaker (draws
+#     count half a win), stopping when either is accepted at SERIES_ALPHA/BETA
+#   - "ci": stops when the Wilson confidence interval of player 1's mean score
+#     excludes an even score (0.5)
+#   - "none": always plays SERIES_GAMES
+# Every game is still rated on its own (elo.py); matches record each game's
+# number in its series and, once it ends, how many games the series took.
+# A resumed batch rebuilds its series from the games already recorded
+# (resume_series) and plays the unfinished ones on from where they stopped.
+
+import math
+import os
+from elo import expected_score, match_result
+
+
+SERIES_GAMES = int(os.environ.get("SERIES_GAMES", 1)) # most games per pairing, 1 plays single games
+SERIES_MIN_GAMES = int(os.environ.get("SERIES_MIN_GAMES", 2)) # games before a series may stop (both colours)
+SERIES_STOP_RULE = os.environ.get("SERIES_STOP_RULE", "sprt") # "sprt", "ci" or "none"
+SERIES_ELO_MARGIN = float(os.environ.get("SERIES_ELO_MARGIN", 100)) # sprt hypotheses: +-margin elo
+SERIES_ALPHA = float(os.environ.get("SERIES_ALPHA", 0.05))
+SERIES_BETA = float(os.environ.get("SERIES_BETA", 0.05))
+SERIES_CONFIDENCE_Z = float(os.environ.get("SERIES_CONFIDENCE_Z", 1.96)) # ci: 95% interval
+
+
+class Series:
+    """
+    Results of a series between player 1 and player 2 and whether it can stop
+    """
+    def __init__(self, max_games=SERIES_GAMES, min_games=SERIES_MIN_GAMES, stop_rule=SERIES_STOP_RULE):
+        self.max_games = max_games
+        self.min_games = min_games
+        self.stop_rule = stop_rule
+        self.games = 0
+        self.score = 0.0 # player 1's total score (1 win, 0.5 draw, 0 loss)
+        self.stopped = False # a game errored, the series ends early
+
+
+    def record(self, player_1_result):
+        self.games += 1
+        self.score += player_1_result
+
+
+    def log_likelihood_ratio(self):
+        """
+        Returns log likelihood ratio of player 1 being SERIES_ELO_MARGIN stronger against weaker
+        """
+        stronger = expected_score(SERIES_ELO_MARGIN, 0) # player 1's expected score if stronger (1 - it if weaker)
+        return (self.score - (self.games - self.score)) * math.log(stronger / (1 - stronger))
+
+
+    def confidence_interval(self):
+        """
+        Returns Wilson interval (low, high) of player 1's mean score
+        """
+        z = SERIES_CONFIDENCE_Z
+        mean = self.score / self.games
+        centre = (mean + z * z / (2 * self.games)) / (1 + z * z / self.games)
+        half_width = z * math.sqrt(mean * (1 - mean) / self.games + z * z / (4 * self.games ** 2)) / (1 + z * z / self.games)
+        return centre - half_width, centre + half_width
+
+
+    def settled(self):
+        """
+        Returns whether the stop rule has settled the series' outcome
+        """
+        if self.games < max(1, self.min_games):
+            return False
+        if self.stop_rule == "sprt":
+            llr = self.log_likelihood_ratio()
+            return llr >= math.log((1 - SERIES_BETA) / SERIES_ALPHA) or llr <= math.log(SERIES_BETA / (1 - SERIES_ALPHA))
+        if self.stop_rule == "ci":
+            low, high = self.confidence_interval()
+            return low > 0.5 or high < 0.5
+        return False
+
+
+    def finished(self):
+        return self.stopped or self.games >= self.max_games or self.settled()
+
+
+    def summary(self):
+        stopped = "settled" if self.settled() else "max games" if self.games >= self.max_games else "stopped"
+        return f"{self.score:g}/{self.games} ({stopped})"
+
+
+def series_pairing(match):
+    """
+    Returns (player_1_id, player_2_id) of the series given -> recorded series match belongs to,
+    as the pairing was scheduled (player 1 plays white in the series' odd games)
+    """
+    if match["series_game"] % 2 == 1:
+        return match["player_1_id"], match["player_2_id"]
+    return match["player_2_id"], match["player_1_id"]
+
+
+def resume_series(matches):
+    """
+    Rebuilds series from given -> recorded matches [{player_1_id, player_2_id, winner_id, status_flag, series_game},...]
+    (matches that aren't series games are skipped)
+    Returns -> {(player_1_id, player_2_id): Series} keyed as series_pairing
+    """
+    series_by_pairing = {}
+    series_matches = [match for match in matches if match["series_game"] != None]
+    for match in sorted(series_matches, key=lambda match: match["series_game"]):
+        pairing = series_pairing(match)
+        series = series_by_pairing.setdefault(pairing, Series())
+        result = match_result(match["winner_id"], match["player_1_id"], match["status_flag"])
+        if result == None: # errored game stopped the series
+            series.stopped = True
+        elif not series.stopped:
+            series.record(result if match["player_1_id"] == pairing[0] else 1 - result)
+
+    return series_by_pairing
@@ -0,0 +1,183 @@
+# Functions to support dry runs of a batch for capacity planning.
+#
+# A dry run (run_games with dry_run) schedules a batch from the players table
+# like a real one but loads no model and plays no move. Each game's length is
+# estimated as the scheduler estimates it, from its players' stored model
+# latency (model_stats) and recent game lengths (matches), and the batch is
+# simulated on the chosen executor:
+#   - one game master playing every game on its game workers
+#   - sharded: instances game masters claiming shards in turn, each playing
+#     its shard's games on its game workers
+# Games start as GameScheduler starts them (longest first, or in waves with
+# MAX_RESIDENT_MODELS, throttled players one game at a time) and models are loaded
+# and released as ModelLifecycle does. The report gives predicted makespan,
+# peak memory of a game master (SIMULATION_BASE_RSS_MB plus each loaded model's
+# stored size times SIMULATION_MODEL_MEMORY_FACTOR, calibrate both against the
+# batch's "Peak RSS" line) and db writes (statements and match row bytes).
+# Estimates are rough on purpose: deeper searches are costed as a perfectly
+# ordered alpha-beta tree (a lower bound), series as playing all SERIES_GAMES
+# (an upper bound), latencies are the keras model's (dense evaluated players
+# are faster) and model load time isn't counted.
+
+import heapq
+import math
+import os
+from scheduling import BATCH_GAME_WORKERS, DEFAULT_GAME_PLIES, EVALUATIONS_PER_MOVE
+from model_lifecycle import order_lifecycle_games, MODEL_LIFECYCLE, MAX_RESIDENT_MODELS
+from series import SERIES_GAMES
+from heartbeat import BATCH_HEARTBEAT_SECONDS
+
+
+SIMULATION_BASE_RSS_MB = float(os.environ.get("SIMULATION_BASE_RSS_MB", 400)) # game master without models (python, tensorflow)
+SIMULATION_MODEL_MEMORY_FACTOR = float(os.environ.get("SIMULATION_MODEL_MEMORY_FACTOR", 3)) # loaded model bytes per stored model byte
+
+PGN_BYTES_PER_PLY = 7.0 # assumed without recorded games (san, move numbers and spaces)
+MATCH_ROW_BYTES = 120 # match row besides its pgn
+
+
+def evaluations_per_move(depth):
+    """
+    Returns positions evaluated per move at given -> search depth (leaves of a perfectly ordered alpha-beta tree)
+    """
+    depth = max(1, depth)
+    return EVALUATIONS_PER_MOVE ** math.ceil(depth / 2) + EVALUATIONS_PER_MOVE ** (depth // 2) - 1
+
+
+def simulate_schedule(games, workers=BATCH_GAME_WORKERS, ordered=False, start=0.0):
+    """
+    Simulates GameScheduler playing given -> games [(cost, player_1, player_2),...] on workers from start seconds
+    Returns -> timeline [(start, finish, player_1, player_2),...] in the order games start
+    """
+    pending = list(games) if ordered else sorted(games, key=lambda game: game[0], reverse=True)
+    running = [] # heap of (finish, order, throttled player ids)
+    busy_player_ids = set()
+    timeline = []
+    now = start
+
+    while len(pending) > 0 or len(running) > 0:
+        while len(running) < max(1, workers):
+            index = next((i for i, (cost, player_1, player_2) in enumerate(pending)
+                          if not any(player.throttled and player.player_id in busy_player_ids for player in (player_1, player_2))), None)
+            if index == None:
+                break
+            cost, player_1, player_2 = pending.pop(index)
+            throttled_ids = {player.player_id for player in (player_1, player_2) if player.throttled}
+            busy_player_ids.update(throttled_ids)
+            heapq.heappush(running, (now + cost, len(timeline), throttled_ids))
+            timeline.append((now, now + cost, player_1, player_2))
+
+        now, order, throttled_ids = heapq.heappop(running)
+        busy_player_ids.difference_update(throttled_ids)
+
+    return timeline
+
+
+def simulate_models(timeline, model_memory, lifecycle=MODEL_LIFECYCLE, max_resident=MAX_RESIDENT_MODELS, loaded=()):
+    """
+    Simulates loading models for given -> timeline of games, {player_id: bytes of loaded model}, with
+    ModelLifecycle (if lifecycle) or every model kept loaded (with the models already loaded)
+    Returns -> peak bytes of loaded models, most models loaded, player ids loaded afterwards
+    """
+    if not lifecycle:
+        loaded = set(loaded) | {player.player_id for start, finish, player_1, player_2 in timeline for player in (player_1, player_2)}
+        return sum(model_memory.get(player_id, 0) for player_id in loaded), len(loaded), loaded
+
+    remaining = {}
+    next_starts = {} # player_id -> starts of games not started yet, ascending
+    running = {}
+    for start, finish, player_1, player_2 in timeline:
+        for player in (player_1, player_2):
+            remaining[player.player_id] = remaining.get(player.player_id, 0) + 1
+            next_starts.setdefault(player.player_id, []).append(start)
+            running[player.player_id] = 0
+
+    # finishes before starts at the same time, a worker releases its game before taking the next
+    events = sorted([(start, 1, position) for position, (start, finish, player_1, player_2) in enumerate(timeline)] +
+                    [(finish, 0, position) for position, (start, finish, player_1, player_2) in enumerate(timeline)])
+
+    resident = set()
+    peak_bytes, peak_models = 0, 0
+    for time, started, position in events:
+        player_ids = (timeline[position][2].player_id, timeline[position][3].player_id)
+        if started:
+            for player_id in player_ids:
+                running[player_id] += 1
+                next_starts[player_id].pop(0)
+            for player_id in player_ids:
+                if player_id in resident:
+                    continue
+                if max_resident > 0 and len(resident) >= max_resident:
+                    idle = [resident_id for resident_id in resident if running[resident_id] == 0]
+                    if len(idle) > 0:
+                        resident.discard(max(idle, key=lambda resident_id: next_starts[resident_id][0] if len(next_starts[resident_id]) > 0 else math.inf))
+                resident.add(player_id)
+            peak_bytes = max(peak_bytes, sum(model_memory.get(player_id, 0) for player_id in resident))
+            peak_models = max(peak_models, len(resident))
+        else:
+            for player_id in player_ids:
+                running[player_id] -= 1
+                remaining[player_id] -= 1
+                if remaining[player_id] == 0:
+                    resident.discard(player_id)
+
+    return peak_bytes, peak_models, set()
+
+
+def simulate_batch(shards, model_memory, instances=1, workers=BATCH_GAME_WORKERS, lifecycle=MODEL_LIFECYCLE, max_resident=MAX_RESIDENT_MODELS):
+    """
+    Simulates given -> shards [[(cost, player_1, player_2),...],...] claimed in turn by instances game masters
+    (one shard of every game for an unsharded batch), each playing its shard on workers,
+    with {player_id: bytes of loaded model}
+    Returns -> makespan seconds, peak memory bytes of a game master, most models loaded in a game master
+    """
+    free_instances = [(0.0, instance) for instance in range(max(1, instances))]
+    loaded = {} # instance -> player ids kept loaded between shards (without lifecycle)
+    makespan, peak_bytes, peak_models = 0.0, 0, 0
+
+    for shard in shards:
+        now, instance = heapq.heappop(free_instances)
+        if lifecycle:
+            shard = order_lifecycle_games(shard, max_resident)
+        timeline = simulate_schedule(shard, workers, ordered=lifecycle, start=now)
+        shard_bytes, shard_models, loaded[instance] = simulate_models(timeline, model_memory, lifecycle, max_resident, loaded.get(instance, ()))
+
+        finished = max((finish for start, finish, player_1, player_2 in timeline), default=now)
+        heapq.heappush(free_instances, (finished, instance))
+        makespan = max(makespan, finished)
+        peak_bytes = max(peak_bytes, shard_bytes)
+        peak_models = max(peak_models, shard_models)
+
+    return makespan, SIMULATION_BASE_RSS_MB * 2 ** 20 + peak_bytes, peak_models
+
+
+def estimate_db_writes(shards, error_matches, players, instances, game_plies, pgn_bytes_per_ply, sharded=False, makespan=0.0):
+    """
+    Estimates db writes of a batch of given -> shards [[(cost, player_1, player_2),...],...], number of
+    error_matches (unplayable pairings) and players, {player_id: average plies} & pgn bytes per ply,
+    played in makespan seconds
+    Returns -> statements, match row bytes
+    """
+    series_games = max(1, SERIES_GAMES)
+    pairings = sum(len(shard) for shard in shards)
+    matches = pairings * series_games + error_matches
+
+    statements = 1 # new batch
+    statements += matches # match insert
+    statements += int(makespan / BATCH_HEARTBEAT_SECONDS) * instances * (2 if sharded else 1) # batch (and shard) heartbeats
+    if SERIES_GAMES > 1:
+        statements += pairings # series length
+    statements += 2 * players + 1 # player data (elo if sharded) & leaderboard per player, batch complete
+
+    # model stats (and status flags if sharded) of players each game master loaded
+    shard_players = sum(len({player.player_id for cost, player_1, player_2 in shard for player in (player_1, player_2)}) for shard in shards)
+    if sharded:
+        statements += 3 * len(shards) + instances + 1 # shard create, claim & complete, each instance's last claim, finalise claim
+        statements += 2 * shard_players
+    else:
+        statements += shard_players
+
+    plies = sum((game_plies.get(player_1.player_id, DEFAULT_GAME_PLIES) + game_plies.get(player_2.player_id, DEFAULT_GAME_PLIES)) / 2
+                for shard in shards for cost, player_1, player_2 in shard)
+    match_bytes = matches * MATCH_ROW_BYTES + plies * series_games * pgn_bytes_per_ply
+
+    return statements, int(match_bytes)
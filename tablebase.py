@@ -0,0 +1,98 @@
+# Functions to support probing syzygy endgame tablebases.
+#
+# Positions with few enough pieces are solved exactly by syzygy tablebases, so
+# search doesn't need the model there: with SYZYGY_PATH set (directories of
+# .rtbw/.rtbz files, separated like PATH) search.minimax scores tablebase
+# positions from their WDL (win/draw/loss) and DTZ (distance to zeroing)
+# instead of evaluating them, and bot vs. bot games are adjudicated as soon as
+# they reach one (TABLEBASE_ADJUDICATE) rather than played out by weak bots.
+# Cursed wins and blessed losses (won/lost but drawn by the 50 move rule)
+# count as draws.
+
+import chess
+import chess.syzygy
+import os
+import threading
+
+
+SYZYGY_PATH = os.environ.get("SYZYGY_PATH", "") # unset: no tablebase probing
+TABLEBASE_ADJUDICATE = os.environ.get("TABLEBASE_ADJUDICATE", "1") == "1" # end bot games in tablebase positions
+
+TABLEBASE_WIN = 1e6 # evaluation of a won tablebase position (less its DTZ), beyond any model's
+
+# opened on first probe
+tablebase = None
+tablebase_pieces = 0 # most pieces of any loaded table
+tablebase_lock = threading.Lock()
+tablebase_opened = False
+
+
+def open_tablebase():
+    """
+    Opens the tablebases in SYZYGY_PATH (once)
+    Returns -> chess.syzygy.Tablebase | None if none are configured or found
+    """
+    global tablebase, tablebase_pieces, tablebase_opened
+
+    if tablebase_opened:
+        return tablebase
+
+    with tablebase_lock:
+        if not tablebase_opened:
+            directories = [directory for directory in SYZYGY_PATH.split(os.pathsep) if directory != ""]
+            if len(directories) > 0:
+                opened = chess.syzygy.Tablebase()
+                for directory in directories:
+                    try:
+                        opened.add_directory(directory)
+                    except OSError as e:
+                        print(f"Error opening tablebase directory {directory}:", str(e))
+                # table names like KQvK, one letter per piece
+                pieces = max((len(name) - 1 for name in opened.wdl), default=0)
+                if pieces > 0:
+                    tablebase, tablebase_pieces = opened, pieces
+                    print(f"Opened syzygy tablebases for up to {pieces} pieces")
+                else:
+                    print("No syzygy tables found in", SYZYGY_PATH)
+            tablebase_opened = True
+
+    return tablebase
+
+
+def probe_tablebase(board):
+    """
+    Probes given -> board in the tablebases
+    Returns -> (wdl, dtz) for the side to move | None if the position isn't in them
+    """
+    if not tablebase_opened:
+        open_tablebase()
+    if tablebase == None or chess.popcount(board.occupied) > tablebase_pieces or board.castling_rights:
+        return None
+
+    wdl = tablebase.get_wdl(board)
+    if wdl == None:
+        return None
+    dtz = 0
+    if wdl in (-2, 2): # only wins need the distance
+        dtz = tablebase.get_dtz(board, 0)
+    return wdl, dtz
+
+
+def tablebase_result(board):
+    """
+    Returns game result ("1-0", "0-1", "1/2-1/2") of given -> board if the tablebases solve it
+    and TABLEBASE_ADJUDICATE is set | None
+    """
+    if not TABLEBASE_ADJUDICATE:
+        return None
+
+    probe = probe_tablebase(board)
+    if probe == None:
+        return None
+
+    wdl, dtz = probe
+    if wdl == 2:
+        return "1-0" if board.turn == chess.WHITE else "0-1"
+    if wdl == -2:
+        return "0-1" if board.turn == chess.WHITE else "1-0"
+    return "1/2-1/2"
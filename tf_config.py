@@ -0,0 +1,106 @@
+# Functions to support configuring tensorflow for many concurrent small evaluations.
+#
+# Games (and bot move workers) each evaluate one board at a time from their own
+# thread. Left at its defaults tensorflow gives every op a pool as large as the
+# machine, so N game threads oversubscribe the cores N times over. Instead:
+#   - intra/inter op pools are sized to the cores available per game worker
+#   - worker processes (shard_worker.py) can be pinned to their own cores
+#   - models are called directly (or through a compiled tf.function) rather
+#     than with predict, which sets up a whole data pipeline per call
+# Find the best settings for a machine with:
+#   python benchmark_tf.py path/to/model.h5
+
+import os
+import threading
+import weakref
+import numpy
+import tensorflow as tf
+from scheduling import BATCH_GAME_WORKERS
+
+
+# model call path for evaluations: "call" (model(x, training=False)), "function" (compiled tf.function) or "predict"
+MODEL_CALL_MODE = os.environ.get("MODEL_CALL_MODE", "function")
+
+# "1" pins each worker process of shard_worker.py to its own share of the cores
+PIN_WORKERS = os.environ.get("PIN_WORKERS", "0") == "1"
+
+
+def available_cpus():
+    """
+    Returns number of cores this process may run on
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def configure_tensorflow(intra_op_threads=None, inter_op_threads=None):
+    """
+    Sizes tensorflow's thread pools (TF_INTRA_OP_THREADS / TF_INTER_OP_THREADS env,
+    by default the cores available per game worker). Must run before tensorflow runs any op.
+    Returns -> (intra_op_threads, inter_op_threads)
+    """
+    if intra_op_threads == None:
+        intra_op_threads = int(os.environ.get("TF_INTRA_OP_THREADS", max(1, available_cpus() // BATCH_GAME_WORKERS)))
+    if inter_op_threads == None:
+        inter_op_threads = int(os.environ.get("TF_INTER_OP_THREADS", 1))
+
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e: # tensorflow already initialised, keeps its pools
+        print("Tensorflow threads already configured:", str(e))
+
+    return tf.config.threading.get_intra_op_parallelism_threads(), tf.config.threading.get_inter_op_parallelism_threads()
+
+
+def pin_worker(worker_number, workers):
+    """
+    Pins this process to worker_number's share of the available cores (linux only)
+    Call before tensorflow is configured so its pools are sized to the share
+    Returns -> set of cores pinned to | None if pinning is unsupported
+    """
+    if not hasattr(os, "sched_setaffinity"):
+        return None
+
+    cores = sorted(os.sched_getaffinity(0))
+    cores_per_worker = max(1, len(cores) // workers)
+    start = (worker_number * cores_per_worker) % len(cores)
+    worker_cores = set(cores[start:start + cores_per_worker])
+
+    os.sched_setaffinity(0, worker_cores)
+    return worker_cores
+
+
+# compiled call of each model (dropped with the model)
+compiled_calls = weakref.WeakKeyDictionary()
+compiled_calls_lock = threading.Lock()
+
+
+def get_compiled_call(model):
+    """
+    Returns tf.function calling given -> model in inference mode, traced once for any batch size
+    """
+    with compiled_calls_lock:
+        compiled_call = compiled_calls.get(model)
+        if compiled_call == None:
+            input_signature = [tf.TensorSpec((None,) + tuple(model.input_shape[1:]), tf.float32)]
+            model_ref = weakref.ref(model) # a strong reference would keep the cache entry alive
+            compiled_call = tf.function(lambda boards: model_ref()(boards, training=False), input_signature=input_signature)
+            compiled_calls[model] = compiled_call
+    return compiled_call
+
+
+def evaluate_boards(model, boards):
+    """
+    Evaluates given -> batch of encoded boards (numpy array (n, 14, 8, 8)) with model
+    using MODEL_CALL_MODE
+    Returns -> numpy array (n, outputs)
+    """
+    if MODEL_CALL_MODE == "predict":
+        return model.predict(boards)
+
+    boards = numpy.asarray(boards, dtype=numpy.float32)
+    if MODEL_CALL_MODE == "function":
+        return get_compiled_call(model)(tf.constant(boards)).numpy()
+    return numpy.asarray(model(boards, training=False))